@@ -1,15 +1,142 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+except ImportError: # Headless machines can still use the batch mode
+    tk = None
+import argparse
+import hashlib
+import random
+import sys
 import zipfile
 import os
 import time
 import librosa
 import soundfile as sf
 import threading
+import multiprocessing
+import queue
 import pygame
 import tempfile
 import numpy as np
 
+BEAT_POLL_INTERVAL = 100 # ms between checks of the beat detection worker's progress queue
+AUDIO_EXTENSIONS = ('.mp3', '.aac', '.m4a', '.wav', '.ogg')
+# Beat analysis per audio file hash, so regenerating a song skips librosa entirely
+FEATURE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'feature_cache')
+FEATURE_FORMAT = 1 # Bump when the cached features change
+
+class BeatDetectionCancelled(Exception):
+    pass
+
+def feature_cache_path(audio_path):
+    """Cache file for a song, named after the hash of its contents."""
+    digest = hashlib.sha1()
+    with open(audio_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return os.path.join(FEATURE_CACHE_DIR, f'{digest.hexdigest()}-v{FEATURE_FORMAT}.npz')
+
+def load_features(cache_path):
+    """(sample rate, onset envelope, beat frames, tempo) from the cache, or None."""
+    try:
+        with np.load(cache_path) as data:
+            return int(data['sr']), data['onset_envelope'], data['beat_frames'], float(data['tempo'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def save_features(cache_path, sr, onset_envelope, beat_frames, tempo):
+    try:
+        os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, sr=sr, onset_envelope=onset_envelope, beat_frames=beat_frames, tempo=tempo)
+        os.replace(cache_path + '.tmp', cache_path) # Never leave a half-written cache entry
+    except OSError as e:
+        print(f'Could not cache beat analysis: {e}')
+
+def find_beats(audio_path, report=None, cancel=None):
+    """Loads a song and tracks its beats. Returns (tempo, beat times in ms). report(text,
+    fraction) is called before each stage; once cancel is set the next stage raises
+    BeatDetectionCancelled. Songs analysed before come straight from the feature cache."""
+    stages = iter([('Loading audio...', 0.05), ('Measuring onset strength...', 0.4), ('Tracking beats...', 0.7)])
+    def next_stage():
+        if cancel is not None and cancel.is_set():
+            raise BeatDetectionCancelled()
+        if report is not None:
+            report(*next(stages))
+    cache_path = feature_cache_path(audio_path)
+    cached = load_features(cache_path)
+    if cached is not None:
+        sr, onset_envelope, beats, tempo = cached
+    else:
+        next_stage()
+        y, sr = librosa.load(audio_path, sr=None)
+        next_stage()
+        onset_envelope = librosa.onset.onset_strength(y=y, sr=sr)
+        next_stage()
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr)
+        tempo = float(np.atleast_1d(tempo)[0])
+        save_features(cache_path, sr, onset_envelope, beats, tempo)
+    return tempo, beat_times_ms(beats, sr)
+
+def beat_times_ms(beat_frames, sr):
+    return [int(t * 1000) for t in librosa.frames_to_time(beat_frames, sr=sr)]
+
+def detect_beats(audio_path, progress, cancel):
+    """Runs in a worker process: find_beats, reporting through the progress queue as
+    ('progress', text, fraction), then ('done', tempo, beat times in ms) or ('error', message)."""
+    try:
+        tempo, times = find_beats(audio_path, lambda text, fraction: progress.put(('progress', text, fraction)), cancel)
+        progress.put(('done', tempo, times))
+    except BeatDetectionCancelled:
+        pass
+    except Exception as e:
+        progress.put(('error', str(e)))
+
+def place_circles(times_ms, rng=random):
+    """One hit circle per beat, spread across the playfield."""
+    return [(rng.randint(100, 700), rng.randint(100, 500), ms) for ms in times_ms]
+
+def build_osu_file(audio_filename, title, artist, creator, hitobjects):
+    # Minimal .osu file for circles only
+    lines = [
+        'osu file format v14',
+        '',
+        '[General]',
+        f'AudioFilename: {audio_filename}',
+        'AudioLeadIn: 0',
+        '',
+        '[Metadata]',
+        f'Title:{title}',
+        f'Artist:{artist}',
+        f'Creator:{creator}',
+        '',
+        '[Difficulty]',
+        'HPDrainRate:5',
+        'CircleSize:4',
+        'OverallDifficulty:5',
+        'ApproachRate:5',
+        '',
+        '[HitObjects]'
+    ]
+    for x, y, t in hitobjects:
+        lines.append(f'{x},{y},{t},1,0,0:0:0:0:')
+    return '\n'.join(lines)
+
+def write_osz(save_path, audio_path, title, osu_content):
+    osu_filename = f"{title.replace(' ', '_')}.osu"
+    # Written next to its final path and moved into place, so a worker killed mid-write
+    # never leaves a truncated .osz that later runs would skip as already generated
+    temp_path = save_path + '.tmp'
+    try:
+        with zipfile.ZipFile(temp_path, 'w') as z:
+            z.write(audio_path, os.path.basename(audio_path))
+            z.writestr(osu_filename, osu_content)
+        os.replace(temp_path, save_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 class OsuMapGenerator:
     def __init__(self, root):
         self.root = root
@@ -20,7 +147,11 @@ class OsuMapGenerator:
         self.artist = tk.StringVar()
         self.creator = tk.StringVar()
         self.hitobjects = []
+        self.beat_worker = None    # Beat detection process, its progress queue and cancel flag
+        self.beat_progress = None
+        self.beat_cancel = None
         self.setup_ui()
+        self.root.protocol('WM_DELETE_WINDOW', self.on_close)
 
     def setup_ui(self):
         tk.Label(self.root, text='osu! Beatmap Generator', font=('Arial', 18, 'bold')).pack(pady=10)
@@ -34,7 +165,12 @@ class OsuMapGenerator:
         tk.Label(self.root, text='Creator:').pack()
         tk.Entry(self.root, textvariable=self.creator).pack()
         tk.Button(self.root, text='Add Hit Circle', command=self.add_hit_circle).pack(pady=5)
-        tk.Button(self.root, text='Auto-Generate Hit Circles (Detect Beats)', command=self.auto_generate_circles).pack(pady=5)
+        self.detect_button = tk.Button(self.root, text='Auto-Generate Hit Circles (Detect Beats)', command=self.auto_generate_circles)
+        self.detect_button.pack(pady=5)
+        self.progress_bar = ttk.Progressbar(self.root, length=300, maximum=1.0)
+        self.progress_bar.pack(pady=2)
+        self.cancel_button = tk.Button(self.root, text='Cancel Beat Detection', command=self.cancel_beat_detection, state=tk.DISABLED)
+        self.cancel_button.pack(pady=2)
         tk.Button(self.root, text='Export .osz', command=self.export_osz).pack(pady=10)
         tk.Button(self.root, text='Preview Map', command=self.preview_map).pack(pady=5)
         self.status = tk.Label(self.root, text='')
@@ -75,21 +211,80 @@ class OsuMapGenerator:
         if not self.mp3_path:
             messagebox.showerror('Error', 'Please select an audio file first!')
             return
+        if self.beat_worker is not None:
+            return
+        # A cached song needs no worker; spawning one would re-import everything just to read the cache
         try:
-            y, sr = librosa.load(self.mp3_path, sr=None)
-            tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-            times = librosa.frames_to_time(beats, sr=sr)
-            self.hitobjects.clear()
-            # Spread circles across the playfield
-            import random
-            for i, t in enumerate(times):
-                x = random.randint(100, 700)
-                y_ = random.randint(100, 500)
-                ms = int(t * 1000)
-                self.hitobjects.append((x, y_, ms))
-            self.status.config(text=f'Generated {len(self.hitobjects)} hit circles from beats')
-        except Exception as e:
-            messagebox.showerror('Error', f'Beat detection failed: {e}')
+            cached = load_features(feature_cache_path(self.mp3_path))
+        except OSError:
+            cached = None # The worker reports the unreadable file
+        if cached is not None:
+            sr, _, beats, tempo = cached
+            self._place_circles(tempo, beat_times_ms(beats, sr))
+            return
+        # librosa runs in its own process so the window stays responsive on long songs
+        context = multiprocessing.get_context('spawn')
+        self.beat_progress = context.Queue()
+        self.beat_cancel = context.Event()
+        self.beat_worker = context.Process(target=detect_beats, args=(self.mp3_path, self.beat_progress, self.beat_cancel), daemon=True)
+        self.beat_worker.start()
+        self.detect_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar['value'] = 0
+        self.status.config(text='Starting beat detection...')
+        self.root.after(BEAT_POLL_INTERVAL, self._poll_beat_detection)
+
+    def _poll_beat_detection(self):
+        if self.beat_worker is None:
+            return # Cancelled
+        try:
+            while True:
+                message = self.beat_progress.get_nowait()
+                if message[0] == 'progress':
+                    self.status.config(text=message[1])
+                    self.progress_bar['value'] = message[2]
+                elif message[0] == 'done':
+                    self._finish_beat_detection()
+                    self._place_circles(message[1], message[2])
+                    return
+                else:
+                    self._finish_beat_detection()
+                    messagebox.showerror('Error', f'Beat detection failed: {message[1]}')
+                    return
+        except queue.Empty:
+            pass
+        if not self.beat_worker.is_alive() and self.beat_progress.empty():
+            self._finish_beat_detection()
+            messagebox.showerror('Error', 'Beat detection stopped unexpectedly.')
+            return
+        self.root.after(BEAT_POLL_INTERVAL, self._poll_beat_detection)
+
+    def _place_circles(self, tempo, times_ms):
+        self.hitobjects[:] = place_circles(times_ms)
+        self.progress_bar['value'] = 1.0
+        self.status.config(text=f'Generated {len(self.hitobjects)} hit circles from beats ({tempo:.0f} BPM)')
+
+    def cancel_beat_detection(self):
+        if self.beat_worker is None:
+            return
+        # librosa cannot be interrupted mid-call, so the flag covers the gaps between stages
+        # and terminate() covers the rest
+        self.beat_cancel.set()
+        self.beat_worker.terminate()
+        self._finish_beat_detection()
+        self.progress_bar['value'] = 0
+        self.status.config(text='Beat detection cancelled')
+
+    def _finish_beat_detection(self):
+        self.beat_worker.join(timeout=1)
+        self.beat_worker = self.beat_progress = self.beat_cancel = None
+        self.detect_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+
+    def on_close(self):
+        if self.beat_worker is not None:
+            self.beat_worker.terminate()
+        self.root.destroy()
 
     def export_osz(self):
         if not self.mp3_path or not self.hitobjects or not self.map_name.get():
@@ -98,42 +293,16 @@ class OsuMapGenerator:
         save_path = filedialog.asksaveasfilename(defaultextension='.osz', filetypes=[('osu! Beatmap Archive', '*.osz')])
         if not save_path:
             return
-        osu_filename = f"{self.map_name.get().replace(' ', '_')}.osu"
         # Write .osu file content
         osu_content = self.generate_osu_file()
         try:
-            with zipfile.ZipFile(save_path, 'w') as z:
-                z.write(self.mp3_path, os.path.basename(self.mp3_path))
-                z.writestr(osu_filename, osu_content)
+            write_osz(save_path, self.mp3_path, self.map_name.get(), osu_content)
             self.status.config(text=f'Exported {os.path.basename(save_path)}')
         except Exception as e:
             messagebox.showerror('Error', f'Failed to export: {e}')
 
     def generate_osu_file(self):
-        # Minimal .osu file for circles only
-        lines = [
-            'osu file format v14',
-            '',
-            '[General]',
-            f'AudioFilename: {os.path.basename(self.mp3_path)}',
-            'AudioLeadIn: 0',
-            '',
-            '[Metadata]',
-            f'Title:{self.map_name.get()}',
-            f'Artist:{self.artist.get()}',
-            f'Creator:{self.creator.get()}',
-            '',
-            '[Difficulty]',
-            'HPDrainRate:5',
-            'CircleSize:4',
-            'OverallDifficulty:5',
-            'ApproachRate:5',
-            '',
-            '[HitObjects]'
-        ]
-        for x, y, t in self.hitobjects:
-            lines.append(f'{x},{y},{t},1,0,0:0:0:0:')
-        return '\n'.join(lines)
+        return build_osu_file(os.path.basename(self.mp3_path), self.map_name.get(), self.artist.get(), self.creator.get(), self.hitobjects)
 
     def preview_map(self):
         if not self.mp3_path or not self.hitobjects:
@@ -196,7 +365,95 @@ class OsuMapGenerator:
         if temp_wav:
             os.unlink(temp_wav.name)
 
+def generate_map_file(audio_path, out_dir, creator):
+    """Batch mode: beat-tracks one song and exports it as an .osz next to the others.
+    Titles come from 'Artist - Title' file names. Returns (circle count, tempo)."""
+    stem = os.path.splitext(os.path.basename(audio_path))[0]
+    artist, _, title = stem.partition(' - ')
+    if not title:
+        artist, title = 'Unknown', stem
+    tempo, times = find_beats(audio_path)
+    hitobjects = place_circles(times, random.Random(stem)) # Same layout on every run
+    osu_content = build_osu_file(os.path.basename(audio_path), title, artist, creator, hitobjects)
+    write_osz(os.path.join(out_dir, stem + '.osz'), audio_path, title, osu_content)
+    return len(hitobjects), tempo
+
+def _batch_worker(audio_path, out_dir, creator, results):
+    try:
+        results.put((audio_path, 'ok', generate_map_file(audio_path, out_dir, creator)))
+    except Exception as e:
+        results.put((audio_path, 'failed', str(e)))
+
+def run_batch(music_dir, out_dir, creator='osu!python', workers=None, timeout=300, overwrite=False):
+    """Generates a map for every song in music_dir, a few processes at a time. A song that
+    takes longer than `timeout` seconds has its process killed. Prints a summary and
+    returns the number of songs that did not produce a map."""
+    os.makedirs(out_dir, exist_ok=True)
+    songs = sorted(os.path.join(music_dir, name) for name in os.listdir(music_dir) if name.lower().endswith(AUDIO_EXTENSIONS))
+    outcome = {}
+    pending = []
+    for path in songs:
+        if not overwrite and os.path.exists(os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '.osz')):
+            outcome[path] = ('skipped', 'map already exists')
+        else:
+            pending.append(path)
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    # One process per song rather than a pool, so a song that hangs can be killed on its own
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    running = {} # path -> (process, deadline)
+    started = time.time()
+    while pending or running:
+        while pending and len(running) < workers:
+            path = pending.pop(0)
+            process = context.Process(target=_batch_worker, args=(path, out_dir, creator, results), daemon=True)
+            process.start()
+            running[path] = (process, time.time() + timeout)
+        try:
+            path, status, detail = results.get(timeout=0.5)
+            if path in running: # Otherwise it already timed out
+                outcome[path] = (status, detail)
+                print(f"[{len(outcome)}/{len(songs)}] {status}: {os.path.basename(path)}")
+                running.pop(path)[0].join()
+        except queue.Empty:
+            pass
+        for path, (process, deadline) in list(running.items()):
+            if time.time() > deadline:
+                process.terminate()
+                outcome[path] = ('timed out', f'over {timeout}s')
+            elif not process.is_alive() and results.empty():
+                outcome[path] = ('failed', f'worker exited with code {process.exitcode}')
+            else:
+                continue
+            process.join()
+            del running[path]
+            print(f"[{len(outcome)}/{len(songs)}] {outcome[path][0]}: {os.path.basename(path)}")
+
+    counts = {}
+    for status, _ in outcome.values():
+        counts[status] = counts.get(status, 0) + 1
+    circles = sum(detail[0] for status, detail in outcome.values() if status == 'ok')
+    print(f"\nProcessed {len(songs)} songs in {time.time() - started:.1f}s: "
+          + ', '.join(f'{count} {status}' for status, count in sorted(counts.items())) + f", {circles} hit circles")
+    for path, (status, detail) in sorted(outcome.items()):
+        if status in ('failed', 'timed out'):
+            print(f"  {status}: {os.path.basename(path)} ({detail})")
+    return counts.get('failed', 0) + counts.get('timed out', 0)
+
 def main():
+    parser = argparse.ArgumentParser(description='osu! beatmap generator. Without --batch, opens the editor window.')
+    parser.add_argument('--batch', metavar='MUSIC_DIR', help='generate a map for every song in this folder, without a window')
+    parser.add_argument('--out', metavar='DIR', help='where batch maps are written (default: MUSIC_DIR/maps)')
+    parser.add_argument('--creator', default='osu!python', help='creator name written into batch maps')
+    parser.add_argument('--workers', type=int, help='songs analysed at once (default: CPU count - 1)')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before a song is given up on (default: 300)')
+    parser.add_argument('--overwrite', action='store_true', help='regenerate maps that already exist')
+    args = parser.parse_args()
+    if args.batch:
+        out_dir = args.out or os.path.join(args.batch, 'maps')
+        sys.exit(1 if run_batch(args.batch, out_dir, args.creator, args.workers, args.timeout, args.overwrite) else 0)
+    if tk is None:
+        parser.error('tkinter is not available; use --batch for headless generation')
     root = tk.Tk()
     app = OsuMapGenerator(root)
     root.mainloop()
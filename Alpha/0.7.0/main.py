@@ -4,11 +4,22 @@ import math
 import random
 import os
 import datetime
-import tempfile
+import bisect
+import io
+import time
+import json
+import hashlib
+import importlib.util
 import numpy as np
 import shutil
+import threading
+import multiprocessing
+import wave
 import zipfile
+import zlib
 import pygame.gfxdraw
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 # Global settings dictionary (to be updated and passed around)
 SETTINGS = {
@@ -20,11 +31,71 @@ SETTINGS = {
     'difficulty_multiplier': 1.0, # Placeholder for future difficulty
     'approach_circle_speed': 'Normal', # New: Example dropdown
     'show_fps_counter': True,
+    'map_sort': 'artist', # One of MAP_SORT_KEYS
+    'audio_frequency': 44100, # Mixer settings, see AUDIO_FREQUENCIES and friends
+    'audio_buffer': 512,
+    'audio_channels': 2,
+    'audio_offset': 0, # ms the game clock runs behind the music, measured by the calibration screen
+    'rate_mod': 'None', # One of RATE_MOD_CYCLE
+}
+SETTINGS_PATH = os.path.join(os.path.dirname(__file__), 'settings.json')
+# Settings that are saved between runs (the window size is not)
+PERSISTED_SETTINGS = ('custom_cursor', 'music_volume', 'sfx_volume', 'approach_circle_speed', 'show_fps_counter',
+                      'map_sort', 'audio_frequency', 'audio_buffer', 'audio_channels', 'audio_offset', 'rate_mod')
+
+# Audio members up to this size are read into memory, larger ones are streamed from the archive
+MAX_BUFFERED_AUDIO_BYTES = 32 * 1024 * 1024
+AUDIO_EXTENSIONS = ('.mp3', '.ogg', '.wav')
+# Formats pygame cannot load; they are converted to WAV in the audio cache during library scans
+TRANSCODE_EXTENSIONS = ('.aac', '.m4a')
+# Rate-change mods: playback rate and whether the pitch is kept (time stretch) or follows the
+# speed (resampling, like Nightcore). Their audio is rendered once per song into the audio cache.
+RATE_MODS = {'DT': (1.5, True), 'HT': (0.75, True), 'NC': (1.5, False)}
+RATE_MOD_CYCLE = ('None', 'DT', 'HT', 'NC')
+# Keeping the pitch needs librosa's time stretch; without it DT and HT resample like NC
+LIBROSA_AVAILABLE = importlib.util.find_spec('librosa') is not None
+# Decoded song audio from .osz archives is cached as WAV files up to this total size
+AUDIO_CACHE_BYTES = 512 * 1024 * 1024
+
+# What pygame.mixer.music is currently streaming from. The file object (and the archive it
+# reads from) must stay open for as long as the music is loaded.
+_MUSIC_SOURCE = {'file': None, 'archive': None}
+
+# How long the maps menu selection has to rest on an entry before it is preloaded
+PRELOAD_SETTLE_TIME = 250 # ms
+
+# Song previews in the maps menu: clip length and the total size of decoded clips kept around
+PREVIEW_CLIP_SECONDS = 12
+PREVIEW_CACHE_BYTES = 48 * 1024 * 1024
+
+# Song analysis for visualizers, computed once per song and cached next to the library index
+ANALYSIS_FORMAT = 1      # Bump whenever the analysis arrays change
+ENVELOPE_RATE = 200      # Waveform envelope points per second
+SPECTRUM_FPS = 60        # Band magnitude rows per second
+SPECTRUM_BANDS = 16      # Log-spaced bands from SPECTRUM_LOW_HZ up
+SPECTRUM_LOW_HZ = 40
+SPECTRUM_WINDOW = 2048   # FFT size in samples
+SPECTRUM_CHUNK = 512     # Frames transformed at once, bounds the temporary FFT buffers
+
+# Map library index: a snapshot of the maps/ folder plus the entries parsed from each file,
+# persisted so that opening the map list only has to re-parse files that actually changed
+MAPS_DIR = os.path.join(os.path.dirname(__file__), 'maps')
+LIBRARY_INDEX_PATH = os.path.join(os.path.dirname(__file__), 'library_index.json')
+MAP_EXTENSIONS = ('.osu', '.osz', '.txt')
+LIBRARY_RESCAN_INTERVAL = 2000 # ms between rescans while the maps menu is open
+LIBRARY_INDEX_FORMAT = 3 # Bump whenever the layout of the stored entries changes
+SEARCH_FUZZY_RATIO = 0.6 # Share of query trigrams a map needs when no exact match exists
+
+_MAP_LIBRARY = {
+    'loaded': False,  # Whether the on-disk index has been read yet
+    'snapshot': {},   # path -> [inode, size, mtime_ns]
+    'entries': {},    # path -> list of map entries parsed from that file
+    'added': {},      # path -> unix time the file was first seen
+    'offsets': {},    # path -> {difficulty: ms}, per-map audio offsets set by the player
+    'transcode_format': None, # Mixer format every file was last checked for conversion with
+    'version': 0,     # Bumped whenever the entries change
+    'last_scan': 0,   # pygame ticks of the last scan
 }
-
-# Global variables for audio path and temp file
-audio_path = None
-current_audio_temp_file = None
 
 # Initial window dimensions (can be changed by resizing)
 INITIAL_WIDTH, INITIAL_HEIGHT = 800, 600
@@ -52,16 +123,38 @@ CIRCLE_OUTLINE_COLOR = OSU_WHITE
 NUMBER_COLOR = OSU_WHITE
 BACKGROUND_COLOR = OSU_DARK_GREY
 
+# Slider curves are sampled once at load time; this caches the result per curve definition,
+# least recently used first, so a retry reuses them without the session's maps piling up
+SLIDER_SAMPLE_SPACING = 4 # Target distance in osu! pixels between sampled curve points
+SLIDER_PATH_CACHE_SIZE = 4096 # Curves kept, a few maps' worth
+_SLIDER_PATH_CACHE = OrderedDict()
+
+# Menus sleep in pygame.event.wait until input arrives or an animation asks for a frame
+MENU_ANIMATION_FPS = 30 # Frame rate of decorative menu animations such as the logo pulse
+MENU_IDLE_TIMEOUT = 1000 # ms; menus still wake up this often with nothing to animate
+_FRAME_REQUEST = {'due': None}
+
+# A drag-resize fires many VIDEORESIZE events; the display is only reset once they stop
+RESIZE_SETTLE_TIME = 150 # ms
+_RESIZE = {'size': None, 'at': 0}
+
 # Global animation state dictionary for holiday elements
 _ANIMATION_STATE = {
     'current_holiday_type': None, # Tracks which holiday is currently active to manage transitions
-    'firework_particles': [],
-    'firework_active': False,
-    'firework_start_time': 0,
+    'firework': None, # Current FireworkBurst
     'pumpkin_glow_phase': 0.0,
     'christmas_lights': [],
 }
 
+_FONTS = {}
+
+def get_font(size, bold=False):
+    """Returns a shared Arial font. SysFont lookups are slow and the fonts never change."""
+    key = (size, bold)
+    if key not in _FONTS:
+        _FONTS[key] = pygame.font.SysFont('Arial', size, bold=bold)
+    return _FONTS[key]
+
 # HitCircle class
 # Revamped hit circle with animated gradient, glow, and shadow
 def draw_hit_circle(surface, pos, number, approach=1.0):
@@ -85,7 +178,7 @@ def draw_hit_circle(surface, pos, number, approach=1.0):
     aa_filled_circle(surface, CIRCLE_COLOR, (int(pos[0]), int(pos[1])), CIRCLE_RADIUS)
     aa_circle(surface, CIRCLE_OUTLINE_COLOR, (int(pos[0]), int(pos[1])), CIRCLE_RADIUS, CIRCLE_OUTLINE)
     # Draw number with shadow and glow
-    font = pygame.font.SysFont('Arial', 36, bold=True)
+    font = get_font(36, bold=True)
     text = font.render(str(number), True, NUMBER_COLOR)
     text_shadow = font.render(str(number), True, OSU_DARK_BLUE)
     text_rect = text.get_rect(center=pos)
@@ -111,6 +204,9 @@ class HitObject:
         self.approach_time = 1200  # ms
         self.hit_window = 300      # ms
         self.lifetime = self.approach_time + self.hit_window
+        self.hitsound = 0          # hitSound bit flags from the .osu file
+        self.sample_set = 'normal'
+        self.addition_set = 'normal'
 
     def draw(self, surface, now):
         t = self.time - now
@@ -136,6 +232,216 @@ class HitObject:
                 return True
         return False
 
+    def finished(self, now):
+        return self.hit or self.disappeared
+
+def _sample_count(points):
+    """Number of samples for a curve segment, based on the length of its control polygon."""
+    polygon_length = np.sum(np.linalg.norm(np.diff(points, axis=0), axis=1))
+    return int(max(2, min(1000, polygon_length / SLIDER_SAMPLE_SPACING)))
+
+def _bezier_segment(points):
+    # Evaluate the Bernstein basis for every sample at once: (samples x n+1) @ (n+1 x 2)
+    n = len(points) - 1
+    t = np.linspace(0.0, 1.0, _sample_count(points))[:, None]
+    k = np.arange(n + 1)
+    coefficients = np.array([math.comb(n, i) for i in k], dtype=float)
+    basis = coefficients * t**k * (1.0 - t)**(n - k)
+    return basis @ points
+
+def _bezier_path(points):
+    # Repeated control points ("red anchors") split the curve into separate Bezier segments
+    segments = [[points[0]]]
+    for prev, point in zip(points[:-1], points[1:]):
+        if np.array_equal(prev, point):
+            segments.append([point])
+        else:
+            segments[-1].append(point)
+    parts = [_bezier_segment(np.array(segment)) for segment in segments if len(segment) > 1]
+    return np.concatenate(parts) if parts else points
+
+def _circle_arc_path(points):
+    a, b, c = points
+    d = 2.0 * (a[0] * (b[1] - c[1]) + b[0] * (c[1] - a[1]) + c[0] * (a[1] - b[1]))
+    if abs(d) < 1e-6:
+        return _bezier_path(points) # Collinear points have no circumcircle
+    a_sq, b_sq, c_sq = a @ a, b @ b, c @ c
+    center = np.array([
+        (a_sq * (b[1] - c[1]) + b_sq * (c[1] - a[1]) + c_sq * (a[1] - b[1])) / d,
+        (a_sq * (c[0] - b[0]) + b_sq * (a[0] - c[0]) + c_sq * (b[0] - a[0])) / d,
+    ])
+    radius = np.linalg.norm(a - center)
+    start_angle = math.atan2(a[1] - center[1], a[0] - center[0])
+    end_angle = math.atan2(c[1] - center[1], c[0] - center[0])
+    # Walk the arc in the direction that passes through the middle point
+    orientation = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    if orientation > 0:
+        while end_angle < start_angle:
+            end_angle += 2 * math.pi
+    else:
+        while end_angle > start_angle:
+            end_angle -= 2 * math.pi
+    samples = int(max(2, min(1000, abs(end_angle - start_angle) * radius / SLIDER_SAMPLE_SPACING)))
+    angles = np.linspace(start_angle, end_angle, samples)
+    return center + radius * np.column_stack((np.cos(angles), np.sin(angles)))
+
+def _catmull_path(points):
+    # Uniform Catmull-Rom through every control point, all segments evaluated together
+    if len(points) < 3:
+        return points
+    v2, v3 = points[:-1], points[1:]
+    v1 = np.vstack((points[:1], points[:-2]))
+    v4 = np.vstack((points[2:], points[-1:] * 2 - points[-2:-1]))
+    t = np.linspace(0.0, 1.0, _sample_count(points) // (len(points) - 1) + 2)[None, :, None]
+    v1, v2, v3, v4 = (v[:, None, :] for v in (v1, v2, v3, v4))
+    curve = 0.5 * (2 * v2 + (v3 - v1) * t + (2 * v1 - 5 * v2 + 4 * v3 - v4) * t**2 + (3 * v2 - v1 - 3 * v3 + v4) * t**3)
+    return curve.reshape(-1, 2)
+
+class SliderPath:
+    """Sampled polyline of a slider curve plus its cumulative length table, trimmed
+    (or extended) to the slider's pixel length."""
+    def __init__(self, curve_type, control_points, pixel_length):
+        points = np.array(control_points, dtype=float)
+        if curve_type == 'P' and len(points) == 3:
+            polyline = _circle_arc_path(points)
+        elif curve_type == 'C':
+            polyline = _catmull_path(points)
+        elif curve_type == 'L':
+            polyline = points
+        else:
+            polyline = _bezier_path(points)
+        # Drop zero-length steps so interpolation never divides by zero
+        steps = np.linalg.norm(np.diff(polyline, axis=0), axis=1)
+        keep = np.concatenate(([True], steps > 1e-9))
+        polyline, steps = polyline[keep], steps[steps > 1e-9]
+        cumulative = np.concatenate(([0.0], np.cumsum(steps)))
+
+        if pixel_length > 0 and len(polyline) > 1:
+            if cumulative[-1] > pixel_length:
+                end = np.searchsorted(cumulative, pixel_length)
+                polyline = polyline[:end + 1].copy()
+                cumulative = cumulative[:end + 1].copy()
+                ratio = (pixel_length - cumulative[-2]) / (cumulative[-1] - cumulative[-2])
+                polyline[-1] = polyline[-2] + (polyline[-1] - polyline[-2]) * ratio
+                cumulative[-1] = pixel_length
+            elif cumulative[-1] < pixel_length:
+                direction = (polyline[-1] - polyline[-2]) / (cumulative[-1] - cumulative[-2])
+                polyline = np.vstack((polyline, polyline[-1] + direction * (pixel_length - cumulative[-1])))
+                cumulative = np.append(cumulative, pixel_length)
+        self.points = polyline
+        self.cumulative = cumulative
+        self.length = float(cumulative[-1])
+
+    def position_at(self, distance):
+        """Position at a distance along the path, by binary search on the length table."""
+        if len(self.points) == 1:
+            return tuple(self.points[0])
+        distance = min(max(distance, 0.0), self.length)
+        i = min(max(int(np.searchsorted(self.cumulative, distance)), 1), len(self.points) - 1)
+        span = self.cumulative[i] - self.cumulative[i - 1]
+        ratio = (distance - self.cumulative[i - 1]) / span if span > 0 else 0.0
+        point = self.points[i - 1] + (self.points[i] - self.points[i - 1]) * ratio
+        return (float(point[0]), float(point[1]))
+
+def build_slider_path(curve_type, control_points, pixel_length):
+    """Returns the SliderPath for a curve definition, computing it only once."""
+    key = (curve_type, tuple(control_points), pixel_length)
+    path = _SLIDER_PATH_CACHE.get(key)
+    if path is None:
+        path = SliderPath(curve_type, control_points, pixel_length)
+        _SLIDER_PATH_CACHE[key] = path
+        if len(_SLIDER_PATH_CACHE) > SLIDER_PATH_CACHE_SIZE:
+            _SLIDER_PATH_CACHE.popitem(last=False)
+    else:
+        _SLIDER_PATH_CACHE.move_to_end(key)
+    return path
+
+class SliderObject(HitObject):
+    def __init__(self, pos, time, number, path, slides, end_time):
+        super().__init__(pos, time, number)
+        self.path = path
+        self.slides = max(1, slides)
+        self.end_time = end_time
+        self.body_surface = None # Pre-rendered body, created on first draw and freed once the slider ends
+        self.body_offset = (0, 0)
+
+    def finished(self, now):
+        return self.disappeared or (self.hit and now > self.end_time)
+
+    def ball_position(self, now):
+        span_duration = (self.end_time - self.time) / self.slides
+        if span_duration <= 0:
+            return self.pos
+        progress = (now - self.time) / span_duration
+        span = min(int(progress), self.slides - 1)
+        fraction = min(max(progress - span, 0.0), 1.0)
+        if span % 2 == 1:
+            fraction = 1.0 - fraction # Reverse slides run back towards the head
+        return self.path.position_at(fraction * self.path.length)
+
+    def _render_body(self):
+        # Stamp circles along the path once, evenly spaced by length
+        distances = np.arange(0.0, self.path.length + SLIDER_SAMPLE_SPACING, SLIDER_SAMPLE_SPACING)
+        xs = np.interp(distances, self.path.cumulative, self.path.points[:, 0])
+        ys = np.interp(distances, self.path.cumulative, self.path.points[:, 1])
+        left, top = int(xs.min()) - CIRCLE_RADIUS - 2, int(ys.min()) - CIRCLE_RADIUS - 2
+        width, height = int(xs.max()) - left + CIRCLE_RADIUS + 3, int(ys.max()) - top + CIRCLE_RADIUS + 3
+        body = pygame.Surface((width, height), pygame.SRCALPHA)
+        centers = [(int(x) - left, int(y) - top) for x, y in zip(xs, ys)]
+        for center in centers:
+            pygame.draw.circle(body, OSU_WHITE + (200,), center, CIRCLE_RADIUS)
+        for center in centers:
+            pygame.draw.circle(body, OSU_DARK_BLUE + (200,), center, CIRCLE_RADIUS - CIRCLE_OUTLINE)
+        self.body_surface = body
+        self.body_offset = (left, top)
+
+    def draw_body(self, surface, now):
+        """Draws the slider track and, while it is running, the slider ball."""
+        if self.disappeared or self.time - now >= self.approach_time:
+            return
+        if now > self.end_time:
+            self.body_surface = None
+            return
+        if self.body_surface is None:
+            self._render_body()
+        surface.blit(self.body_surface, self.body_offset)
+        if now >= self.time:
+            ball = self.ball_position(now)
+            ball = (int(ball[0]), int(ball[1]))
+            aa_filled_circle(surface, OSU_YELLOW, ball, CIRCLE_RADIUS // 2)
+            aa_circle(surface, OSU_WHITE, ball, CIRCLE_RADIUS, 2) # Follow circle
+
+def slider_timing(timing_points):
+    """Turns [TimingPoints] rows into (times, beat_lengths, velocities) for bisect lookups."""
+    times, beat_lengths, velocities = [], [], []
+    beat_length, velocity = 500.0, 1.0
+    for tp_time, value, uninherited in sorted(timing_points, key=lambda tp: tp[0]):
+        if uninherited:
+            beat_length, velocity = value, 1.0
+        elif value < 0:
+            velocity = -100.0 / value
+        times.append(tp_time)
+        beat_lengths.append(beat_length)
+        velocities.append(velocity)
+    return times, beat_lengths, velocities
+
+def make_slider(parts, number, slider_multiplier, timing):
+    """Builds a SliderObject from a [HitObjects] row, computing its curve at load time."""
+    x, y, t = int(parts[0]), int(parts[1]), int(parts[2])
+    curve = parts[5].split('|')
+    control_points = [(x, y)]
+    for point in curve[1:]:
+        px, py = point.split(':')
+        control_points.append((int(px), int(py)))
+    slides, pixel_length = int(parts[6]), float(parts[7])
+    path = build_slider_path(curve[0], control_points, pixel_length)
+
+    times, beat_lengths, velocities = timing
+    i = bisect.bisect_right(times, t) - 1
+    beat_length, velocity = (beat_lengths[i], velocities[i]) if i >= 0 else (500.0, 1.0)
+    duration = path.length / (slider_multiplier * 100 * velocity) * beat_length * slides
+    return SliderObject((x, y), t, number, path, slides, t + int(duration))
+
 def generate_hitobjects(count):
     hitobjects = []
     t = 1000
@@ -146,7 +452,30 @@ def generate_hitobjects(count):
         t += 800
     return hitobjects
 
-def load_map(filepath):
+# sampleSet numbers used by timing points and hitSample fields
+OSU_SAMPLE_SETS = {'1': 'normal', '2': 'soft', '3': 'drum'}
+
+def apply_hitsound_fields(obj, parts, sample_points, default_sample_set):
+    """Sets an object's hitsound flags and sample sets from its [HitObjects] row. The sets
+    come from the row's hitSample field, falling back to the active timing point and then
+    to the map's SampleSet."""
+    obj.hitsound = int(parts[4]) if len(parts) > 4 and parts[4].isdigit() else 0
+    times, sets = sample_points
+    i = bisect.bisect_right(times, obj.time) - 1
+    sample_set = sets[i] if i >= 0 else default_sample_set
+    if sample_set not in HITSOUND_SAMPLE_SETS:
+        sample_set = 'normal'
+    addition_set = sample_set
+    # hitSample ("normalSet:additionSet:index:volume:filename") is the last field of the row
+    hit_sample = parts[-1].split(':') if len(parts) > 5 and ':' in parts[-1] and '|' not in parts[-1] else []
+    if len(hit_sample) >= 2:
+        sample_set = OSU_SAMPLE_SETS.get(hit_sample[0], sample_set)
+        addition_set = OSU_SAMPLE_SETS.get(hit_sample[1], sample_set)
+    obj.sample_set, obj.addition_set = sample_set, addition_set
+
+def load_map(filepath, difficulty=None):
+    """Fully parses a map. For .osz archives, difficulty names the .osu member to play
+    (the first one when omitted); the other difficulties are never read."""
     hitobjects = []
     map_name = os.path.splitext(os.path.basename(filepath))[0]
     lines = []
@@ -154,6 +483,8 @@ def load_map(filepath):
         try:
             with zipfile.ZipFile(filepath, 'r') as z:
                 osu_files = [f for f in z.namelist() if f.endswith('.osu')]
+                if difficulty in osu_files:
+                    osu_files = [difficulty]
                 if osu_files:
                     with z.open(osu_files[0]) as f:
                         lines = [l.decode('utf-8').strip() for l in f.readlines()]
@@ -164,19 +495,43 @@ def load_map(filepath):
     else:
         with open(filepath, 'r') as f:
             lines = [line.strip() for line in f]
-    # Parse .osu or .osz (only circles supported)
-    in_hitobjects = False
+    # Parse .osu or .osz (circles and sliders, spinners are played as circles)
+    section = None
+    slider_multiplier = 1.4
+    timing_points = []
+    timing = None
+    default_sample_set = 'normal'
+    sample_points = ([], []) # Times and sample sets of the timing points
     for line in lines:
         if not line or line.startswith('#'):
             continue
-        if line.startswith('[HitObjects]'):
-            in_hitobjects = True
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
             continue
-        if in_hitobjects:
+        if section == 'General' and line.startswith('SampleSet:'):
+            default_sample_set = line.split(':', 1)[1].strip().lower()
+        elif section == 'Difficulty' and line.startswith('SliderMultiplier:'):
+            slider_multiplier = float(line.split(':', 1)[1])
+        elif section == 'TimingPoints':
             parts = line.split(',')
-            if len(parts) >= 3:
+            if len(parts) >= 2:
+                timing_points.append((float(parts[0]), float(parts[1]), len(parts) < 7 or parts[6] == '1'))
+            if len(parts) >= 4 and parts[3] in OSU_SAMPLE_SETS:
+                sample_points[0].append(float(parts[0]))
+                sample_points[1].append(OSU_SAMPLE_SETS[parts[3]])
+        elif section == 'HitObjects':
+            parts = line.split(',')
+            if len(parts) >= 8 and int(parts[3]) & 2:
+                if timing is None:
+                    timing = slider_timing(timing_points)
+                obj = make_slider(parts, len(hitobjects)+1, slider_multiplier, timing)
+            elif len(parts) >= 3:
                 x, y, t = int(parts[0]), int(parts[1]), int(parts[2])
-                hitobjects.append(HitObject((x, y), t, len(hitobjects)+1))
+                obj = HitObject((x, y), t, len(hitobjects)+1)
+            else:
+                continue
+            apply_hitsound_fields(obj, parts, sample_points, default_sample_set)
+            hitobjects.append(obj)
     if not hitobjects:  # fallback for custom format
         for line in lines:
             if not line or line.startswith('#'):
@@ -187,6 +542,345 @@ def load_map(filepath):
                 hitobjects.append(HitObject((x, y), t, len(hitobjects)+1))
     return hitobjects, map_name
 
+def parse_osu_header(lines):
+    """Parses the [General], [Metadata] and [Difficulty] sections of a .osu file, plus the
+    BPM of its first uncontrolled timing point. Stops at [HitObjects] so the (much larger)
+    object list is never read."""
+    header = {}
+    section = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+            if section == 'HitObjects':
+                break
+            continue
+        if section in ('General', 'Metadata', 'Difficulty') and ':' in line:
+            key, value = line.split(':', 1)
+            header[key.strip()] = value.strip()
+        elif section == 'TimingPoints' and 'BPM' not in header:
+            parts = line.split(',')
+            try:
+                beat_length = float(parts[1])
+            except (IndexError, ValueError):
+                continue
+            if beat_length > 0:
+                header['BPM'] = round(60000.0 / beat_length, 2)
+    return header
+
+def summarize_hitobjects(rest):
+    """Counts the rows left after [HitObjects] and reads the last object's time, without
+    building any objects. Returns (object_count, length_ms)."""
+    rows = [row for row in rest.splitlines() if row.strip() and not row.startswith('//')]
+    if not rows:
+        return 0, 0
+    try:
+        return len(rows), int(float(rows[-1].split(',')[2]))
+    except (IndexError, ValueError):
+        return len(rows), 0
+
+def estimate_star_rating(object_count, length_ms, header):
+    """Very rough difficulty estimate from object density and the map's OD/AR/CS.
+    It is only meant to order the map list, not to match osu!'s star rating."""
+    if object_count == 0 or length_ms <= 0:
+        return 0.0
+    def difficulty_value(key):
+        try:
+            return float(header.get(key, 5))
+        except ValueError:
+            return 5.0
+    density = object_count / (length_ms / 1000.0)
+    stars = 0.9 * density ** 0.85 + 0.12 * (difficulty_value('OverallDifficulty') + difficulty_value('ApproachRate')) / 2 + 0.05 * difficulty_value('CircleSize')
+    return round(min(stars, 10.0), 2)
+
+def make_map_entry(filepath, header, difficulty=None, object_count=0, length_ms=0):
+    """Builds one map list entry from a parsed .osu header."""
+    base_name = os.path.splitext(os.path.basename(filepath))[0]
+    title = header.get('Title', base_name)
+    version = header.get('Version', '')
+    try:
+        preview_time = int(header.get('PreviewTime', -1))
+    except ValueError:
+        preview_time = -1
+    return {
+        'label': f"{title} [{version}]" if version else title,
+        'path': filepath,
+        'difficulty': difficulty, # .osu member inside an .osz, None for single-file maps
+        'title': title,
+        'artist': header.get('Artist', ''),
+        'creator': header.get('Creator', ''),
+        'version': version,
+        'audio_filename': header.get('AudioFilename'),
+        'preview_time': preview_time,
+        'bpm': header.get('BPM', 0.0),
+        'length': length_ms,
+        'objects': object_count,
+        'stars': estimate_star_rating(object_count, length_ms, header),
+    }
+
+def read_map_entries(filepath):
+    """Builds the map list entries for one file in maps/, one per difficulty in an .osz.
+    Only the .osu headers are read, [HitObjects] is parsed later when a difficulty is played."""
+    entries = []
+    try:
+        if filepath.endswith('.osz'):
+            try:
+                with zipfile.ZipFile(filepath, 'r') as z:
+                    for osu_file in sorted(f for f in z.namelist() if f.endswith('.osu')):
+                        with z.open(osu_file) as f:
+                            header = parse_osu_header(l.decode('utf-8', errors='ignore') for l in f)
+                            summary = summarize_hitobjects(f.read().decode('utf-8', errors='ignore'))
+                        entries.append(make_map_entry(filepath, header, osu_file, *summary))
+            except zipfile.BadZipFile:
+                pass # Custom text map with an .osz extension, nothing to read
+        elif filepath.endswith('.osu'):
+            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                header = parse_osu_header(f)
+                entries.append(make_map_entry(filepath, header, None, *summarize_hitobjects(f.read())))
+    except OSError as e:
+        print(f"Could not read map {filepath}: {e}")
+    return entries or [make_map_entry(filepath, {})]
+
+def snapshot_maps_dir(maps_dir):
+    """Returns {path: [inode, size, mtime_ns]} for every map file under maps_dir.
+    Only stats files, archives are never opened here."""
+    snapshot = {}
+    pending = [maps_dir]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        pending.append(dir_entry.path)
+                    elif dir_entry.name.endswith(MAP_EXTENSIONS):
+                        st = dir_entry.stat()
+                        snapshot[dir_entry.path] = [st.st_ino, st.st_size, st.st_mtime_ns]
+        except OSError as e:
+            print(f"Could not scan {directory}: {e}")
+    return snapshot
+
+def load_settings():
+    """Applies the saved settings over the defaults, if there are any."""
+    if not os.path.exists(SETTINGS_PATH):
+        return
+    try:
+        with open(SETTINGS_PATH, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        SETTINGS.update({key: stored[key] for key in PERSISTED_SETTINGS if key in stored})
+    except (OSError, ValueError) as e:
+        print(f"Could not read settings, using defaults: {e}")
+
+def save_settings():
+    try:
+        with open(SETTINGS_PATH, 'w', encoding='utf-8') as f:
+            json.dump({key: SETTINGS[key] for key in PERSISTED_SETTINGS}, f, indent=2)
+    except OSError as e:
+        print(f"Could not save settings: {e}")
+
+def load_library_index():
+    """Reads the persisted library index, if there is one."""
+    _MAP_LIBRARY['loaded'] = True
+    if not os.path.exists(LIBRARY_INDEX_PATH):
+        return
+    try:
+        with open(LIBRARY_INDEX_PATH, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # Offsets are set by the player and cannot be rebuilt, so they survive a format change
+        _MAP_LIBRARY['offsets'] = data.get('offsets', {})
+        if data.get('format') != LIBRARY_INDEX_FORMAT:
+            print("Library index is from an older version, rebuilding it.")
+            return
+        _MAP_LIBRARY['snapshot'] = data.get('snapshot', {})
+        _MAP_LIBRARY['entries'] = data.get('entries', {})
+        _MAP_LIBRARY['added'] = data.get('added', {})
+        _MAP_LIBRARY['transcode_format'] = data.get('transcode_format')
+    except (OSError, ValueError) as e:
+        print(f"Could not read library index, rebuilding it: {e}")
+        _MAP_LIBRARY['snapshot'], _MAP_LIBRARY['entries'], _MAP_LIBRARY['added'] = {}, {}, {}
+
+def save_library_index():
+    try:
+        with open(LIBRARY_INDEX_PATH, 'w', encoding='utf-8') as f:
+            json.dump({
+                'format': LIBRARY_INDEX_FORMAT,
+                'snapshot': _MAP_LIBRARY['snapshot'],
+                'entries': _MAP_LIBRARY['entries'],
+                'added': _MAP_LIBRARY['added'],
+                'offsets': _MAP_LIBRARY['offsets'],
+                'transcode_format': _MAP_LIBRARY['transcode_format'],
+            }, f)
+    except OSError as e:
+        print(f"Could not save library index: {e}")
+
+def scan_map_library(maps_dir=None):
+    """Diffs maps/ against the last snapshot and re-parses only added or changed files.
+    Returns True if the library changed since the previous scan."""
+    if not _MAP_LIBRARY['loaded']:
+        load_library_index()
+    maps_dir = maps_dir or MAPS_DIR
+    old_snapshot = _MAP_LIBRARY['snapshot']
+    new_snapshot = snapshot_maps_dir(maps_dir)
+    changed_paths = [p for p, sig in new_snapshot.items() if old_snapshot.get(p) != sig]
+    removed_paths = [p for p in old_snapshot if p not in new_snapshot]
+
+    for path in removed_paths:
+        _MAP_LIBRARY['entries'].pop(path, None)
+        _MAP_LIBRARY['added'].pop(path, None)
+        _MAP_LIBRARY['offsets'].pop(path, None)
+    for path in changed_paths:
+        _MAP_LIBRARY['entries'][path] = read_map_entries(path)
+        _MAP_LIBRARY['added'].setdefault(path, time.time())
+
+    _MAP_LIBRARY['snapshot'] = new_snapshot
+    _MAP_LIBRARY['last_scan'] = pygame.time.get_ticks()
+    format_changed = False
+    if pygame.mixer.get_init():
+        # Songs pygame cannot play are converted ahead of time. Every file is checked once per
+        # mixer format, since that is part of the cache key; after that only changed files are.
+        # The format is kept in the index, so a new session does not check everything again.
+        _TRANSCODER.poll()
+        queued_paths = changed_paths
+        if _MAP_LIBRARY['transcode_format'] != list(pygame.mixer.get_init()):
+            _MAP_LIBRARY['transcode_format'] = list(pygame.mixer.get_init())
+            queued_paths, format_changed = list(_MAP_LIBRARY['entries']), True
+        for path in queued_paths:
+            _TRANSCODER.queue_map(path)
+    changed = bool(changed_paths or removed_paths)
+    if changed:
+        _MAP_LIBRARY['version'] += 1
+    if changed or format_changed:
+        save_library_index()
+    return changed
+
+def map_offset(path, difficulty=None):
+    """Per-map audio offset in ms, 0 unless the player set one."""
+    return _MAP_LIBRARY['offsets'].get(path, {}).get(difficulty or '', 0)
+
+def set_map_offset(path, difficulty, offset):
+    """Stores a per-map offset in the library. It is written out with the next save_library_index()."""
+    offsets = _MAP_LIBRARY['offsets'].setdefault(path, {})
+    if offset:
+        offsets[difficulty or ''] = offset
+    else:
+        offsets.pop(difficulty or '', None)
+        if not offsets:
+            del _MAP_LIBRARY['offsets'][path]
+
+def library_entries():
+    """Returns every map entry in the library, ordered by file path."""
+    entries = _MAP_LIBRARY['entries']
+    return [entry for path in sorted(entries) for entry in entries[path]]
+
+# Sort keys offered by the map list, in the order Tab cycles through them
+MAP_SORT_KEYS = ('artist', 'title', 'length', 'bpm', 'stars', 'added')
+MAP_SORT_NAMES = {'artist': 'Artist', 'title': 'Title', 'length': 'Length', 'bpm': 'BPM', 'stars': 'Stars', 'added': 'Date Added'}
+
+def map_group_label(key, entry):
+    """Name of the group an entry falls into when the list is sorted by key."""
+    if key in ('artist', 'title'):
+        text = entry.get(key, '').strip()
+        return text[:1].upper() if text[:1].isalpha() else '#'
+    if key == 'length':
+        minutes = int(entry.get('length', 0) // 60000)
+        return f'{minutes}-{minutes + 1} min'
+    if key == 'bpm':
+        low = int(entry.get('bpm', 0) // 20 * 20)
+        return f'{low}-{low + 19} BPM'
+    if key == 'stars':
+        return f"{int(entry.get('stars', 0))}*"
+    added = _MAP_LIBRARY['added'].get(entry['path'], 0)
+    return datetime.date.fromtimestamp(added).isoformat()
+
+class MapSortCache:
+    """Sort permutations and group labels for the map list, computed once per key and only
+    thrown away when the library index changes. Switching the sort order is then just a
+    lookup of a precomputed permutation."""
+    def __init__(self):
+        self.library_version = None
+        self.entry_count = None
+        self.orders = {}
+
+    def get(self, key, entries):
+        """Returns {'order', 'groups'} for key: order lists entry ids in sorted order,
+        groups holds each entry's group label by id."""
+        if self.library_version != _MAP_LIBRARY['version'] or self.entry_count != len(entries):
+            self.orders = {}
+            self.library_version = _MAP_LIBRARY['version']
+            self.entry_count = len(entries)
+        if key not in self.orders:
+            if key in ('artist', 'title'):
+                order = np.array(sorted(range(len(entries)), key=lambda i: (entries[i].get(key, '').lower(), entries[i]['label'].lower())), dtype=np.int64)
+            else:
+                if key == 'added':
+                    values = [_MAP_LIBRARY['added'].get(entry['path'], 0) for entry in entries]
+                else:
+                    values = [entry.get(key, 0) for entry in entries]
+                order = np.argsort(np.array(values, dtype=float), kind='stable')
+            self.orders[key] = {'order': order, 'groups': [map_group_label(key, entry) for entry in entries]}
+        return self.orders[key]
+
+_MAP_SORT_CACHE = MapSortCache()
+
+class MapSearchIndex:
+    """Trigram index over the title, artist, creator and difficulty name of map entries.
+    Each query word is narrowed through the trigram posting lists and then confirmed as a
+    substring. Typing more characters only filters the previous results. When nothing
+    matches exactly, maps are ranked by how many of the query's trigrams they share."""
+    def __init__(self, entries):
+        self.texts = [' '.join((entry.get('title', ''), entry.get('artist', ''), entry.get('creator', ''), entry.get('version', ''))).lower()
+                      for entry in entries]
+        postings = {}
+        for doc_id, text in enumerate(self.texts):
+            for gram in {text[i:i+3] for i in range(len(text) - 2)}:
+                postings.setdefault(gram, []).append(doc_id)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+        self.all_ids = np.arange(len(self.texts), dtype=np.int32)
+        self.last_query = ''
+        self.last_results = self.all_ids
+        self.last_exact = True
+
+    def _match_word(self, word, candidates):
+        if len(word) >= 3:
+            grams = {word[i:i+3] for i in range(len(word) - 2)}
+            if any(gram not in self.postings for gram in grams):
+                return candidates[:0]
+            # Intersect the shortest posting lists first
+            for gram in sorted(grams, key=lambda g: len(self.postings[g])):
+                candidates = np.intersect1d(candidates, self.postings[gram], assume_unique=True)
+                if not len(candidates):
+                    return candidates
+        texts = self.texts
+        return np.array([i for i in candidates.tolist() if word in texts[i]], dtype=np.int32)
+
+    def _fuzzy(self, query):
+        grams = {query[i:i+3] for i in range(len(query) - 2)}
+        lists = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not lists:
+            return self.all_ids[:0]
+        counts = np.bincount(np.concatenate(lists), minlength=len(self.texts))
+        ids = np.nonzero(counts >= max(1, int(len(grams) * SEARCH_FUZZY_RATIO)))[0]
+        return ids[np.argsort(-counts[ids], kind='stable')].astype(np.int32)
+
+    def search(self, query):
+        """Returns the ids of the entries matching query, in library order for exact matches."""
+        query = ' '.join(query.lower().split())
+        if query == self.last_query:
+            return self.last_results
+        if self.last_exact and self.last_query and query.startswith(self.last_query):
+            results = self.last_results # A longer query can only narrow an exact match
+        else:
+            results = self.all_ids
+        for word in query.split():
+            results = self._match_word(word, results)
+        exact = True
+        if not len(results) and len(query) >= 3:
+            results, exact = self._fuzzy(query), False
+        self.last_query, self.last_results, self.last_exact = query, results, exact
+        return results
+
 def draw_gradient_rect(surface, rect, color1, color2, vertical=True):
     x, y, w, h = rect
     for i in range(h if vertical else w):
@@ -222,8 +916,9 @@ def draw_rounded_gradient(surface, rect, color1, color2, radius=24, vertical=Tru
     temp.blit(mask, (0,0), special_flags=pygame.BLEND_RGBA_MULT)
     surface.blit(temp, (x, y))
 
-def generate_hitsound(frequency=1000, duration=0.1, sample_rate=44100):
-    """Generates a simple percussive hitsound as a pygame.Sound object."""
+def generate_hitsound(frequency=1000, duration=0.1):
+    """Generates a simple percussive hitsound as a pygame.Sound object, in the mixer's format."""
+    sample_rate, _, channels = pygame.mixer.get_init()
     num_samples = int(duration * sample_rate)
     t = np.linspace(0., duration, num_samples, endpoint=False)
     
@@ -236,13 +931,251 @@ def generate_hitsound(frequency=1000, duration=0.1, sample_rate=44100):
     data *= decay
     
     # Ensure the data is in 16-bit format for pygame
-    # The sound needs to be stereo (2 channels) for sndarray
-    sound_array = np.column_stack((data, data)).astype(np.int16)
+    # sndarray wants one column per mixer channel, or a flat array for mono
+    sound_array = (np.column_stack((data,) * channels) if channels > 1 else data).astype(np.int16)
     
     # Create the pygame sound object from the numpy array
     sound = pygame.sndarray.make_sound(sound_array)
     return sound
 
+# Hitsound bank: osu! sample sets and the hitsounds each one provides
+HITSOUND_SAMPLE_SETS = ('normal', 'soft', 'drum')
+HITSOUND_NAMES = ('hitnormal', 'hitwhistle', 'hitfinish', 'hitclap')
+HITSOUND_FLAGS = {'hitwhistle': 2, 'hitfinish': 4, 'hitclap': 8} # hitSound bits in .osu [HitObjects]
+HITSOUND_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'hitsounds.npz')
+HITSOUND_DURATION = 0.4 # s, length of the longest sample
+# Synthesis parameters per (sample set, hitsound):
+# (tone Hz, tone decay, pitch drop, noise level, noise decay, gain)
+HITSOUND_PARAMS = {
+    ('normal', 'hitnormal'):  (1000, 30, 0.0, 0.05, 60, 0.50),
+    ('normal', 'hitwhistle'): (2000, 9, 0.0, 0.00, 1, 0.30),
+    ('normal', 'hitfinish'):  (3200, 7, 0.0, 0.60, 6, 0.40),
+    ('normal', 'hitclap'):    (1500, 80, 0.0, 0.90, 35, 0.45),
+    ('soft', 'hitnormal'):    (600, 25, 0.0, 0.02, 60, 0.40),
+    ('soft', 'hitwhistle'):   (1600, 7, 0.0, 0.00, 1, 0.22),
+    ('soft', 'hitfinish'):    (2400, 6, 0.0, 0.35, 7, 0.30),
+    ('soft', 'hitclap'):      (1200, 90, 0.0, 0.60, 45, 0.30),
+    ('drum', 'hitnormal'):    (180, 18, 1.5, 0.25, 70, 0.60),
+    ('drum', 'hitwhistle'):   (900, 14, 0.5, 0.10, 30, 0.35),
+    ('drum', 'hitfinish'):    (120, 8, 2.0, 0.70, 10, 0.55),
+    ('drum', 'hitclap'):      (2500, 120, 0.0, 1.00, 30, 0.50),
+}
+
+def synthesize_hitsound_bank(sample_rate):
+    """Renders every sample of the bank in one vectorized pass. Returns int16 PCM shaped
+    (sample sets, hitsounds, samples); the noise is seeded so the output is reproducible."""
+    params = np.array([[HITSOUND_PARAMS[(s, n)] for n in HITSOUND_NAMES] for s in HITSOUND_SAMPLE_SETS], dtype=float)
+    tone_hz, tone_decay, drop, noise_level, noise_decay, gain = (params[..., i, None] for i in range(6))
+    t = np.arange(int(HITSOUND_DURATION * sample_rate)) / sample_rate
+    # Drum tones start higher and fall back to their base pitch; the phase is the integral of that sweep
+    sweep = 40.0
+    phase = 2 * np.pi * tone_hz * (t + drop * (1 - np.exp(-sweep * t)) / sweep)
+    tone = np.sin(phase) * np.exp(-tone_decay * t)
+    noise = np.random.default_rng(0).uniform(-1.0, 1.0, t.shape) * noise_level * np.exp(-noise_decay * t)
+    wave = tone + noise
+    wave /= np.abs(wave).max(axis=-1, keepdims=True)
+    # Short fade in and out so no sample starts or stops with a click
+    fade = np.minimum(1.0, np.minimum(t, HITSOUND_DURATION - t) * 1000.0)
+    return (wave * fade * gain * np.iinfo(np.int16).max).astype(np.int16)
+
+def hitsound_cache_key(sample_rate):
+    return repr((sample_rate, HITSOUND_DURATION, sorted(HITSOUND_PARAMS.items())))
+
+def load_hitsound_pcm(sample_rate):
+    """Returns the bank's PCM from the disk cache, synthesizing and caching it on a miss."""
+    key = hitsound_cache_key(sample_rate)
+    try:
+        with np.load(HITSOUND_CACHE_PATH) as cached:
+            if str(cached['key']) == key:
+                return cached['pcm']
+    except (OSError, ValueError, KeyError):
+        pass
+    pcm = synthesize_hitsound_bank(sample_rate)
+    try:
+        np.savez(HITSOUND_CACHE_PATH, key=np.array(key), pcm=pcm)
+    except OSError as e:
+        print(f"Warning: Could not cache hitsounds: {e}")
+    return pcm
+
+# Hitsound voices: mixer channels reserved for hitsounds, so previews and other sounds never
+# take them and hitsounds never wait for a free channel
+HITSOUND_VOICES = 16
+HITSOUND_STEAL_GUARD = 15 # ms; a voice younger than this is not cut off, the new play is dropped instead
+
+class HitsoundBank:
+    """Every sample set with its hitnormal/whistle/finish/clap samples as ready pygame Sounds.
+    A hit plays hitnormal from the object's sample set plus each addition its hitSound
+    flags ask for, taken from the addition set. Plays go to a reserved pool of channels;
+    when all of them are busy the oldest voice is stolen."""
+    def __init__(self):
+        self.stats = {'played': 0, 'stolen': 0, 'dropped': 0}
+        self.reload()
+
+    def reload(self):
+        """Builds the Sounds for the mixer's current format."""
+        frequency, _, channels = pygame.mixer.get_init()
+        pcm = load_hitsound_pcm(frequency)
+        self.sounds = {}
+        for i, sample_set in enumerate(HITSOUND_SAMPLE_SETS):
+            for j, name in enumerate(HITSOUND_NAMES):
+                samples = pcm[i, j]
+                if channels > 1:
+                    samples = np.repeat(samples[:, None], channels, axis=1)
+                self.sounds[(sample_set, name)] = pygame.sndarray.make_sound(np.ascontiguousarray(samples))
+        self.volume = None
+        # A restarted mixer is back to its default channels, so the pool is set up again here
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), HITSOUND_VOICES + 8))
+        pygame.mixer.set_reserved(HITSOUND_VOICES)
+        self.voices = [pygame.mixer.Channel(i) for i in range(HITSOUND_VOICES)]
+        self.started = [0] * HITSOUND_VOICES # Ticks each voice last started playing
+
+    def apply_volume(self):
+        """Sets the SFX volume on the samples, only when it changed since the last hit."""
+        volume = SETTINGS['sfx_volume']
+        if volume != self.volume:
+            for sound in self.sounds.values():
+                sound.set_volume(volume)
+            self.volume = volume
+
+    def voice(self, now):
+        """Index of a free voice, or of the oldest one to steal. None drops the play."""
+        for i, channel in enumerate(self.voices):
+            if not channel.get_busy():
+                return i
+        oldest = min(range(HITSOUND_VOICES), key=self.started.__getitem__)
+        if now - self.started[oldest] < HITSOUND_STEAL_GUARD:
+            return None
+        self.stats['stolen'] += 1
+        return oldest
+
+    def play(self, hitsound=0, sample_set='normal', addition_set=None):
+        self.apply_volume()
+        now = pygame.time.get_ticks()
+        names = ['hitnormal'] + [name for name, flag in HITSOUND_FLAGS.items() if hitsound & flag]
+        for name in names:
+            sound = self.sounds[(sample_set if name == 'hitnormal' else addition_set or sample_set, name)]
+            i = self.voice(now)
+            if i is None:
+                self.stats['dropped'] += 1
+                continue
+            self.voices[i].play(sound) # Playing on a busy channel cuts off what it was playing
+            self.started[i] = now
+            self.stats['played'] += 1
+
+    def play_object(self, obj):
+        self.play(obj.hitsound, obj.sample_set, obj.addition_set)
+
+# Mixer configuration, applied through pygame.mixer.pre_init and saved with the settings
+AUDIO_FREQUENCIES = (22050, 44100, 48000)
+AUDIO_BUFFER_SIZES = (128, 256, 512, 1024, 2048, 4096) # Samples per audio callback; smaller means less latency
+AUDIO_CHANNEL_COUNTS = (1, 2)
+LATENCY_PROBE_TRIALS = 8
+LATENCY_PROBE_EVENT = pygame.USEREVENT + 1
+_MIXER_STATE = {'settings': None} # pre_init arguments the running mixer was started with
+
+def mixer_settings():
+    return (SETTINGS['audio_frequency'], -16, SETTINGS['audio_channels'], SETTINGS['audio_buffer'])
+
+def restart_mixer(settings=None):
+    """Reinitializes the mixer, with the saved audio settings unless others are given.
+    Sounds made for the previous format have to be rebuilt afterwards. Returns False if the
+    device refused the settings; the mixer then runs with the previous ones again, or stays
+    off if those fail as well."""
+    settings = settings or mixer_settings()
+    # Waits for a preview decode in progress and keeps new ones out until the mixer is back
+    with _AUDIO_PREVIEW.decode_lock:
+        _AUDIO_PREVIEW.clear()
+        previous = _MIXER_STATE['settings']
+        pygame.mixer.quit()
+        for attempt in (settings, previous):
+            if attempt is None:
+                continue
+            try:
+                pygame.mixer.pre_init(*attempt)
+                pygame.mixer.init()
+            except pygame.error as e:
+                print(f"Warning: Could not start the mixer with {attempt}: {e}")
+                continue
+            _MIXER_STATE['settings'] = attempt
+            return attempt == settings
+        _MIXER_STATE['settings'] = None
+        return False
+
+def probe_buffer_latency(buffer_size, trials=LATENCY_PROBE_TRIALS):
+    """Measures, for one buffer size, the delay in ms from Sound.play() until SDL_mixer has
+    finished the sound inside its audio callback, minus the sound's own length. pygame has no
+    hook into the callback itself, but channel end events are posted from inside it. Trials
+    whose end event never arrives come back as None."""
+    frequency, size, channels = SETTINGS['audio_frequency'], -16, SETTINGS['audio_channels']
+    if not restart_mixer((frequency, size, channels, buffer_size)):
+        return [None] * trials # The device does not take this buffer size
+    frequency, _, channels = pygame.mixer.get_init()
+    length_ms = 10
+    silence = np.zeros((frequency * length_ms // 1000, channels) if channels > 1 else frequency * length_ms // 1000, dtype=np.int16)
+    probe = pygame.sndarray.make_sound(silence)
+    channel = pygame.mixer.Channel(0)
+    channel.set_endevent(LATENCY_PROBE_EVENT)
+    delays = []
+    for _ in range(trials):
+        pygame.event.clear(LATENCY_PROBE_EVENT)
+        start = time.perf_counter()
+        channel.play(probe)
+        delay = None
+        while time.perf_counter() - start < 1.0:
+            if pygame.event.get(LATENCY_PROBE_EVENT):
+                delay = (time.perf_counter() - start) * 1000 - length_ms
+                break
+            time.sleep(0.0005)
+        delays.append(delay)
+    channel.set_endevent()
+    return delays
+
+def run_latency_probe(buffer_sizes=AUDIO_BUFFER_SIZES):
+    """Probes every buffer size and returns ({buffer size: (median ms, worst ms, stable)},
+    recommended buffer size). A size counts as stable when no end event went missing and
+    none arrived later than three callback periods, which is where underruns show up. The
+    recommendation is the smallest stable size. The saved mixer settings are restored afterwards."""
+    results = {}
+    try:
+        for buffer_size in buffer_sizes:
+            delays = probe_buffer_latency(buffer_size)
+            period_ms = buffer_size * 1000.0 / SETTINGS['audio_frequency']
+            measured = [d for d in delays if d is not None]
+            if not measured:
+                results[buffer_size] = (None, None, False)
+                continue
+            worst = max(measured)
+            stable = len(measured) == len(delays) and worst <= 3 * period_ms + 5
+            results[buffer_size] = (float(np.median(measured)), worst, stable)
+    finally:
+        restart_mixer()
+    stable_sizes = [size for size, (_, _, stable) in results.items() if stable]
+    return results, min(stable_sizes) if stable_sizes else max(buffer_sizes)
+
+# Offset calibration: a metronome the player taps along to
+CALIBRATION_BPM = 120
+CALIBRATION_COUNT_IN = 4 # Beats played before taps are counted
+CALIBRATION_BEATS = 16   # Beats whose taps are measured
+CALIBRATION_MIN_TAPS = 6
+CALIBRATION_FPS = 500    # The loop only redraws on changes, this is just the timing resolution
+MAX_AUDIO_OFFSET = 300   # ms, in either direction
+
+def measure_tap_offset(tap_times, beat_times):
+    """Matches every tap to the nearest metronome click and returns (median offset, spread)
+    in ms, or None with too few taps. Positive means the taps land after the clicks were
+    played, i.e. the sound reaches the player late. The spread is the median absolute
+    deviation, so a few stray taps move neither number."""
+    taps = np.asarray(tap_times, dtype=float)
+    beats = np.asarray(beat_times, dtype=float)
+    if len(beats) == 0 or len(taps) < CALIBRATION_MIN_TAPS:
+        return None
+    after = np.clip(np.searchsorted(beats, taps), 1, len(beats) - 1) if len(beats) > 1 else np.zeros(len(taps), dtype=int)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where(np.abs(taps - beats[before]) <= np.abs(taps - beats[after]), beats[before], beats[after])
+    deltas = taps - nearest
+    offset = float(np.median(deltas))
+    return offset, float(np.median(np.abs(deltas - offset)))
+
 def draw_health_bar_fill(surface, rect, health_percent, radius=16):
     # Interpolate color from green (1.0) to yellow (0.5) to red (0.0)
     if health_percent > 0.5:
@@ -263,40 +1196,111 @@ def draw_health_bar_fill(surface, rect, health_percent, radius=16):
     color2_pulse = tuple(min(255, int(c*pulse)) for c in color2)
     draw_rounded_gradient(surface, rect, color1_pulse, color2_pulse, radius=radius)
 
+# (month, day) -> (greeting, color, icon type)
+HOLIDAYS = {
+    (7, 1): ("Happy Canada Day!", OSU_RED, "canada_flag"), # Canada Day
+    (10, 31): ("Happy Halloween!", (255, 165, 0), "halloween_pumpkin"), # Halloween, orange
+    (12, 25): ("Merry Christmas!", OSU_GREEN, "christmas_tree"), # Christmas
+    (1, 1): ("Happy New Year!", OSU_YELLOW, "new_year_firework"), # New Year's Day
+}
+_HOLIDAY = {'recheck_at': 0, 'holiday': None, 'greeting': None, 'flag_strip': None, 'firework_sprite': None}
+
+# Canada flag wave, pre-rendered as a strip of frames covering one wave period
+FLAG_SIZE = (80, 40)
+FLAG_WAVE_AMPLITUDE = 2.0
+FLAG_WAVE_FREQUENCY = 0.1
+FLAG_WAVE_SPEED = 250.0
+FLAG_WAVE_PERIOD = 2 * math.pi * FLAG_WAVE_SPEED # ms
+FLAG_FRAMES = round(FLAG_WAVE_PERIOD * MENU_ANIMATION_FPS / 1000)
+
+def current_holiday():
+    """Returns today's (greeting, color, icon type) or None. The date is only looked up again at midnight."""
+    now = pygame.time.get_ticks()
+    if now >= _HOLIDAY['recheck_at']:
+        today = datetime.date.today()
+        _HOLIDAY['holiday'] = HOLIDAYS.get((today.month, today.day))
+        _HOLIDAY['greeting'] = None
+        midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time())
+        _HOLIDAY['recheck_at'] = now + int((midnight - datetime.datetime.now()).total_seconds() * 1000) + 1
+    return _HOLIDAY['holiday']
+
+def build_flag_strip():
+    flag_width, flag_height = FLAG_SIZE
+    margin = int(math.ceil(FLAG_WAVE_AMPLITUDE))
+    frame_height = flag_height + 2 * margin + 1
+    strip = pygame.Surface((flag_width * FLAG_FRAMES, frame_height), pygame.SRCALPHA)
+
+    # Simplified maple leaf polygon (normalized coordinates)
+    maple_leaf_poly = [
+        (0.0, -0.9), (-0.07, -0.5), (-0.35, -0.45), (-0.25, -0.2),
+        (-0.5, -0.15), (-0.3, 0.05), (-0.35, 0.35), (-0.1, 0.2),
+        (0.0, 0.6), (0.1, 0.2), (0.35, 0.35), (0.3, 0.05),
+        (0.5, -0.15), (0.25, -0.2), (0.35, -0.45), (0.07, -0.5)
+    ]
+    leaf_scale = flag_height * 0.55 # Scale leaf to be 55% of flag height
+
+    for frame in range(FLAG_FRAMES):
+        phase = frame * FLAG_WAVE_PERIOD / FLAG_FRAMES / FLAG_WAVE_SPEED
+        left = frame * flag_width
+        # Draw flag with wave by drawing vertical lines
+        for x_offset in range(flag_width):
+            y_offset = margin + math.sin(phase + x_offset * FLAG_WAVE_FREQUENCY) * FLAG_WAVE_AMPLITUDE
+            # Determine color based on x position (1:2:1 ratio)
+            if x_offset < flag_width // 4 or x_offset >= flag_width * 3 // 4:
+                flag_color = OSU_RED
+            else:
+                flag_color = OSU_WHITE
+            pygame.draw.line(strip, flag_color, (left + x_offset, y_offset), (left + x_offset, flag_height + y_offset))
+        # The leaf waves with the flag's center
+        leaf_wave_offset = math.sin(phase + (flag_width // 2) * FLAG_WAVE_FREQUENCY) * FLAG_WAVE_AMPLITUDE
+        leaf_points = [(left + flag_width // 2 + p[0] * leaf_scale, margin + flag_height // 2 + p[1] * leaf_scale + leaf_wave_offset) for p in maple_leaf_poly]
+        pygame.draw.polygon(strip, OSU_RED, leaf_points)
+        pygame.gfxdraw.aapolygon(strip, leaf_points, OSU_RED)
+    return strip
+
+def firework_sprite():
+    if _HOLIDAY['firework_sprite'] is None:
+        sprite = pygame.Surface((4, 4), pygame.SRCALPHA)
+        pygame.draw.circle(sprite, OSU_YELLOW, (2, 2), 2)
+        _HOLIDAY['firework_sprite'] = sprite
+    return _HOLIDAY['firework_sprite']
+
+class FireworkBurst:
+    """A firework burst kept as NumPy arrays. Particle positions are a function of the elapsed
+    time, so the burst looks the same at any frame rate, and every particle is one blit of a
+    shared sprite whose alpha is set once per frame."""
+    def __init__(self, center, count=30, duration=1200):
+        angles = np.random.uniform(0, 2 * math.pi, count)
+        speeds = np.random.uniform(0.5, 2.0, count) * FPS / 1000.0 # Pixels per frame at FPS -> pixels per ms
+        self.velocity = np.column_stack((np.cos(angles), np.sin(angles))) * speeds[:, None]
+        self.origin = np.array(center, dtype=float) - 2 # Offset to the sprite's top left
+        self.start_time = pygame.time.get_ticks()
+        self.duration = duration
+
+    def draw(self, screen, now):
+        """Draws the burst and returns False once it has burnt out."""
+        elapsed = now - self.start_time
+        if elapsed >= self.duration:
+            return False
+        positions = (self.origin + self.velocity * elapsed).astype(int)
+        sprite = firework_sprite()
+        sprite.set_alpha(int(255 * (1 - elapsed / self.duration))) # Fade out
+        screen.blits([(sprite, pos) for pos in map(tuple, positions.tolist())], doreturn=False)
+        return True
+
 def draw_holiday_elements(screen, font_medium):
     """Checks for holidays and draws a greeting and icon if applicable."""
     global _ANIMATION_STATE # Declare intent to modify the global dictionary
 
-    today = datetime.date.today()
-    month = today.month
-    day = today.day
-    current_width, current_height = screen.get_size()
+    holiday = current_holiday()
+    current_width, current_height = LAYOUT.size
     current_time_ms = pygame.time.get_ticks()
-
-    greeting = None
-    color = None
-    icon_type = None
-
-    # --- Define Holidays ---
-    # Canada Day
-    if month == 7 and day == 1:
-        greeting, color, icon_type = "Happy Canada Day!", OSU_RED, "canada_flag"
-    # Halloween
-    elif month == 10 and day == 31:
-        greeting, color, icon_type = "Happy Halloween!", (255, 165, 0), "halloween_pumpkin" # Orange
-    # Christmas
-    elif month == 12 and day == 25:
-        greeting, color, icon_type = "Merry Christmas!", OSU_GREEN, "christmas_tree"
-    # New Year's Day
-    elif month == 1 and day == 1:
-        greeting, color, icon_type = "Happy New Year!", OSU_YELLOW, "new_year_firework"
+    greeting, color, icon_type = holiday if holiday else (None, None, None)
 
     # Manage animation state transitions
     if icon_type != _ANIMATION_STATE['current_holiday_type']:
         # Reset all animation states if holiday changes or no holiday is active
-        _ANIMATION_STATE['firework_particles'] = []
-        _ANIMATION_STATE['firework_active'] = False
-        _ANIMATION_STATE['firework_start_time'] = 0
+        _ANIMATION_STATE['firework'] = None
         _ANIMATION_STATE['pumpkin_glow_phase'] = 0.0
         _ANIMATION_STATE['christmas_lights'] = []
         _ANIMATION_STATE['current_holiday_type'] = icon_type # Update current active holiday
@@ -309,55 +1313,23 @@ def draw_holiday_elements(screen, font_medium):
         icon_base_y = 70 # Base Y for the top of the icon area
 
         # Draw Text
-        holiday_text = font_medium.render(greeting, True, color)
+        if _HOLIDAY['greeting'] is None:
+            _HOLIDAY['greeting'] = font_medium.render(greeting, True, color)
+        holiday_text = _HOLIDAY['greeting']
         holiday_rect = holiday_text.get_rect(center=(current_width // 2, greeting_y))
         screen.blit(holiday_text, holiday_rect)
 
         # Draw Icon
         if icon_type == "canada_flag":
-            flag_height = 40
-            flag_width = 80
-            flag_x_start = current_width // 2 - flag_width // 2
-            
-            # Wave animation parameters
-            wave_amplitude = 2.0
-            wave_frequency = 0.1
-            wave_speed = 250.0
-
-            # Simplified maple leaf polygon (normalized coordinates)
-            maple_leaf_poly = [
-                (0.0, -0.9), (-0.07, -0.5), (-0.35, -0.45), (-0.25, -0.2),
-                (-0.5, -0.15), (-0.3, 0.05), (-0.35, 0.35), (-0.1, 0.2),
-                (0.0, 0.6), (0.1, 0.2), (0.35, 0.35), (0.3, 0.05),
-                (0.5, -0.15), (0.25, -0.2), (0.35, -0.45), (0.07, -0.5)
-            ]
-            leaf_scale = flag_height * 0.55 # Scale leaf to be 55% of flag height
-
-            # Draw flag with wave by drawing vertical lines
-            for x_offset in range(flag_width):
-                y_offset = math.sin(current_time_ms / wave_speed + x_offset * wave_frequency) * wave_amplitude
-                
-                col_x = flag_x_start + x_offset
-                # Determine color based on x position (1:2:1 ratio)
-                if x_offset < flag_width // 4 or x_offset >= flag_width * 3 // 4:
-                    flag_color = OSU_RED
-                else:
-                    flag_color = OSU_WHITE
-                
-                pygame.draw.line(screen, flag_color, (col_x, icon_base_y + y_offset), (col_x, icon_base_y + flag_height + y_offset))
+            if _HOLIDAY['flag_strip'] is None:
+                _HOLIDAY['flag_strip'] = build_flag_strip()
+            flag_width = FLAG_SIZE[0]
+            frame = int(current_time_ms % FLAG_WAVE_PERIOD / FLAG_WAVE_PERIOD * FLAG_FRAMES) % FLAG_FRAMES
+            frame_area = pygame.Rect(frame * flag_width, 0, flag_width, _HOLIDAY['flag_strip'].get_height())
+            margin = int(math.ceil(FLAG_WAVE_AMPLITUDE))
+            screen.blit(_HOLIDAY['flag_strip'], (current_width // 2 - flag_width // 2, icon_base_y - margin), frame_area)
+            request_frame(1000 // MENU_ANIMATION_FPS)
 
-            # Draw maple leaf on top of the waving flag
-            leaf_center_x = current_width // 2
-            leaf_center_y = icon_base_y + flag_height // 2
-            
-            # The leaf should also wave with the flag's center
-            leaf_wave_offset = math.sin(current_time_ms / wave_speed + (flag_width // 2) * wave_frequency) * wave_amplitude
-            
-            final_leaf_points = [(leaf_center_x + p[0] * leaf_scale, leaf_center_y + p[1] * leaf_scale + leaf_wave_offset) for p in maple_leaf_poly]
-            
-            pygame.draw.polygon(screen, OSU_RED, final_leaf_points)
-            pygame.gfxdraw.aapolygon(screen, final_leaf_points, OSU_RED)
-        
         elif icon_type == "halloween_pumpkin":
             icon_x = current_width // 2
             icon_y = icon_base_y + 20 # Center of pumpkin
@@ -379,6 +1351,7 @@ def draw_holiday_elements(screen, font_medium):
             pygame.draw.polygon(screen, eye_color, [(icon_x - 10, icon_y - 5), (icon_x - 5, icon_y - 15), (icon_x, icon_y - 5)])
             pygame.draw.polygon(screen, eye_color, [(icon_x + 10, icon_y - 5), (icon_x + 5, icon_y - 15), (icon_x, icon_y - 5)])
             pygame.draw.polygon(screen, eye_color, [(icon_x - 10, icon_y + 10), (icon_x - 5, icon_y + 15), (icon_x, icon_y + 10), (icon_x + 5, icon_y + 15), (icon_x + 10, icon_y + 10)])
+            request_frame(1000 // MENU_ANIMATION_FPS)
 
         elif icon_type == "christmas_tree":
             icon_x = current_width // 2
@@ -400,329 +1373,662 @@ def draw_holiday_elements(screen, font_medium):
                 blink_phase = (current_time_ms / 300.0 + blink_offset) % (2 * math.pi)
                 if math.sin(blink_phase) > 0: # Simple on/off blinking
                     pygame.draw.circle(screen, OSU_YELLOW, pos, 3)
+                # Lights only change when their phase crosses a multiple of pi, so sleep until the next one does
+                next_flip = (math.floor(blink_phase / math.pi) + 1) * math.pi - blink_phase
+                request_frame(next_flip * 300.0 + 1)
 
         elif icon_type == "new_year_firework":
-            icon_x = current_width // 2
-            icon_y = icon_base_y + 20 # Center of explosion
-
-            # Trigger firework animation once
-            if not _ANIMATION_STATE['firework_active']:
-                _ANIMATION_STATE['firework_active'] = True
-                _ANIMATION_STATE['firework_start_time'] = current_time_ms
-                _ANIMATION_STATE['firework_particles'] = []
-                for _ in range(30): # 30 particles
-                    angle = random.uniform(0, 2 * math.pi)
-                    speed = random.uniform(0.5, 2.0)
-                    # Store [x, y, angle, speed, start_alpha]
-                    _ANIMATION_STATE['firework_particles'].append([icon_x, icon_y, angle, speed, 255])
-            
-            # Update and draw firework particles
-            animation_duration = 1200
-            elapsed = current_time_ms - _ANIMATION_STATE['firework_start_time']
-
-            if elapsed < animation_duration:
-                for p in _ANIMATION_STATE['firework_particles']:
-                    p[0] += p[3] * math.cos(p[2]) # Update x
-                    p[1] += p[3] * math.sin(p[2]) # Update y
-                    p[4] = max(0, int(255 * (1 - elapsed / animation_duration))) # Fade out
-
-                    # Create a temporary surface for the particle to handle alpha
-                    particle_surf = pygame.Surface((4, 4), pygame.SRCALPHA)
-                    pygame.draw.circle(particle_surf, OSU_YELLOW + (p[4],), (2, 2), 2)
-                    screen.blit(particle_surf, (int(p[0]) - 2, int(p[1]) - 2))
-            else:
-                # Reset for next time
-                _ANIMATION_STATE['firework_active'] = False
+            # Launch a new burst whenever the previous one has burnt out
+            burst = _ANIMATION_STATE['firework']
+            if burst is None or not burst.draw(screen, current_time_ms):
+                _ANIMATION_STATE['firework'] = FireworkBurst((current_width // 2, icon_base_y + 20)) # Center of explosion
+                _ANIMATION_STATE['firework'].draw(screen, current_time_ms)
+            request_frame(1000 // MENU_ANIMATION_FPS)
+
+class Layout:
+    """Size of the window everything is laid out for. It only changes when a resize has been
+    applied, and `version` is bumped then; size-bound caches compare the version instead of
+    probing the window size every frame."""
+    def __init__(self):
+        self.size = None
+        self.width = self.height = 0
+        self.version = 0
+
+    def update(self, size):
+        if size != self.size:
+            self.size = size
+            self.width, self.height = size
+            self.version += 1
+
+LAYOUT = Layout()
+
+def set_display_mode(size):
+    """(Re)creates the window and recomputes the layout for its size."""
+    SETTINGS['current_width'], SETTINGS['current_height'] = size
+    screen = pygame.display.set_mode(size, pygame.RESIZABLE)
+    LAYOUT.update(screen.get_size())
+    return screen
+
+def queue_resize(event):
+    _RESIZE['size'] = (event.w, event.h)
+    _RESIZE['at'] = pygame.time.get_ticks()
+
+def apply_pending_resize(screen):
+    """Resets the display once a resize has settled and returns the surface to draw on."""
+    if _RESIZE['size'] is None:
+        return screen
+    remaining = _RESIZE['at'] + RESIZE_SETTLE_TIME - pygame.time.get_ticks()
+    if remaining > 0:
+        request_frame(remaining) # Idle menus have to wake up to apply it
+        return screen
+    size, _RESIZE['size'] = _RESIZE['size'], None
+    return set_display_mode(size)
+
+def request_frame(delay_ms=0):
+    """Asks for the next menu frame within delay_ms. Animations call this while they draw."""
+    due = pygame.time.get_ticks() + max(0, int(delay_ms))
+    if _FRAME_REQUEST['due'] is None or due < _FRAME_REQUEST['due']:
+        _FRAME_REQUEST['due'] = due
+
+def wait_for_menu_events():
+    """Blocks until input arrives or the next requested frame is due and returns the pending events.
+    Returns an empty list when woken up by a frame request or the idle timeout."""
+    due, _FRAME_REQUEST['due'] = _FRAME_REQUEST['due'], None
+    timeout = MENU_IDLE_TIMEOUT if due is None else min(MENU_IDLE_TIMEOUT, due - pygame.time.get_ticks())
+    events = []
+    if timeout > 0:
+        event = pygame.event.wait(timeout)
+        if event.type != pygame.NOEVENT:
+            events.append(event)
+    return events + pygame.event.get()
+
+_MENU_BACKGROUND = {'layout': None, 'surface': None}
+
+def draw_menu_background(screen):
+    """Blits the shared menu gradient, only re-rendering it when the layout changes."""
+    if _MENU_BACKGROUND['layout'] != LAYOUT.version:
+        background = pygame.Surface(LAYOUT.size)
+        draw_gradient_rect(background, (0, 0, LAYOUT.width, LAYOUT.height), OSU_DARK_GREY, (10, 10, 40), vertical=True)
+        _MENU_BACKGROUND['layout'], _MENU_BACKGROUND['surface'] = LAYOUT.version, background
+    screen.blit(_MENU_BACKGROUND['surface'], (0, 0))
+
+def draw_menu_cursor(screen):
+    if SETTINGS['custom_cursor']:
+        mx, my = pygame.mouse.get_pos()
+        for r in range(20, 8, -2): # Outer glow
+            pygame.draw.circle(screen, OSU_BLUE + (30,), (mx, my), r, 2)
+        pygame.draw.circle(screen, OSU_WHITE, (mx, my), 16, 2) # Inner circle
+
+def render_button(font, text, color, btn_c1, btn_c2):
+    """Renders a rounded menu button onto its own surface, with a 4px margin for the shadow."""
+    text_surface = font.render(text, True, color)
+    width, height = text_surface.get_width() + 40, text_surface.get_height() + 10
+    surface = pygame.Surface((width + 8, height + 8), pygame.SRCALPHA)
+    draw_rounded_gradient(surface, (4, 4, width, height), btn_c1, btn_c2, radius=12, vertical=False)
+    pygame.draw.rect(surface, (255,255,255,180), (4, 4, width, height), 2, border_radius=12)
+    surface.blit(text_surface, text_surface.get_rect(center=(4 + width // 2, 4 + height // 2)))
+    return surface
+
+class Widget:
+    """Base class for retained-mode menu widgets. A widget keeps its rendered surface and its
+    hit box and only re-renders when its state or position changes."""
+    focusable = True
+
+    def __init__(self, font, anchor='center'):
+        self.font = font
+        self.anchor = anchor
+        self.pos = (0, 0)
+        self.selected = False
+        self.disabled = False
+        self.surface = None
+        self.box = None # Part of the surface that forms the hit box; the whole surface if None
+        self.rect = pygame.Rect(0, 0, 0, 0) # Hit box on screen
+        self.rendered_key = None
+
+    def state_key(self):
+        return (self.selected, self.disabled)
+
+    def render(self):
+        raise NotImplementedError
+
+    def refresh(self):
+        key = (self.state_key(), self.pos)
+        if key == self.rendered_key:
+            return
+        self.surface = self.render()
+        box = self.box or self.surface.get_rect()
+        self.rect = pygame.Rect((0, 0), box.size)
+        setattr(self.rect, self.anchor, self.pos)
+        self.rendered_key = key
 
-def about_screen(screen, clock):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_small = pygame.font.SysFont('Arial', 32)
-    version_font = pygame.font.SysFont('Arial', 24)
-    running = True
-    while running:
-        current_width, current_height = screen.get_size()
-        draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True) # Adjusted start color
-        title = font_big.render('About osu!python', True, OSU_BLUE)
-        title_rect = title.get_rect(center=(current_width//2, current_height//2 - 100))
-        screen.blit(title, title_rect)
-        lines = [
-            'osu!python is a osu! clone by Nebula12219548',
-            'Inspired by osu! (ppy)',
-            'For educational and fun purposes only.',
-            f'Version: v{VERSION}',
-            'GitHub: https://github.com/Nebula12219548/osu-python',
-            '',
-            'Press any key or click to return.'
-        ]
-        for i, line in enumerate(lines):
-            text = font_small.render(line, True, OSU_WHITE)
-            rect = text.get_rect(center=(current_width//2, current_height//2 + i*40 - 20))
-            screen.blit(text, rect)
-        version_text = version_font.render(f'v{VERSION}', True, OSU_LIGHT_GREY)
-        version_rect = version_text.get_rect(bottomright=(current_width-10, current_height-10))
-        screen.blit(version_text, version_rect)
-
-        # Custom cursor
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2): # Outer glow
-                pygame.draw.circle(screen, OSU_BLUE + (30,), (mx, my), r, 2)
-            pygame.draw.circle(screen, OSU_WHITE, (mx, my), 16, 2) # Inner circle
+    def draw(self, screen):
+        self.refresh()
+        box = self.box or self.surface.get_rect()
+        screen.blit(self.surface, (self.rect.left - box.left, self.rect.top - box.top))
 
-        pygame.display.flip()
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                running = False
-        clock.tick(FPS)
+    def hit(self, pos):
+        return not self.disabled and self.rect.collidepoint(pos)
 
-def settings_menu(screen, clock, settings):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_medium = pygame.font.SysFont('Arial', 36)
-    font_small = pygame.font.SysFont('Arial', 32)
-    version_font = pygame.font.SysFont('Arial', 24)
-    running = True
-    selected = 0
-    
-    # Define options for the settings menu
-    options = [
-        {'label': 'Custom Cursor', 'setting': 'custom_cursor', 'type': 'toggle'},
-        {'label': 'Show FPS Counter', 'setting': 'show_fps_counter', 'type': 'toggle'},
-        {'label': 'Music Volume', 'setting': 'music_volume', 'type': 'slider', 'min': 0.0, 'max': 1.0, 'step': 0.05},
-        {'label': 'SFX Volume', 'setting': 'sfx_volume', 'type': 'slider', 'min': 0.0, 'max': 1.0, 'step': 0.05},
-        {'label': 'Approach Circle Speed', 'setting': 'approach_circle_speed', 'type': 'dropdown', 'values': ['Slow', 'Normal', 'Fast']},
-        {'label': 'Difficulty Multiplier (WIP)', 'setting': 'difficulty_multiplier', 'type': 'slider', 'min': 0.5, 'max': 2.0, 'step': 0.1, 'disabled': True}, # Example disabled option
-        {'label': 'Back to Main Menu', 'type': 'action'}
-    ]
+    def activate(self, pos=None):
+        """Handles Enter or a click and returns a value for the menu loop, or None."""
+        return None
 
-    while running:
-        current_width, current_height = screen.get_size()
-        draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True) # Adjusted start color
-        title = font_big.render('Settings', True, OSU_BLUE)
-        title_rect = title.get_rect(center=(current_width//2, 80))
-        screen.blit(title, title_rect)
+    def adjust(self, direction):
+        """Handles Left (-1) and Right (+1)."""
+        pass
 
-        for i, opt in enumerate(options):
-            is_selected = (i == selected)
-            color = (255,255,0) if is_selected else (255,255,255)
-            btn_c1 = (0, 180, 255) if is_selected else (60,60,60)
-            btn_c2 = (0, 120, 200) if is_selected else (40,40,40)
-
-            display_text = opt['label']
-            if opt['type'] == 'toggle':
-                display_text += f": {'On' if settings[opt['setting']] else 'Off'}"
-            elif opt['type'] == 'slider':
-                display_text += f": {settings[opt['setting']]:.2f}"
-            elif opt['type'] == 'dropdown':
-                display_text += f": {settings[opt['setting']]}"
-            if opt.get('disabled', False):
-                color = (150, 150, 150)
-                btn_c1 = (30, 30, 30)
-                btn_c2 = (20, 20, 20)
-
-            text_surface = font_medium.render(display_text, True, color)
-            rect = text_surface.get_rect(center=(current_width//2, 180 + i*60))
-
-            draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-            pygame.draw.rect(screen, OSU_WHITE + (180,), rect.inflate(40, 10), 2, border_radius=12) # White border
-            screen.blit(text_surface, rect)
-
-            # Draw slider bar if it's a slider type
-            if opt['type'] == 'slider' and not opt.get('disabled', False):
-                slider_width = 200
-                slider_height = 10
-                slider_x = current_width // 2 + rect.width // 2 + 30 # Adjust position
-                slider_y = rect.centery - slider_height // 2
-
-                slider_rect = pygame.Rect(slider_x, slider_y, slider_width, slider_height)
-                pygame.draw.rect(screen, OSU_MEDIUM_GREY, slider_rect, border_radius=5) # Slider track
-
-                value_range = opt['max'] - opt['min']
-                if value_range > 0:
-                    handle_pos_x = slider_x + slider_width * ((settings[opt['setting']] - opt['min']) / value_range)
-                    pygame.draw.circle(screen, OSU_WHITE, (int(handle_pos_x), rect.centery), 10) # Handle outline
-                    pygame.draw.circle(screen, OSU_BLUE, (int(handle_pos_x), rect.centery), 8) # Handle fill
-
-
-        version_text = version_font.render(f'v{VERSION}', True, (180, 180, 180))
-        version_rect = version_text.get_rect(bottomright=(current_width-10, current_height-10))
-        screen.blit(version_text, version_rect)
-
-        # Custom cursor
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2): # Outer glow
-                pygame.draw.circle(screen, OSU_BLUE + (30,), (mx, my), r, 2)
-            pygame.draw.circle(screen, OSU_WHITE, (mx, my), 16, 2) # Inner circle
+    def drag(self, pos):
+        """Handles the mouse moving with the button held after a click on this widget."""
+        pass
+
+class Label(Widget):
+    focusable = False
+
+    def __init__(self, text, font, color=OSU_WHITE, anchor='center'):
+        super().__init__(font, anchor)
+        self.text = text
+        self.color = color
+
+    def state_key(self):
+        return (self.text, self.color)
 
+    def render(self):
+        return self.font.render(self.text, True, self.color)
+
+    def hit(self, pos):
+        return False
+
+class Button(Widget):
+    def __init__(self, label, font, value=None, selected_color=OSU_YELLOW):
+        super().__init__(font)
+        self.label = label
+        self.value = label if value is None else value
+        self.selected_color = selected_color
+
+    def text(self):
+        return self.label
+
+    def state_key(self):
+        return (self.text(), self.selected, self.disabled)
+
+    def render(self):
+        if self.disabled:
+            surface = render_button(self.font, self.text(), (150, 150, 150), (30, 30, 30), (20, 20, 20))
+        elif self.selected:
+            surface = render_button(self.font, self.text(), self.selected_color, OSU_BLUE, OSU_DARK_BLUE)
+        else:
+            surface = render_button(self.font, self.text(), OSU_WHITE, OSU_MEDIUM_GREY, OSU_DARK_GREY)
+        self.box = surface.get_rect().inflate(-8, -8)
+        return surface
+
+    def activate(self, pos=None):
+        return self.value
+
+class Toggle(Button):
+    """Button that cycles a setting through its values; On/Off for booleans."""
+    def __init__(self, label, font, settings, setting, values=(False, True), on_change=None):
+        super().__init__(label, font)
+        self.settings = settings
+        self.setting = setting
+        self.values = list(values)
+        self.on_change = on_change
+
+    def text(self):
+        value = self.settings[self.setting]
+        if isinstance(value, bool):
+            value = 'On' if value else 'Off'
+        return f"{self.label}: {value}"
+
+    def adjust(self, direction):
+        if self.settings[self.setting] in self.values:
+            index = self.values.index(self.settings[self.setting])
+            self.settings[self.setting] = self.values[(index + direction) % len(self.values)]
+        else:
+            self.settings[self.setting] = self.values[0] # A saved value that is no longer offered
+        if self.on_change:
+            self.on_change(self.settings[self.setting])
+
+    def activate(self, pos=None):
+        self.adjust(1)
+        return None
+
+class Slider(Button):
+    """Button showing a numeric setting with a track to its right. Clicking the track sets
+    the value, holding the button and moving drags the handle, Left/Right step it."""
+    TRACK_WIDTH = 200
+
+    def __init__(self, label, font, settings, setting, minimum, maximum, step, on_change=None, fmt='{:.2f}'):
+        super().__init__(label, font)
+        self.settings = settings
+        self.setting = setting
+        self.minimum, self.maximum, self.step = minimum, maximum, step
+        self.on_change = on_change
+        self.fmt = fmt
+        self.dragging = False # Whether the current mouse press started on the track
+
+    def text(self):
+        return f"{self.label}: {self.fmt.format(self.settings[self.setting])}"
+
+    def track_rect(self):
+        return pygame.Rect(self.rect.right + 10, self.rect.centery - 5, self.TRACK_WIDTH, 10)
+
+    def render(self):
+        button = super().render()
+        if self.disabled:
+            return button
+        surface = pygame.Surface((button.get_width() + 10 + self.TRACK_WIDTH + 10, button.get_height()), pygame.SRCALPHA)
+        surface.blit(button, (0, 0))
+        track = pygame.Rect(self.box.right + 10, self.box.centery - 5, self.TRACK_WIDTH, 10)
+        pygame.draw.rect(surface, OSU_MEDIUM_GREY, track, border_radius=5) # Slider track
+        value_range = self.maximum - self.minimum
+        if value_range > 0:
+            handle_x = int(track.left + self.TRACK_WIDTH * ((self.settings[self.setting] - self.minimum) / value_range))
+            pygame.draw.circle(surface, OSU_WHITE, (handle_x, track.centery), 10) # Handle outline
+            pygame.draw.circle(surface, OSU_BLUE, (handle_x, track.centery), 8) # Handle fill
+        return surface
+
+    def set_value(self, value):
+        self.settings[self.setting] = round(max(self.minimum, min(self.maximum, value)), 2) # Round to avoid float precision issues
+        if self.on_change:
+            self.on_change(self.settings[self.setting])
+
+    def hit(self, pos):
+        return super().hit(pos) or (not self.disabled and self.track_rect().inflate(0, 10).collidepoint(pos))
+
+    def adjust(self, direction):
+        self.set_value(self.settings[self.setting] + direction * self.step)
+
+    def activate(self, pos=None):
+        self.dragging = pos is not None and self.track_rect().inflate(0, 10).collidepoint(pos)
+        if self.dragging:
+            self.drag(pos)
+        return None
+
+    def drag(self, pos):
+        if self.dragging:
+            track = self.track_rect()
+            self.set_value(self.minimum + (pos[0] - track.left) / track.width * (self.maximum - self.minimum))
+
+class Menu:
+    """The widgets of one screen, with keyboard focus and click dispatch through the widgets'
+    cached hit boxes. `place(width, height)` returns one position per widget and only runs
+    when the layout changes. Escape returns `cancel` when it is set."""
+    def __init__(self, widgets, place, selected=0, cancel=None):
+        self.widgets = widgets
+        self.focus_order = [widget for widget in widgets if widget.focusable]
+        self.place = place
+        self.cancel = cancel
+        self.layout_version = None
+        self.selected = 0
+        self.pressed = None # Widget the held mouse button went down on
+        if self.focus_order:
+            self.select(selected)
+
+    def select(self, index):
+        self.selected = index % len(self.focus_order)
+        for i, widget in enumerate(self.focus_order):
+            widget.selected = i == self.selected
+
+    def layout(self):
+        if self.layout_version != LAYOUT.version:
+            self.layout_version = LAYOUT.version
+            for widget, pos in zip(self.widgets, self.place(LAYOUT.width, LAYOUT.height)):
+                widget.pos = pos
+                widget.refresh()
+
+    def draw(self, screen):
+        self.layout()
+        for widget in self.widgets:
+            widget.draw(screen)
+
+    def handle_event(self, event):
+        """Returns the value of the widget the event activated, if any."""
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                return self.cancel
+            if not self.focus_order:
+                return None
+            focused = self.focus_order[self.selected]
+            if event.key == pygame.K_UP:
+                self.select(self.selected - 1)
+            elif event.key == pygame.K_DOWN:
+                self.select(self.selected + 1)
+            elif focused.disabled: # Cannot activate disabled options
+                return None
+            elif event.key == pygame.K_RETURN:
+                return focused.activate()
+            elif event.key == pygame.K_LEFT:
+                focused.adjust(-1)
+            elif event.key == pygame.K_RIGHT:
+                focused.adjust(1)
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            for i, widget in enumerate(self.focus_order):
+                if widget.hit(event.pos):
+                    self.select(i)
+                    self.pressed = widget
+                    return widget.activate(event.pos)
+        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+            self.pressed = None
+        elif event.type == pygame.MOUSEMOTION and self.pressed is not None and event.buttons[0]:
+            self.pressed.drag(event.pos)
+        return None
+
+def column(x, y, count, spacing=60):
+    return [(x, y + i * spacing) for i in range(count)]
+
+def run_menu(screen, clock, menu, draw_background=draw_menu_background, draw_foreground=None):
+    """Shows a menu until one of its widgets returns a value, and returns that value."""
+    while True:
+        screen = apply_pending_resize(screen)
+        draw_background(screen)
+        menu.draw(screen)
+        if draw_foreground:
+            draw_foreground(screen)
+        draw_menu_cursor(screen)
         pygame.display.flip()
 
-        for event in pygame.event.get():
+        # Nothing is redrawn until an event arrives or an animation asked for a frame
+        for event in wait_for_menu_events():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected = (selected - 1) % len(options)
-                elif event.key == pygame.K_DOWN:
-                    selected = (selected + 1) % len(options)
-                elif event.key == pygame.K_RETURN:
-                    opt = options[selected]
-                    if opt.get('disabled', False): # Cannot activate disabled options
-                        continue
-                    if opt['type'] == 'toggle':
-                        settings[opt['setting']] = not settings[opt['setting']]
-                        pygame.mouse.set_visible(not settings['custom_cursor']) # Update cursor visibility immediately
-                    elif opt['type'] == 'action' and opt['label'] == 'Back to Main Menu':
-                        running = False
-                    elif opt['type'] == 'dropdown':
-                        current_value_index = opt['values'].index(settings[opt['setting']])
-                        next_value_index = (current_value_index + 1) % len(opt['values'])
-                        settings[opt['setting']] = opt['values'][next_value_index]
-                elif event.key == pygame.K_LEFT:
-                    opt = options[selected]
-                    if opt.get('disabled', False):
-                        continue
-                    if opt['type'] == 'slider':
-                        current_value = settings[opt['setting']]
-                        new_value = max(opt['min'], current_value - opt['step'])
-                        settings[opt['setting']] = round(new_value, 2) # Round to avoid float precision issues
-                        if opt['setting'] == 'music_volume':
-                            pygame.mixer.music.set_volume(settings['music_volume'])
-                        # Add SFX volume adjustment here if you have specific SFX playing
-                    elif opt['type'] == 'dropdown':
-                        current_value_index = opt['values'].index(settings[opt['setting']])
-                        prev_value_index = (current_value_index - 1 + len(opt['values'])) % len(opt['values'])
-                        settings[opt['setting']] = opt['values'][prev_value_index]
-                elif event.key == pygame.K_RIGHT:
-                    opt = options[selected]
-                    if opt.get('disabled', False):
-                        continue
-                    if opt['type'] == 'slider':
-                        current_value = settings[opt['setting']]
-                        new_value = min(opt['max'], current_value + opt['step'])
-                        settings[opt['setting']] = round(new_value, 2)
-                        if opt['setting'] == 'music_volume':
-                            pygame.mixer.music.set_volume(settings['music_volume'])
-                        # Add SFX volume adjustment here if you have specific SFX playing
-                    elif opt['type'] == 'dropdown':
-                        current_value_index = opt['values'].index(settings[opt['setting']])
-                        next_value_index = (current_value_index + 1) % len(opt['values'])
-                        settings[opt['setting']] = opt['values'][next_value_index]
-
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for i, opt in enumerate(options):
-                    display_text = opt['label']
-                    if opt['type'] == 'toggle':
-                        display_text += f": {'On' if settings[opt['setting']] else 'Off'}"
-                    elif opt['type'] == 'slider':
-                        display_text += f": {settings[opt['setting']]:.2f}"
-                    elif opt['type'] == 'dropdown':
-                        display_text += f": {settings[opt['setting']]}"
-
-                    text_surface = font_medium.render(display_text, True, (255,255,255))
-                    rect = text_surface.get_rect(center=(current_width//2, 180 + i*60))
-                    
-                    if opt.get('disabled', False):
-                        continue
-
-                    if rect.inflate(40, 10).collidepoint(event.pos):
-                        if opt['type'] == 'toggle':
-                            settings[opt['setting']] = not settings[opt['setting']]
-                            pygame.mouse.set_visible(not settings['custom_cursor']) # Update cursor visibility immediately
-                        elif opt['type'] == 'action' and opt['label'] == 'Back to Main Menu':
-                            running = False
-                        elif opt['type'] == 'dropdown':
-                            current_value_index = opt['values'].index(settings[opt['setting']])
-                            next_value_index = (current_value_index + 1) % len(opt['values'])
-                            settings[opt['setting']] = opt['values'][next_value_index]
-                    
-                    # Handle slider click/drag
-                    if opt['type'] == 'slider':
-                        slider_width = 200
-                        slider_height = 10
-                        slider_x = current_width // 2 + rect.width // 2 + 30
-                        slider_y = rect.centery - slider_height // 2
-                        slider_rect = pygame.Rect(slider_x, slider_y, slider_width, slider_height)
-
-                        if slider_rect.collidepoint(event.pos):
-                            normalized_x = (event.pos[0] - slider_x) / slider_width
-                            value_range = opt['max'] - opt['min']
-                            new_value = opt['min'] + normalized_x * value_range
-                            new_value = round(max(opt['min'], min(opt['max'], new_value)), 2)
-                            settings[opt['setting']] = new_value
-                            if opt['setting'] == 'music_volume':
-                                pygame.mixer.music.set_volume(settings['music_volume'])
-                            # Add SFX volume adjustment here if you have specific SFX playing
-
-
+                queue_resize(event)
+            else:
+                result = menu.handle_event(event)
+                if result is not None:
+                    return result
         clock.tick(FPS)
-    return settings # Return updated settings
-
-def tutorial_screen(screen, clock, hit_sound):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_small = pygame.font.SysFont('Arial', 32)
-    version_font = pygame.font.SysFont('Arial', 24)
-    instructions = [
-        'Welcome to osu!python Tutorial!',
-        '',
-        '1. Click the circles as they appear.',
-        '2. You must click them in order.',
-        '3. Try to click when the approach circle closes in.',
-        '4. Missing circles will reduce your health.',
-        '',
-        'Press SPACE to start the demonstration.'
-    ]
-    running = True
-    while running:
-        current_width, current_height = screen.get_size()
-        draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True) # Adjusted start color
-        title = font_big.render('Tutorial', True, OSU_BLUE)
-        title_rect = title.get_rect(center=(current_width//2, 120))
-        screen.blit(title, title_rect)
-        for i, line in enumerate(instructions):
-            text = font_small.render(line, True, (255,255,255))
-            rect = text.get_rect(center=(current_width//2, 220 + i*40))
-            screen.blit(text, rect)
-        version_text = version_font.render(f'v{VERSION}', True, (180, 180, 180))
-        version_rect = version_text.get_rect(bottomright=(current_width-10, current_height-10))
-        screen.blit(version_text, version_rect)
-
-        # Custom cursor
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2): # Outer glow
-                pygame.draw.circle(screen, OSU_BLUE + (30,), (mx, my), r, 2)
-            pygame.draw.circle(screen, OSU_WHITE, (mx, my), 16, 2) # Inner circle
 
+def run_info_screen(screen, clock, menu, dismiss_keys=None):
+    """Shows a screen of labels until a click or key press; any key unless dismiss_keys is given."""
+    while True:
+        screen = apply_pending_resize(screen)
+        draw_menu_background(screen)
+        menu.draw(screen)
+        draw_menu_cursor(screen)
         pygame.display.flip()
-        for event in pygame.event.get():
+        for event in wait_for_menu_events():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
-                running = False
+                queue_resize(event)
+            elif event.type == pygame.KEYDOWN and (dismiss_keys is None or event.key in dismiss_keys):
+                return
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                running = False
+                return
         clock.tick(FPS)
 
-    # Run demonstration
-    run_tutorial_demo(screen, clock, hit_sound)
+class Scene:
+    """One screen of the game. The SceneManager creates each scene once and keeps it, so its
+    fonts, widgets and caches are built on the first visit only."""
+    def __init__(self, manager):
+        self.manager = manager
+
+    def preload(self, **params):
+        """Prepares a likely next visit while another scene is still showing."""
+        pass
+
+    def run(self, screen, clock, **params):
+        """Shows the scene and returns the next (scene name, params), or None to quit."""
+        raise NotImplementedError
+
+class SceneManager:
+    def __init__(self, clock, hit_sound):
+        self.clock = clock
+        self.hit_sound = hit_sound
+        self.factories = {}
+        self.scenes = {}
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+
+    def get(self, name):
+        if name not in self.scenes:
+            self.scenes[name] = self.factories[name](self)
+        return self.scenes[name]
+
+    def preload(self, name, **params):
+        self.get(name).preload(**params)
+
+    def run(self, name, **params):
+        transition = (name, params)
+        while transition is not None:
+            name, params = transition
+            # Scenes may have recreated the window on resize, so always draw to the current one
+            transition = self.get(name).run(pygame.display.get_surface(), self.clock, **params)
+
+class AboutScene(Scene):
+    def __init__(self, manager):
+        super().__init__(manager)
+        lines = [
+            'osu!python is a osu! clone by Nebula12219548',
+            'Inspired by osu! (ppy)',
+            'For educational and fun purposes only.',
+            f'Version: v{VERSION}',
+            'GitHub: https://github.com/Nebula12219548/osu-python',
+            '',
+            'Press any key or click to return.'
+        ]
+        widgets = [Label('About osu!python', get_font(54, bold=True), OSU_BLUE)]
+        widgets += [Label(line, get_font(32)) for line in lines]
+        widgets.append(Label(f'v{VERSION}', get_font(24), OSU_LIGHT_GREY, anchor='bottomright'))
+        self.menu = Menu(widgets, lambda w, h: [(w//2, h//2 - 100)] + column(w//2, h//2 - 20, len(lines), 40) + [(w-10, h-10)])
+
+    def run(self, screen, clock):
+        run_info_screen(screen, clock, self.menu)
+        return ('main_menu', {})
+
+class SettingsScene(Scene):
+    def __init__(self, manager):
+        super().__init__(manager)
+        font_medium = get_font(36)
+
+        def set_music_volume(value):
+            pygame.mixer.music.set_volume(value)
+            # Add SFX volume adjustment here if you have specific SFX playing
+
+        # Define options for the settings menu
+        options = [
+            Toggle('Custom Cursor', font_medium, SETTINGS, 'custom_cursor', on_change=lambda value: pygame.mouse.set_visible(not value)), # Update cursor visibility immediately
+            Toggle('Show FPS Counter', font_medium, SETTINGS, 'show_fps_counter'),
+            Slider('Music Volume', font_medium, SETTINGS, 'music_volume', 0.0, 1.0, 0.05, on_change=set_music_volume),
+            Slider('SFX Volume', font_medium, SETTINGS, 'sfx_volume', 0.0, 1.0, 0.05),
+            Toggle('Approach Circle Speed', font_medium, SETTINGS, 'approach_circle_speed', values=['Slow', 'Normal', 'Fast']),
+            Slider('Difficulty Multiplier (WIP)', font_medium, SETTINGS, 'difficulty_multiplier', 0.5, 2.0, 0.1), # Example disabled option
+            Button('Audio Device', font_medium, value='Audio'),
+            Button('Back to Main Menu', font_medium, value='Back'),
+        ]
+        options[5].disabled = True
+        widgets = [Label('Settings', get_font(54, bold=True), OSU_BLUE)] + options + [Label(f'v{VERSION}', get_font(24), OSU_LIGHT_GREY, anchor='bottomright')]
+        self.menu = Menu(widgets, lambda w, h: [(w//2, 80)] + column(w//2, 160, len(options), 55) + [(w-10, h-10)])
+
+    def run(self, screen, clock):
+        choice = run_menu(screen, clock, self.menu)
+        save_settings()
+        if choice == 'Audio':
+            return ('audio', {})
+        return ('main_menu', {})
+
+class AudioSettingsScene(Scene):
+    """Mixer frequency, buffer size and channels, plus the latency probe. Changes are applied
+    by restarting the mixer when leaving the screen."""
+    def __init__(self, manager):
+        super().__init__(manager)
+        font_medium = get_font(36)
+        options = [
+            Toggle('Frequency', font_medium, SETTINGS, 'audio_frequency', values=AUDIO_FREQUENCIES),
+            Toggle('Buffer Size', font_medium, SETTINGS, 'audio_buffer', values=AUDIO_BUFFER_SIZES),
+            Toggle('Channels', font_medium, SETTINGS, 'audio_channels', values=AUDIO_CHANNEL_COUNTS),
+            Button('Measure Latency', font_medium, value='Probe'),
+            Slider('Audio Offset', font_medium, SETTINGS, 'audio_offset', -MAX_AUDIO_OFFSET, MAX_AUDIO_OFFSET, 5, fmt='{:+.0f} ms'),
+            Button('Calibrate Offset', font_medium, value='Calibrate'),
+            Button('Back to Settings', font_medium, value='Back'),
+        ]
+        self.status = Label('Smaller buffers lower hitsound latency', get_font(24), OSU_LIGHT_GREY)
+        widgets = [Label('Audio Device', get_font(54, bold=True), OSU_BLUE), self.status] + options
+        self.menu = Menu(widgets, lambda w, h: [(w//2, 70), (w//2, 120)] + column(w//2, 180, len(options), 55))
+
+    def apply_mixer(self):
+        """Restarts the mixer with the chosen settings. Settings the device refuses are put
+        back to the ones it was running with, so they never get saved."""
+        if pygame.mixer.get_init() and _MIXER_STATE['settings'] != mixer_settings():
+            previous = _MIXER_STATE['settings']
+            if not restart_mixer():
+                SETTINGS['audio_frequency'], _, SETTINGS['audio_channels'], SETTINGS['audio_buffer'] = previous
+            if pygame.mixer.get_init():
+                self.manager.hit_sound.reload()
+
+    def show_probe_results(self, screen, clock, results, recommended):
+        lines = []
+        for size, (median, worst, stable) in results.items():
+            if median is None:
+                lines.append(f'{size}: no response')
+            else:
+                lines.append(f"{size}: {median:.1f} ms, worst {worst:.1f} ms{'' if stable else ' (underruns)'}")
+        widgets = [Label('Latency Probe', get_font(54, bold=True), OSU_BLUE)] + [Label(line, get_font(24)) for line in lines]
+        widgets += [Button(f'Use Buffer {recommended}', get_font(36), value='Use'), Button('Keep Current', get_font(36), value='Keep')]
+        menu = Menu(widgets, lambda w, h: [(w//2, 70)] + column(w//2, 130, len(lines), 30) + column(w//2, 150 + len(lines) * 30, 2))
+        return run_menu(screen, clock, menu) == 'Use'
+
+    def run(self, screen, clock):
+        if not pygame.mixer.get_init():
+            self.status.text = 'Audio is unavailable, changes apply on the next start'
+        while True:
+            choice = run_menu(screen, clock, self.menu)
+            if choice == 'Probe' and pygame.mixer.get_init():
+                draw_menu_background(screen)
+                Menu([Label('Measuring latency...', get_font(36))], lambda w, h: [(w//2, h//2)]).draw(screen)
+                pygame.display.flip()
+                results, recommended = run_latency_probe()
+                if pygame.mixer.get_init():
+                    self.manager.hit_sound.reload()
+                if self.show_probe_results(screen, clock, results, recommended):
+                    SETTINGS['audio_buffer'] = recommended
+                self.status.text = f'Recommended buffer size: {recommended}'
+            elif choice == 'Calibrate' and pygame.mixer.get_init():
+                # Calibrate with the mixer the game will actually run with
+                self.apply_mixer()
+                save_settings()
+                return ('calibration', {})
+            elif choice == 'Back':
+                break
+        self.apply_mixer()
+        save_settings()
+        return ('settings', {})
+
+class CalibrationScene(Scene):
+    """Plays a metronome and measures how far the player's taps land from the clicks. The
+    median becomes the global audio offset the game clock is shifted by."""
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.title = Label('Offset Calibration', get_font(54, bold=True), OSU_BLUE)
+        self.hint = Label('Tap any key or click on every beat you hear. Esc cancels.', get_font(24), OSU_LIGHT_GREY)
+        self.progress = Label('', get_font(36))
+        self.overlay = Menu([self.title, self.hint, self.progress], lambda w, h: [(w//2, 80), (w//2, 140), (w//2, h//2)])
+        self.accent = self.click = None
+        self.sound_settings = None # Mixer settings the clicks were generated for
+
+    def run_metronome(self, screen, clock):
+        """Returns (tap times, click times) in ticks, or None if cancelled."""
+        if self.click is None or self.sound_settings != _MIXER_STATE['settings']:
+            self.accent, self.click = generate_hitsound(1500), generate_hitsound(1000)
+            self.sound_settings = _MIXER_STATE['settings']
+        for sound in (self.accent, self.click):
+            sound.set_volume(SETTINGS['sfx_volume'])
+        interval = 60000.0 / CALIBRATION_BPM
+        total = CALIBRATION_COUNT_IN + CALIBRATION_BEATS
+        start = pygame.time.get_ticks() + 500
+        taps, clicks = [], []
+        dirty = True
+        pygame.event.clear()
+        while len(clicks) < total or pygame.time.get_ticks() < clicks[-1] + interval / 2:
+            now = pygame.time.get_ticks()
+            if len(clicks) < total and now >= start + len(clicks) * interval:
+                (self.accent if len(clicks) % 4 == 0 else self.click).play()
+                clicks.append(now) # When play() was actually called, not when it was due
+                dirty = True
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
+                elif event.type == pygame.VIDEORESIZE:
+                    queue_resize(event)
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                    return None
+                elif event.type in (pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN):
+                    # Taps count from half a beat before the first measured click
+                    if now >= start + (CALIBRATION_COUNT_IN - 0.5) * interval:
+                        taps.append(now)
+                    dirty = True
+            screen = apply_pending_resize(screen)
+            if dirty:
+                # Nothing flashes on the beat, so the measurement is of what the player hears
+                if len(clicks) <= CALIBRATION_COUNT_IN:
+                    self.progress.text = f'Get ready... {CALIBRATION_COUNT_IN - len(clicks) + 1}'
+                else:
+                    self.progress.text = f'Beat {len(clicks) - CALIBRATION_COUNT_IN}/{CALIBRATION_BEATS}  ({len(taps)} taps)'
+                draw_menu_background(screen)
+                self.overlay.draw(screen)
+                pygame.display.flip()
+                dirty = False
+            clock.tick(CALIBRATION_FPS)
+        # The count-in clicks stay in so early taps on the first counted beat match correctly
+        return taps, clicks
+
+    def run(self, screen, clock):
+        while True:
+            recorded = self.run_metronome(screen, clock)
+            if recorded is None:
+                return ('audio', {})
+            result = measure_tap_offset(*recorded)
+            if result is None:
+                lines = ['Not enough taps to measure an offset.']
+                buttons = [Button('Try Again', get_font(36), value='Retry'), Button('Back', get_font(36), value='Back')]
+            else:
+                offset, spread = result
+                offset = int(round(max(-MAX_AUDIO_OFFSET, min(MAX_AUDIO_OFFSET, offset))))
+                lines = [f'Measured offset: {offset:+d} ms', f'Tap spread: {spread:.0f} ms',
+                         f"Current offset: {SETTINGS['audio_offset']:+.0f} ms"]
+                buttons = [Button('Apply', get_font(36), value='Apply'), Button('Try Again', get_font(36), value='Retry'),
+                           Button('Discard', get_font(36), value='Back')]
+            widgets = [self.title] + [Label(line, get_font(32)) for line in lines] + buttons
+            menu = Menu(widgets, lambda w, h: [(w//2, 80)] + column(w//2, 170, len(lines), 45) + column(w//2, 200 + len(lines) * 45, len(buttons)),
+                        cancel='Back')
+            choice = run_menu(screen, clock, menu)
+            if choice == 'Apply':
+                SETTINGS['audio_offset'] = offset
+                save_settings()
+            if choice != 'Retry':
+                return ('audio', {})
+
+class TutorialScene(Scene):
+    def __init__(self, manager):
+        super().__init__(manager)
+        instructions = [
+            'Welcome to osu!python Tutorial!',
+            '',
+            '1. Click the circles as they appear.',
+            '2. You must click them in order.',
+            '3. Try to click when the approach circle closes in.',
+            '4. Missing circles will reduce your health.',
+            '',
+            'Press SPACE to start the demonstration.'
+        ]
+        widgets = [Label('Tutorial', get_font(54, bold=True), OSU_BLUE)] + [Label(line, get_font(32)) for line in instructions]
+        widgets.append(Label(f'v{VERSION}', get_font(24), OSU_LIGHT_GREY, anchor='bottomright'))
+        self.menu = Menu(widgets, lambda w, h: [(w//2, 120)] + column(w//2, 220, len(instructions), 40) + [(w-10, h-10)])
+
+    def run(self, screen, clock):
+        run_info_screen(screen, clock, self.menu, dismiss_keys=(pygame.K_SPACE,))
+        # Run demonstration
+        run_tutorial_demo(screen, clock, self.manager.hit_sound)
+        return ('main_menu', {})
 
 def run_tutorial_demo(screen, clock, hit_sound):
-    font = pygame.font.SysFont('Arial', 32)
-    hit_feedback_font = pygame.font.SysFont('Arial', 36, bold=True)
+    font = get_font(32)
+    hit_feedback_font = get_font(36, bold=True)
     demo_hitobjects = [
         {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.5), 'time': 1000},
         {'pos': (SETTINGS['current_width'] * 0.75, SETTINGS['current_height'] * 0.5), 'time': 2500},
@@ -744,23 +2050,26 @@ def run_tutorial_demo(screen, clock, hit_sound):
     health_bar_y = 40
     hit_feedbacks = []  # Fix: initialize hit_feedbacks
     running = True
+    layout_version = LAYOUT.version
     while running:
         now = pygame.time.get_ticks() - start_time
-        current_width, current_height = screen.get_size()
+        screen = apply_pending_resize(screen)
+        current_width, current_height = LAYOUT.size
+        if layout_version != LAYOUT.version:
+            layout_version = LAYOUT.version
+            demo_hitobjects = [
+                {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.5), 'time': 1000},
+                {'pos': (SETTINGS['current_width'] * 0.75, SETTINGS['current_height'] * 0.5), 'time': 2500},
+                {'pos': (SETTINGS['current_width'] * 0.25, SETTINGS['current_height'] * 0.5), 'time': 4000},
+                {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.16), 'time': 5500},
+                {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.83), 'time': 7000},
+            ]
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-                demo_hitobjects = [
-                    {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.5), 'time': 1000},
-                    {'pos': (SETTINGS['current_width'] * 0.75, SETTINGS['current_height'] * 0.5), 'time': 2500},
-                    {'pos': (SETTINGS['current_width'] * 0.25, SETTINGS['current_height'] * 0.5), 'time': 4000},
-                    {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.16), 'time': 5500},
-                    {'pos': (SETTINGS['current_width'] * 0.5, SETTINGS['current_height'] * 0.83), 'time': 7000},
-                ]
+                queue_resize(event)
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if current < len(demo_hitobjects):
                     obj = demo_hitobjects[current]
@@ -771,7 +2080,6 @@ def run_tutorial_demo(screen, clock, hit_sound):
                         clicked[current] = True
                         score += 300
                         health = min(health + 20, max_health)
-                        hit_sound.set_volume(SETTINGS['sfx_volume'])
                         hit_sound.play()
                         hit_feedbacks.append({'text': 'Hit!', 'time': pygame.time.get_ticks(), 'color': (0, 255, 100), 'pos': obj['pos']})
                         current += 1
@@ -854,498 +2162,1138 @@ def run_tutorial_demo(screen, clock, hit_sound):
         if current >= len(demo_hitobjects):
             return
 
-def pause_menu(screen, clock, map_name):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_medium = pygame.font.SysFont('Arial', 36)
-    
-    options = ['Resume', 'Retry', 'Back to Maps', 'Quit']
-    selected = 0
-    running = True
-
-    # Darken the background
+def overlay_background(screen):
+    """Snapshots the current frame under a dark overlay, to be used as a menu background."""
+    background = screen.copy()
     overlay = pygame.Surface(screen.get_size(), pygame.SRCALPHA)
     overlay.fill((0, 0, 0, 180)) # Dark transparent overlay
+    background.blit(overlay, (0, 0))
+    return lambda surface: surface.blit(background, (0, 0))
 
-    while running:
-        screen.blit(overlay, (0, 0)) # Draw overlay on top of game state
-
-        current_width, current_height = screen.get_size()
-
-        title = font_big.render(f'{map_name} - Paused', True, (255, 255, 255))
-        title_rect = title.get_rect(center=(current_width//2, current_height//2 - 150))
-        screen.blit(title, title_rect)
-
-        for i, opt_label in enumerate(options):
-            is_selected = (i == selected)
-            color = (0, 180, 255) if is_selected else (255, 255, 255)
-            btn_c1 = (0, 180, 255) if is_selected else (60,60,60)
-            btn_c2 = (0, 120, 200) if is_selected else (40,40,40)
-
-            text_surface = font_medium.render(opt_label, True, color)
-            rect = text_surface.get_rect(center=(current_width//2, current_height//2 - 50 + i*60))
-
-            draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-            pygame.draw.rect(screen, (255,255,255,180), rect.inflate(40, 10), 2, border_radius=12)
-            screen.blit(text_surface, rect)
-
-        # Custom cursor
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2):
-                pygame.draw.circle(screen, (0,180,255,30), (mx, my), r, 2)
-            pygame.draw.circle(screen, (255,255,255), (mx, my), 16, 2)
-        
-        pygame.display.flip()
+def pause_menu(screen, clock, map_name):
+    font_big = get_font(54, bold=True)
+    font_medium = get_font(36)
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected = (selected - 1) % len(options)
-                elif event.key == pygame.K_DOWN:
-                    selected = (selected + 1) % len(options)
-                elif event.key == pygame.K_RETURN:
-                    if options[selected] == 'Resume':
-                        return 'Resume'
-                    elif options[selected] == 'Retry':
-                        return 'Retry'
-                    elif options[selected] == 'Back to Maps':
-                        return 'Maps'
-                    elif options[selected] == 'Quit':
-                        return 'Quit'
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for i, opt_label in enumerate(options):
-                    text_surface = font_medium.render(opt_label, True, (255,255,255))
-                    rect = text_surface.get_rect(center=(current_width//2, current_height//2 - 50 + i*60))
-                    if rect.inflate(40, 10).collidepoint(event.pos):
-                        if options[i] == 'Resume':
-                            return 'Resume'
-                        elif options[i] == 'Retry':
-                            return 'Retry'
-                        elif options[i] == 'Back to Maps':
-                            return 'Maps'
-                        elif options[i] == 'Quit':
-                            return 'Quit'
-        clock.tick(FPS)
+    options = [('Resume', 'Resume'), ('Retry', 'Retry'), ('Back to Maps', 'Maps'), ('Quit', 'Quit')]
+    widgets = [Label(f'{map_name} - Paused', font_big)]
+    widgets += [Button(label, font_medium, value, selected_color=OSU_BLUE) for label, value in options]
+    menu = Menu(widgets, lambda w, h: [(w//2, h//2 - 150)] + column(w//2, h//2 - 50, len(options)))
+    # Darken the game state behind the menu
+    return run_menu(screen, clock, menu, overlay_background(screen))
 
 def game_over_screen(screen, clock, final_score, status):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_medium = pygame.font.SysFont('Arial', 36)
-    
-    options = ['Retry', 'Back to Maps', 'Quit']
-    selected = 0
-    running = True
-
-    # Darken the background
-    overlay = pygame.Surface(screen.get_size(), pygame.SRCALPHA)
-    overlay.fill((0, 0, 0, 180)) # Dark transparent overlay
-
-    while running:
-        screen.blit(overlay, (0, 0)) # Draw overlay on top of game state
-
-        current_width, current_height = screen.get_size()
-
-        status_text = font_big.render(f'Map {status}!', True, (0, 180, 255) if status == 'Completed' else (255, 50, 50))
-        status_rect = status_text.get_rect(center=(current_width//2, current_height//2 - 150))
-        screen.blit(status_text, status_rect)
-
-        score_text = font_medium.render(f'Final Score: {final_score}', True, (255, 255, 255))
-        score_rect = score_text.get_rect(center=(current_width//2, current_height//2 - 90))
-        screen.blit(score_text, score_rect)
-
-        for i, opt_label in enumerate(options):
-            is_selected = (i == selected)
-            color = (0, 180, 255) if is_selected else (255, 255, 255)
-            btn_c1 = (0, 180, 255) if is_selected else (60,60,60)
-            btn_c2 = (0, 120, 200) if is_selected else (40,40,40)
-
-            text_surface = font_medium.render(opt_label, True, color)
-            rect = text_surface.get_rect(center=(current_width//2, current_height//2 - 20 + i*60))
-
-            draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-            pygame.draw.rect(screen, (255,255,255,180), rect.inflate(40, 10), 2, border_radius=12)
-            screen.blit(text_surface, rect)
-
-        # Custom cursor
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2):
-                pygame.draw.circle(screen, (0,180,255,30), (mx, my), r, 2)
-            pygame.draw.circle(screen, (255,255,255), (mx, my), 16, 2)
-
-        pygame.display.flip()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected = (selected - 1) % len(options)
-                elif event.key == pygame.K_DOWN:
-                    selected = (selected + 1) % len(options)
-                elif event.key == pygame.K_RETURN:
-                    if options[selected] == 'Retry':
-                        return 'Retry'
-                    elif options[selected] == 'Back to Maps':
-                        return 'Maps'
-                    elif options[selected] == 'Quit':
-                        return 'Quit'
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for i, opt_label in enumerate(options):
-                    text_surface = font_medium.render(opt_label, True, (255,255,255))
-                    rect = text_surface.get_rect(center=(current_width//2, current_height//2 - 20 + i*60))
-                    if rect.inflate(40, 10).collidepoint(event.pos):
-                        if options[i] == 'Retry':
-                            return 'Retry'
-                        elif options[i] == 'Back to Maps':
-                            return 'Maps'
-                        elif options[i] == 'Quit':
-                            return 'Quit'
-        clock.tick(FPS)
-
-
-def main_menu(screen, clock, settings, hit_sound):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_medium = pygame.font.SysFont('Arial', 36)
-    version_font = pygame.font.SysFont('Arial', 24)
+    font_big = get_font(54, bold=True)
+    font_medium = get_font(36)
 
-    options = ['Start', 'Settings', 'Tutorial', 'About', 'Quit']
-    selected = 0
-    running = True
-
-    while running:
-        current_width, current_height = screen.get_size()
-        draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True) # Adjusted start color
-        
+    options = [('Retry', 'Retry'), ('Back to Maps', 'Maps'), ('Quit', 'Quit')]
+    widgets = [
+        Label(f'Map {status}!', font_big, OSU_BLUE if status == 'Completed' else (255, 50, 50)),
+        Label(f'Final Score: {final_score}', font_medium),
+    ]
+    widgets += [Button(label, font_medium, value, selected_color=OSU_BLUE) for label, value in options]
+    menu = Menu(widgets, lambda w, h: [(w//2, h//2 - 150), (w//2, h//2 - 90)] + column(w//2, h//2 - 20, len(options)))
+    return run_menu(screen, clock, menu, overlay_background(screen))
+
+
+class MainMenuScene(Scene):
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.options = ['Start', 'Settings', 'Tutorial', 'About', 'Quit']
+        widgets = [Button(label, get_font(36), selected_color=OSU_BLUE) for label in self.options]
+        widgets.append(Label(f'v{VERSION}', get_font(24), OSU_LIGHT_GREY, anchor='bottomright'))
+        self.menu = Menu(widgets, lambda w, h: column(w//2, h//2 + 40, len(self.options)) + [(w-10, h-10)])
+        # The logo and its glow are rendered once and only scaled per frame
+        self.title_base = get_font(54, bold=True).render('osu!python', True, OSU_BLUE)
+        self.glow_base = get_font(54, bold=True).render('osu!python', True, (0, 180, 255, 30))
+
+    def draw_logo(self, surface):
+        draw_menu_background(surface)
+        current_width, current_height = LAYOUT.size
         # Smoother animation for logo
         time_ms = pygame.time.get_ticks()
         # Scale oscillates between 1.05 and 1.10
-        scale = 1.05 + 0.05 * (math.sin(time_ms / 300.0) * 0.5 + 0.5) 
-        
-        title = font_big.render('osu!python', True, OSU_BLUE)
-        title = pygame.transform.rotozoom(title, 0, scale)
+        scale = 1.05 + 0.05 * (math.sin(time_ms / 300.0) * 0.5 + 0.5)
+        title = pygame.transform.rotozoom(self.title_base, 0, scale)
         title_rect = title.get_rect(center=(current_width//2, current_height//2 - 120))
         for glow in range(8, 0, -2):
-            glow_surf = font_big.render('osu!python', True, (0, 180, 255, 30))
-            glow_surf = pygame.transform.rotozoom(glow_surf, 0, scale + glow*0.01)
-            glow_rect = glow_surf.get_rect(center=title_rect.center)
-            screen.blit(glow_surf, glow_rect)
-        screen.blit(title, title_rect)
-        for i, opt_label in enumerate(options):
-            is_selected = (i == selected) # Use OSU_BLUE for selected text
-            color = OSU_BLUE if is_selected else OSU_WHITE
-            btn_c1 = OSU_BLUE if is_selected else OSU_MEDIUM_GREY
-            btn_c2 = OSU_DARK_BLUE if is_selected else OSU_DARK_GREY
-
-            text_surface = font_medium.render(opt_label, True, color)
-            rect = text_surface.get_rect(center=(current_width//2, current_height//2 + 40 + i*60))
-            
-            draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-            pygame.draw.rect(screen, (255,255,255,180), rect.inflate(40, 10), 2, border_radius=12)
-            screen.blit(text_surface, rect)
-
+            glow_surf = pygame.transform.rotozoom(self.glow_base, 0, scale + glow*0.01)
+            surface.blit(glow_surf, glow_surf.get_rect(center=title_rect.center))
+        surface.blit(title, title_rect)
+        request_frame(1000 // MENU_ANIMATION_FPS) # The pulse never rests
+
+    def run(self, screen, clock):
+        # Start is the likely next step, so have the maps menu built by then
+        self.manager.preload('maps')
         # Holiday Greeting System
-        draw_holiday_elements(screen, font_medium)
-
-        version_text = version_font.render(f'v{VERSION}', True, (180, 180, 180))
-        version_rect = version_text.get_rect(bottomright=(current_width-10, current_height-10))
-        screen.blit(version_text, version_rect)
-
-        # Custom cursor
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2): # Outer glow
-                pygame.draw.circle(screen, OSU_BLUE + (30,), (mx, my), r, 2)
-            pygame.draw.circle(screen, OSU_WHITE, (mx, my), 16, 2) # Inner circle
-
-        pygame.display.flip()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected = (selected - 1) % len(options)
-                elif event.key == pygame.K_DOWN:
-                    selected = (selected + 1) % len(options)
-                elif event.key == pygame.K_RETURN:
-                    if options[selected] == 'Start':
-                        return settings
-                    elif options[selected] == 'Settings':
-                        settings = settings_menu(screen, clock, settings) # Pass and receive updated settings
-                    elif options[selected] == 'Tutorial':
-                        tutorial_screen(screen, clock, hit_sound)
-                    elif options[selected] == 'About':
-                        about_screen(screen, clock)
-                    elif options[selected] == 'Quit':
-                        pygame.quit()
-                        sys.exit()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for i, opt_label in enumerate(options):
-                    text_surface = font_medium.render(opt_label, True, (255,255,255))
-                    rect = text_surface.get_rect(center=(current_width//2, current_height//2 + 40 + i*60))
-                    if rect.inflate(40, 10).collidepoint(event.pos):
-                        if options[i] == 'Start':
-                            return settings
-                        elif options[i] == 'Settings':
-                            settings = settings_menu(screen, clock, settings) # Pass and receive updated settings
-                        elif options[i] == 'Tutorial':
-                            tutorial_screen(screen, clock, hit_sound)
-                        elif options[i] == 'About':
-                            about_screen(screen, clock)
-                        elif options[i] == 'Quit':
-                            pygame.quit()
-                            sys.exit()
-        clock.tick(FPS)
-
-def maps_menu(screen, clock):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
-    font_medium = pygame.font.SysFont('Arial', 36)
-    version_font = pygame.font.SysFont('Arial', 24)
-
-    maps_dir = os.path.join(os.path.dirname(__file__), 'maps')
-    os.makedirs(maps_dir, exist_ok=True)
-
-    map_files = []
-    for root, _, files in os.walk(maps_dir):
-        for file in files:
-            if file.endswith('.osu') or file.endswith('.osz') or file.endswith('.txt'):
-                map_files.append(os.path.join(root, file))
-
-    options = [{'label': os.path.splitext(os.path.basename(f))[0], 'path': f} for f in map_files]
-    options.append({'label': 'Back to Main Menu', 'path': None})
-    options.append({'label': 'Change Gamemode', 'path': None})
-
-    selected = 0
-    running = True
-
-    while running:
-        current_width, current_height = screen.get_size()
-        draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True)
-        title = font_big.render('Select a Map', True, OSU_BLUE)
-        title_rect = title.get_rect(center=(current_width//2, 80))
-        screen.blit(title, title_rect)
-
-        for i, opt in enumerate(options):
-            is_selected = (i == selected)
-            color = OSU_YELLOW if is_selected else OSU_WHITE
-            btn_c1 = OSU_BLUE if is_selected else OSU_MEDIUM_GREY
-            btn_c2 = OSU_DARK_BLUE if is_selected else OSU_DARK_GREY
-
-            text_surface = font_medium.render(opt['label'], True, color)
-            rect = text_surface.get_rect(center=(current_width//2, 180 + i*60))
+        choice = run_menu(screen, clock, self.menu, self.draw_logo, lambda surface: draw_holiday_elements(surface, get_font(36)))
+        transitions = {'Start': 'maps', 'Settings': 'settings', 'Tutorial': 'tutorial', 'About': 'about'}
+        if choice in transitions:
+            return (transitions[choice], {})
+        return None # Quit
+
+class VirtualList:
+    """Scrollable list that only renders the rows inside its viewport plus a small overscan.
+    Rows share one fixed size, so surfaces of rows scrolled out of view are recycled for
+    the rows scrolling in. Frame cost depends on the viewport height, not the item count."""
+    def __init__(self, font, tag_font=None, row_height=60, overscan=2, max_row_width=700):
+        self.font = font
+        self.tag_font = tag_font
+        self.row_height = row_height
+        self.overscan = overscan
+        self.max_row_width = max_row_width
+        self.labels = []
+        self.tags = []            # Optional small caption per row, e.g. the first row of a group
+        self.selected = 0
+        self.scroll = 0.0         # Current scroll offset in pixels
+        self.target_scroll = 0.0  # Where smooth scrolling is heading
+        self.row_size = None
+        self.rows = {}            # index -> ((label, tag, is_selected), surface) for rows near the viewport
+        self.free_surfaces = []   # Recycled row surfaces
+
+    def set_labels(self, labels, tags=None):
+        self.labels = list(labels)
+        self.tags = list(tags) if tags is not None else [''] * len(self.labels)
+        self.selected = min(self.selected, max(0, len(self.labels) - 1))
+        self._release_rows(lambda i: True)
+
+    def _release_rows(self, should_release):
+        for i in [i for i in self.rows if should_release(i)]:
+            self.free_surfaces.append(self.rows.pop(i)[1])
+
+    def _row_surface(self, i):
+        label, tag, is_selected = self.labels[i], self.tags[i], i == self.selected
+        cached = self.rows.get(i)
+        if cached and cached[0] == (label, tag, is_selected):
+            return cached[1]
+        if cached:
+            surface = cached[1]
+        elif self.free_surfaces:
+            surface = self.free_surfaces.pop()
+        else:
+            surface = pygame.Surface(self.row_size, pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 0))
+        width, height = self.row_size[0] - 8, self.row_size[1] - 8
+        color = OSU_YELLOW if is_selected else OSU_WHITE
+        btn_c1 = OSU_BLUE if is_selected else OSU_MEDIUM_GREY
+        btn_c2 = OSU_DARK_BLUE if is_selected else OSU_DARK_GREY
+        draw_rounded_gradient(surface, (4, 4, width, height), btn_c1, btn_c2, radius=12, vertical=False)
+        pygame.draw.rect(surface, (255,255,255,180), (4, 4, width, height), 2, border_radius=12)
+        text_surface = self.font.render(label, True, color)
+        text_rect = text_surface.get_rect(center=(4 + width // 2, 4 + height // 2))
+        if text_rect.width > width - 28: # Long titles are cut off at the button edge
+            text_rect.left = 18
+            surface.blit(text_surface, text_rect, area=pygame.Rect(0, 0, width - 28, text_rect.height))
+        else:
+            surface.blit(text_surface, text_rect)
+        if tag and self.tag_font:
+            surface.blit(self.tag_font.render(tag, True, OSU_LIGHT_BLUE), (16, 6))
+        self.rows[i] = ((label, tag, is_selected), surface)
+        return surface
 
-            draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-            pygame.draw.rect(screen, (255,255,255,180), rect.inflate(40, 10), 2, border_radius=12)
-            screen.blit(text_surface, rect)
-        version_text = version_font.render(f'v{VERSION}', True, OSU_LIGHT_GREY)
-        version_rect = version_text.get_rect(bottomright=(current_width-10, current_height-10))
-        screen.blit(version_text, version_rect)
+    def max_scroll(self, viewport_height):
+        return max(0.0, len(self.labels) * self.row_height - viewport_height)
 
-        if SETTINGS['custom_cursor']:
-            mx, my = pygame.mouse.get_pos()
-            for r in range(20, 8, -2):
-                pygame.draw.circle(screen, OSU_BLUE + (30,), (mx, my), r, 2)
-            pygame.draw.circle(screen, OSU_WHITE, (mx, my), 16, 2)
+    def scroll_by(self, pixels, viewport_height):
+        self.target_scroll = min(max(self.target_scroll + pixels, 0.0), self.max_scroll(viewport_height))
 
-        pygame.display.flip()
+    def select(self, index, viewport_height):
+        if not self.labels:
+            return
+        self.selected = min(max(index, 0), len(self.labels) - 1)
+        # Scroll just enough to bring the selection into view
+        top = self.selected * self.row_height
+        if top < self.target_scroll:
+            self.target_scroll = top
+        elif top + self.row_height > self.target_scroll + viewport_height:
+            self.target_scroll = top + self.row_height - viewport_height
+        self.target_scroll = min(max(self.target_scroll, 0.0), self.max_scroll(viewport_height))
+
+    def page_size(self, viewport_height):
+        return max(1, viewport_height // self.row_height)
+
+    def update(self, dt_ms):
+        # Ease towards the target so wheel and keyboard scrolling glide instead of jumping
+        self.scroll += (self.target_scroll - self.scroll) * min(1.0, dt_ms / 80.0)
+        if abs(self.target_scroll - self.scroll) < 0.5:
+            self.scroll = self.target_scroll
+
+    def index_at(self, pos, rect):
+        if not rect.collidepoint(pos):
+            return None
+        i = int((pos[1] - rect.top + self.scroll) // self.row_height)
+        row_left = rect.centerx - self.row_size[0] // 2 if self.row_size else rect.left
+        if 0 <= i < len(self.labels) and row_left <= pos[0] < row_left + (self.row_size or rect.size)[0]:
+            return i
+        return None
+
+    def draw(self, surface, rect):
+        row_size = (min(self.max_row_width, rect.width - 40) + 8, self.row_height - 10 + 8)
+        if row_size != self.row_size:
+            self.row_size = row_size
+            self.rows.clear()
+            self.free_surfaces.clear()
+        first = max(0, int(self.scroll // self.row_height) - self.overscan)
+        last = min(len(self.labels), int((self.scroll + rect.height) // self.row_height) + 1 + self.overscan)
+        self._release_rows(lambda i: i < first or i >= last)
+        previous_clip = surface.get_clip()
+        surface.set_clip(rect)
+        row_x = rect.centerx - self.row_size[0] // 2
+        row_margin = (self.row_height - self.row_size[1]) // 2
+        for i in range(first, last):
+            row_y = rect.top + i * self.row_height - int(self.scroll) + row_margin
+            surface.blit(self._row_surface(i), (row_x, row_y))
+        surface.set_clip(previous_clip)
+
+class MapsMenuScene(Scene):
+    """The map list. Its library view, search, sort and selection survive between visits,
+    so returning from a map lands on the same entry without rebuilding anything."""
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.gamemode_options = ['osu!standard', 'osu!mania', 'osu!taiko']
+        self.gamemode_menu = Menu([Label('Select Gamemode', get_font(54, bold=True), OSU_BLUE)] + [Button(mode, get_font(36)) for mode in self.gamemode_options],
+                                  lambda w, h: [(w//2, 80)] + column(w//2, 180, len(self.gamemode_options)), cancel='Cancel')
+        self.map_list = VirtualList(get_font(36), get_font(16))
+        self.search_label = Label('', get_font(24))
+        self.header = Menu([Label('Select a Map', get_font(54, bold=True), OSU_BLUE), self.search_label, Label(f'v{VERSION}', get_font(24), OSU_LIGHT_GREY, anchor='bottomright')],
+                           lambda w, h: [(w//2, 80), (w//2, 118), (w-10, h-10)])
+        self.options = None
+        self.search_index = None
+        self.search_query = ''
+        self.sort_key = SETTINGS['map_sort']
+        self.visible, self.tags = [], []
+        self.list_rect_layout = None
+        self.cached_list_rect = None
+
+    def select_gamemode(self, screen, clock):
+        current = SETTINGS.get('gamemode', 'osu!standard')
+        self.gamemode_menu.select(self.gamemode_options.index(current) if current in self.gamemode_options else 0)
+        choice = run_menu(screen, clock, self.gamemode_menu)
+        if choice in self.gamemode_options:
+            SETTINGS['gamemode'] = choice
+
+    def build_options(self):
+        self.options = [dict(entry) for entry in library_entries()]
+        self.options.append({'label': 'Back to Main Menu', 'path': None})
+        self.options.append({'label': 'Change Gamemode', 'path': None})
+        self.search_index = MapSearchIndex(self.options[:-2])
+
+    def filter_options(self):
+        """Updates the visible options and their group captions for the current search and sort."""
+        entries = self.options[:-2]
+        ids = self.search_index.search(self.search_query)
+        sort = _MAP_SORT_CACHE.get(self.sort_key, entries)
+        if self.search_index.last_exact: # Fuzzy matches stay ranked by relevance
+            mask = np.zeros(len(entries), dtype=bool)
+            mask[ids] = True
+            ids = sort['order'][mask[sort['order']]]
+        visible, tags, previous_group = [], [], None
+        for i in ids.tolist():
+            group = sort['groups'][i]
+            visible.append(entries[i])
+            tags.append(group if group != previous_group else '')
+            previous_group = group
+        # The two action entries at the end are always listed
+        self.visible, self.tags = visible + self.options[-2:], tags + ['', '']
+        self.map_list.set_labels((opt['label'] for opt in self.visible), self.tags)
+
+    def selected_key(self):
+        if not self.visible:
+            return None
+        opt = self.visible[self.map_list.selected]
+        return (opt['path'], opt['label'])
+
+    def refresh_list(self, viewport_height, keep=None):
+        """Refilters the list and keeps the entry identified by `keep` selected if it is still listed."""
+        self.filter_options()
+        self.map_list.select(next((i for i, opt in enumerate(self.visible) if (opt['path'], opt['label']) == keep), 0), viewport_height)
+
+    def list_rect(self):
+        if self.list_rect_layout != LAYOUT.version:
+            self.list_rect_layout = LAYOUT.version
+            self.cached_list_rect = pygame.Rect(0, 130, LAYOUT.width, max(60, LAYOUT.height - 170))
+            # Keep the selection in view in the resized viewport
+            self.map_list.select(self.map_list.selected, self.cached_list_rect.height)
+        return self.cached_list_rect
+
+    def run(self, screen, clock):
+        os.makedirs(MAPS_DIR, exist_ok=True)
+        # Only files that were added, changed or removed since the last visit get re-parsed
+        if scan_map_library() or self.options is None:
+            keep = self.selected_key()
+            self.build_options()
+            self.refresh_list(self.list_rect().height, keep)
+        map_list = self.map_list
+
+        selection_changed_at = pygame.time.get_ticks()
+        dt = 0
+        while True:
+            screen = apply_pending_resize(screen)
+            list_rect = self.list_rect()
+            selected = map_list.selected
+            # Start preparing the map once the selection has settled on it
+            if pygame.time.get_ticks() - selection_changed_at >= PRELOAD_SETTLE_TIME:
+                if self.visible[selected]['path']:
+                    self.manager.preload('play', entry=self.visible[selected])
+                    _AUDIO_PREVIEW.request(self.visible[selected])
+                else:
+                    _MAP_PRELOADER.cancel()
+                    _AUDIO_PREVIEW.stop()
+            _AUDIO_PREVIEW.update()
+            if pygame.time.get_ticks() - _MAP_LIBRARY['last_scan'] >= LIBRARY_RESCAN_INTERVAL:
+                if scan_map_library():
+                    # Keep the same map selected if it survived the rescan
+                    keep = self.selected_key()
+                    self.build_options()
+                    self.refresh_list(list_rect.height, keep)
+                    selection_changed_at = pygame.time.get_ticks()
+            map_list.update(dt)
+
+            sort_caption = f"Sort: {MAP_SORT_NAMES[self.sort_key]} (Tab)  |  Mod: {rate_mod_name(SETTINGS['rate_mod'])} (F1)"
+            if self.search_query:
+                self.search_label.text = f'Search: {self.search_query}  ({len(self.visible) - 2} found)  |  {sort_caption}'
+                self.search_label.color = OSU_LIGHT_GREY
+            else:
+                self.search_label.text = f'Type to search  |  {sort_caption}'
+                self.search_label.color = OSU_MEDIUM_GREY
+
+            draw_menu_background(screen)
+            position = _AUDIO_PREVIEW.position()
+            analysis = _AUDIO_PREVIEW.analysis
+            if position is not None and analysis is not None:
+                draw_spectrum_background(screen, analysis.bands_at(position))
+            self.header.draw(screen)
+            map_list.draw(screen, list_rect)
+            if analysis is not None:
+                # Waveform of the previewed song with the preview's position on it
+                strip_rect = pygame.Rect(10, list_rect.bottom + 8, max(1, LAYOUT.width - 140), 24)
+                screen.blit(analysis.waveform_strip(strip_rect.size), strip_rect)
+                if position is not None:
+                    marker_x = strip_rect.left + strip_rect.width * min(position, analysis.length_ms()) // max(1, analysis.length_ms())
+                    pygame.draw.line(screen, OSU_BLUE, (marker_x, strip_rect.top), (marker_x, strip_rect.bottom))
+            draw_menu_cursor(screen)
+            pygame.display.flip()
+
+            # Only wake up early for things that are actually pending
+            now = pygame.time.get_ticks()
+            if map_list.scroll != map_list.target_scroll:
+                request_frame(1000 // FPS)
+            if now - selection_changed_at < PRELOAD_SETTLE_TIME:
+                request_frame(selection_changed_at + PRELOAD_SETTLE_TIME - now)
+            if _AUDIO_PREVIEW.waiting():
+                request_frame(50) # Poll for the preview clip to finish decoding
+            if position is not None and analysis is not None:
+                request_frame(1000 // MENU_ANIMATION_FPS) # Keep the visualizer moving with the music
+            request_frame(_MAP_LIBRARY['last_scan'] + LIBRARY_RESCAN_INTERVAL - now)
+
+            activated = None
+            search_changed = False
+            for event in wait_for_menu_events():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
+                elif event.type == pygame.VIDEORESIZE:
+                    queue_resize(event)
+                elif event.type == pygame.MOUSEWHEEL:
+                    map_list.scroll_by(-event.y * map_list.row_height, list_rect.height)
+                elif event.type == pygame.TEXTINPUT:
+                    self.search_query += event.text
+                    search_changed = True
+                elif event.type == pygame.KEYDOWN:
+                    page = map_list.page_size(list_rect.height)
+                    moves = {
+                        pygame.K_UP: (map_list.selected - 1) % len(self.visible),
+                        pygame.K_DOWN: (map_list.selected + 1) % len(self.visible),
+                        pygame.K_PAGEUP: map_list.selected - page,
+                        pygame.K_PAGEDOWN: map_list.selected + page,
+                        pygame.K_HOME: 0,
+                        pygame.K_END: len(self.visible) - 1,
+                    }
+                    if event.key in moves:
+                        map_list.select(moves[event.key], list_rect.height)
+                        selection_changed_at = pygame.time.get_ticks()
+                    elif event.key == pygame.K_BACKSPACE and self.search_query:
+                        self.search_query = self.search_query[:-1]
+                        search_changed = True
+                    elif event.key == pygame.K_ESCAPE and self.search_query:
+                        self.search_query = ''
+                        search_changed = True
+                    elif event.key == pygame.K_TAB:
+                        # Cycle the sort order; the permutation for each key is cached
+                        self.sort_key = MAP_SORT_KEYS[(MAP_SORT_KEYS.index(self.sort_key) + 1) % len(MAP_SORT_KEYS)]
+                        SETTINGS['map_sort'] = self.sort_key
+                        self.refresh_list(list_rect.height, self.selected_key())
+                    elif event.key == pygame.K_F1:
+                        SETTINGS['rate_mod'] = RATE_MOD_CYCLE[(RATE_MOD_CYCLE.index(SETTINGS['rate_mod']) + 1) % len(RATE_MOD_CYCLE)]
+                        selection_changed_at = pygame.time.get_ticks() # Preload again, with the new mod
+                    elif event.key == pygame.K_RETURN:
+                        activated = map_list.selected
+                elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    activated = map_list.index_at(event.pos, list_rect)
+                    if activated is not None:
+                        map_list.select(activated, list_rect.height)
+
+                if search_changed:
+                    # Refilter right away so a following Enter acts on the new results
+                    self.refresh_list(list_rect.height)
+                    selection_changed_at = pygame.time.get_ticks()
+                    search_changed = False
+
+            if activated is not None:
+                opt = self.visible[activated]
+                if opt['path'] is None:  # Handle special actions
+                    if opt['label'] == 'Back to Main Menu':
+                        _MAP_PRELOADER.cancel()
+                        _AUDIO_PREVIEW.stop()
+                        return ('main_menu', {})
+                    elif opt['label'] == 'Change Gamemode':
+                        self.select_gamemode(screen, clock)
+                else:
+                    _AUDIO_PREVIEW.stop()
+                    return ('play', {'entry': opt})
+            dt = clock.tick(FPS)
+
+def open_archive_audio(z, member):
+    """Returns (file_object, keep_archive_open) for an audio member of an open .osz.
+    Small members are read into memory, large ones are streamed straight from the zip."""
+    if z.getinfo(member).file_size <= MAX_BUFFERED_AUDIO_BYTES:
+        return io.BytesIO(z.read(member)), False
+    return z.open(member), True
+
+def audio_cache_dir():
+    return os.path.join(os.path.dirname(LIBRARY_INDEX_PATH), 'audio_cache')
+
+def audio_digest(crc, size):
+    """Content address of an audio file from its CRC-32 and size (as recorded in the zip
+    for archive members), so maps that ship the same song share cache entries."""
+    return hashlib.sha1(f'{crc:08x}:{size}'.encode('ascii')).hexdigest()[:24]
+
+def decoded_audio_key(crc, size):
+    """Cache key of a song decoded for the current mixer: its audio_digest plus the sample
+    rate and channel count."""
+    frequency, _, channels = pygame.mixer.get_init()
+    return f'{audio_digest(crc, size)}-{frequency}-{channels}'
+
+def archive_audio_key(map_filepath, member):
+    with zipfile.ZipFile(map_filepath, 'r') as z:
+        info = z.getinfo(member)
+    return decoded_audio_key(info.CRC, info.file_size)
+
+def file_checksum(path):
+    """(CRC-32, size) of a loose file, computed the way zip records them for members."""
+    crc, size = 0, 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return crc, size
+
+def file_audio_key(path):
+    """decoded_audio_key for a loose audio file, so it matches the same song inside an .osz."""
+    return decoded_audio_key(*file_checksum(path))
+
+def lookup_decoded_audio(key):
+    """Path of the cached WAV for a key, or None. A hit counts as a use for LRU eviction."""
+    path = os.path.join(audio_cache_dir(), key + '.wav')
+    if not os.path.exists(path):
+        return None
+    try:
+        os.utime(path) # The mtime doubles as the last-use time
+    except OSError:
+        pass
+    return path
+
+def write_wav(path, samples, frequency):
+    """Writes 16-bit samples through a temporary file, so a cached WAV is never half-written."""
+    with wave.open(path + '.tmp', 'wb') as w:
+        w.setnchannels(samples.shape[1] if samples.ndim == 2 else 1)
+        w.setsampwidth(2)
+        w.setframerate(frequency)
+        w.writeframes(np.ascontiguousarray(samples, dtype=np.int16).tobytes())
+    os.replace(path + '.tmp', path)
+
+def evict_audio_cache(max_bytes=AUDIO_CACHE_BYTES, keep=None):
+    """Removes the least recently used cached WAVs until the cache fits max_bytes, sparing keep."""
+    try:
+        with os.scandir(audio_cache_dir()) as it:
+            cached = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in it if e.name.endswith('.wav')]
+    except OSError:
+        return
+    total = sum(size for _, size, _ in cached)
+    for _, size, path in sorted(cached):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            print(f"Could not evict cached audio {path}: {e}")
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    selected = (selected - 1) % len(options)
-                elif event.key == pygame.K_DOWN:
-                    selected = (selected + 1) % len(options)
-                elif event.key == pygame.K_RETURN:
-                    if options[selected]['path'] is None:  # Handle special actions
-                        if options[selected]['label'] == 'Back to Main Menu':
-                            return None
-                        elif options[selected]['label'] == 'Change Gamemode':
-                            gamemode_options = ['osu!standard', 'osu!mania', 'osu!taiko']
-                            gamemode_selected = 0
-                            changing_gamemode = True
-                            while changing_gamemode:
-                                current_width, current_height = screen.get_size()
-                                draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True)
-                                title = font_big.render('Select Gamemode', True, OSU_BLUE)
-                                title_rect = title.get_rect(center=(current_width//2, 80))
-                                screen.blit(title, title_rect)
-
-                                for i, mode in enumerate(gamemode_options):
-                                    is_selected = (i == gamemode_selected)
-                                    color = OSU_YELLOW if is_selected else OSU_WHITE
-                                    btn_c1 = OSU_BLUE if is_selected else OSU_MEDIUM_GREY
-                                    btn_c2 = OSU_DARK_BLUE if is_selected else OSU_DARK_GREY
-
-                                    text_surface = font_medium.render(mode, True, color)
-                                    rect = text_surface.get_rect(center=(current_width//2, 180 + i*60))
-
-                                    draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-                                    pygame.draw.rect(screen, (255,255,255,180), rect.inflate(40, 10), 2, border_radius=12)
-                                    screen.blit(text_surface, rect)
-
-                                pygame.display.flip()
-
-                                for event in pygame.event.get():
-                                    if event.type == pygame.QUIT:
-                                        pygame.quit()
-                                        sys.exit()
-                                    elif event.type == pygame.KEYDOWN:
-                                        if event.key == pygame.K_UP:
-                                            gamemode_selected = (gamemode_selected - 1) % len(gamemode_options)
-                                        elif event.key == pygame.K_DOWN:
-                                            gamemode_selected = (gamemode_selected + 1) % len(gamemode_options)
-                                        elif event.key == pygame.K_RETURN:
-                                            SETTINGS['gamemode'] = gamemode_options[gamemode_selected]
-                                            changing_gamemode = False
-                                        elif event.key == pygame.K_ESCAPE:
-                                            changing_gamemode = False
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for i, opt in enumerate(options):
-                    text_surface = font_medium.render(opt['label'], True, OSU_WHITE)
-                    rect = text_surface.get_rect(center=(current_width//2, 180 + i*60))
-                    if rect.inflate(40, 10).collidepoint(event.pos):
-                        if opt['path'] is None:  # Handle special actions
-                            if opt['label'] == 'Back to Main Menu':
-                                return None
-                            elif opt['label'] == 'Change Gamemode':
-                                gamemode_options = ['osu!standard', 'osu!mania', 'osu!taiko']
-                                gamemode_selected = 0
-                                changing_gamemode = True
-                                while changing_gamemode:
-                                    current_width, current_height = screen.get_size()
-                                    draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True)
-                                    title = font_big.render('Select Gamemode', True, OSU_BLUE)
-                                    title_rect = title.get_rect(center=(current_width//2, 80))
-                                    screen.blit(title, title_rect)
-
-                                    for i, mode in enumerate(gamemode_options):
-                                        is_selected = (i == gamemode_selected)
-                                        color = OSU_YELLOW if is_selected else OSU_WHITE
-                                        btn_c1 = OSU_BLUE if is_selected else OSU_MEDIUM_GREY
-                                        btn_c2 = OSU_DARK_BLUE if is_selected else OSU_DARK_GREY
-
-                                        text_surface = font_medium.render(mode, True, color)
-                                        rect = text_surface.get_rect(center=(current_width//2, 180 + i*60))
-
-                                        draw_rounded_gradient(screen, rect.inflate(40, 10), btn_c1, btn_c2, radius=12, vertical=False)
-                                        pygame.draw.rect(screen, (255,255,255,180), rect.inflate(40, 10), 2, border_radius=12)
-                                        screen.blit(text_surface, rect)
-
-                                    pygame.display.flip()
-
-                                    for event in pygame.event.get():
-                                        if event.type == pygame.QUIT:
-                                            pygame.quit()
-                                            sys.exit()
-                                        elif event.type == pygame.KEYDOWN:
-                                            if event.key == pygame.K_UP:
-                                                gamemode_selected = (gamemode_selected - 1) % len(gamemode_options)
-                                            elif event.key == pygame.K_DOWN:
-                                                gamemode_selected = (gamemode_selected + 1) % len(gamemode_options)
-                                            elif event.key == pygame.K_RETURN:
-                                                SETTINGS['gamemode'] = gamemode_options[gamemode_selected]
-                                                changing_gamemode = False
-                                            elif event.key == pygame.K_ESCAPE:
-                                                changing_gamemode = False
-                        else:
-                            return opt['path']
-        clock.tick(FPS)
+def decode_with_optional_libraries(path, frequency):
+    """Decodes a file pygame cannot load into int16 samples, shaped (frames, channels).
+    soundfile is tried first since it is fast, librosa (through audioread/ffmpeg) handles
+    the formats libsndfile lacks, such as AAC. Returns (samples, sample rate)."""
+    try:
+        import soundfile
+        samples, rate = soundfile.read(path, dtype='int16', always_2d=True)
+        return samples, rate
+    except ImportError:
+        pass
+    except RuntimeError: # libsndfile does not know the format
+        pass
+    try:
+        import librosa
+    except ImportError:
+        raise RuntimeError("converting this format needs soundfile or librosa (see requirements.txt)")
+    samples, rate = librosa.load(path, sr=frequency, mono=False)
+    samples = samples.T if samples.ndim == 2 else samples[:, None]
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16), rate
+
+def decode_with_pygame(path, frequency):
+    """Decodes anything pygame can load, inside a worker process that has no mixer of its own."""
+    if not pygame.mixer.get_init():
+        os.environ['SDL_AUDIODRIVER'] = 'dummy' # Decoding only, the worker must not open the audio device
+        pygame.mixer.init(frequency, -16, 2)
+    samples = pygame.sndarray.array(pygame.mixer.Sound(path))
+    return (samples if samples.ndim == 2 else samples[:, None]), pygame.mixer.get_init()[0]
+
+def change_playback_rate(samples, rate, keep_pitch):
+    """Renders int16 samples (frames, channels) so that playing them at the original sample
+    rate sounds `rate` times as fast. Keeping the pitch needs librosa's phase vocoder;
+    without librosa the samples are resampled, which shifts the pitch as well."""
+    if keep_pitch:
+        try:
+            import librosa
+            stretched = librosa.effects.time_stretch(samples.T.astype(np.float32) / 32768.0, rate=rate)
+            return (np.clip(stretched.T, -1.0, 1.0) * 32767).astype(np.int16)
+        except ImportError:
+            print("librosa is not installed, so the rate change will shift the pitch too.")
+    # Read the samples at `rate` times the speed, interpolating linearly per channel
+    positions = np.arange(int(len(samples) / rate)) * rate
+    frames = np.arange(len(samples))
+    return np.column_stack([np.interp(positions, frames, samples[:, c]) for c in range(samples.shape[1])]).astype(np.int16)
+
+def transcode_audio(map_filepath, member, out_path, frequency, rate=1.0, keep_pitch=True):
+    """Runs in a worker process: converts one song to a WAV at out_path, played back at
+    `rate` if it is not 1. member is the archive member for .osz maps, None when
+    map_filepath is the audio file itself."""
+    source = map_filepath
+    if member is not None:
+        # audioread only reads real files, so the member goes next to its output for the duration
+        source = out_path + '.source' + os.path.splitext(member)[1]
+        with zipfile.ZipFile(map_filepath, 'r') as z, z.open(member) as f, open(source, 'wb') as out:
+            shutil.copyfileobj(f, out)
+    try:
+        if source.lower().endswith(TRANSCODE_EXTENSIONS):
+            samples, sample_rate = decode_with_optional_libraries(source, frequency)
+        else:
+            samples, sample_rate = decode_with_pygame(source, frequency)
+        if rate != 1.0:
+            samples = change_playback_rate(samples, rate, keep_pitch)
+        write_wav(out_path, samples, sample_rate)
+    finally:
+        if member is not None and os.path.exists(source):
+            os.remove(source)
+    return out_path
+
+def song_audio_source(map_path, audio_filename):
+    """Where a map's song lives: (path, archive member or None, decoded_audio_key), or None."""
+    if not audio_filename:
+        return None
+    try:
+        if map_path.endswith('.osz'):
+            return map_path, audio_filename, archive_audio_key(map_path, audio_filename)
+        audio_path = os.path.join(os.path.dirname(map_path), audio_filename)
+        if os.path.exists(audio_path):
+            return audio_path, None, file_audio_key(audio_path)
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        print(f"Could not read {audio_filename} from {map_path}: {e}")
     return None
 
-def play_game(screen, clock, map_filepath, map_name, hit_sound):
-    global current_audio_temp_file
-    hitobjects, map_name_from_file = load_map(map_filepath)
-    if not hitobjects:
-        print(f"No hitobjects found in map: {map_filepath}")
-        return 'Maps' # Go back to maps menu
+class AudioTranscoder:
+    """Converts songs in formats pygame cannot play, and renders rate mod audio, into the
+    audio cache on a worker process, so decoding never competes with the game loop.
+    Conversions are queued by library scans, decoded songs by playing a map and rate mod
+    audio by the selected map."""
+    def __init__(self):
+        self.executor = None
+        self.pending = {}       # Output path -> (map path, Future)
+        self.failed = set()     # Output paths that could not be converted this session
+        self.rate_job = None    # Output path of the latest rate mod job, the only one worth waiting for
+
+    def submit(self, map_filepath, member, key, rate=1.0, keep_pitch=True):
+        """Queues a job unless its output exists or is on its way. Returns the output path."""
+        out_path = os.path.join(audio_cache_dir(), key + '.wav')
+        if out_path in self.pending or out_path in self.failed or lookup_decoded_audio(key):
+            return out_path
+        os.makedirs(audio_cache_dir(), exist_ok=True)
+        if self.executor is None:
+            # Spawned rather than forked: forking a process that runs SDL's threads is unsafe
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        print(f"Converting {member or map_filepath}{f' to {rate}x' if rate != 1.0 else ''} in the background.")
+        self.pending[out_path] = (map_filepath, self.executor.submit(transcode_audio, map_filepath, member, out_path,
+                                                                     pygame.mixer.get_init()[0], rate, keep_pitch))
+        return out_path
+
+    def queue_map(self, map_path):
+        """Queues the unsupported songs of one library file, found through its parsed entries."""
+        names = {entry.get('audio_filename') for entry in _MAP_LIBRARY['entries'].get(map_path, [])}
+        for name in names:
+            if name and name.lower().endswith(TRANSCODE_EXTENSIONS):
+                song = song_audio_source(map_path, name)
+                if song is not None:
+                    self.submit(*song)
+
+    def queue_decoded(self, entry):
+        """Queues a map's archived song for the decoded audio cache, so the next play loads a
+        WAV instead of decoding the archive member. Only played maps are queued, browsing the
+        menu leaves the cache to the songs that actually get played."""
+        if not entry['path'].endswith('.osz') or not entry.get('audio_filename'):
+            return # Loose songs are read from disk directly, keying them would only cost a checksum
+        song = song_audio_source(entry['path'], entry['audio_filename'])
+        if song is not None:
+            self.submit(*song)
+
+    def queue_rate(self, entry, mod):
+        """Queues the audio of a map entry rendered for a rate mod, cached per (song, mod).
+        Returns the path it will be written to, or None if the map has no song."""
+        song = song_audio_source(entry['path'], entry.get('audio_filename'))
+        if song is None:
+            return None
+        path, member, key = song
+        # Start from the decoded song when the cache has it, that is the cheapest to read
+        decoded = lookup_decoded_audio(key)
+        if decoded is not None:
+            path, member = decoded, None
+        out_path = os.path.join(audio_cache_dir(), f'{key}-{mod.lower()}.wav')
+        if self.rate_job != out_path and self.rate_job in self.pending:
+            # The selection moved on: drop the previous render unless the worker already started it
+            if self.pending[self.rate_job][1].cancel():
+                del self.pending[self.rate_job]
+        self.rate_job = out_path
+        return self.submit(path, member, f'{key}-{mod.lower()}', *RATE_MODS[mod])
+
+    def status(self, out_path):
+        """'ready', 'failed' or 'pending' for a job's output path."""
+        self.poll()
+        if out_path in self.pending:
+            return 'pending'
+        if out_path in self.failed:
+            return 'failed'
+        return 'ready' if os.path.exists(out_path) else 'failed'
+
+    def poll(self):
+        """Collects finished conversions. Called with every library scan."""
+        for out_path, (map_path, future) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[out_path]
+            try:
+                future.result()
+            except Exception as e: # Whatever the decoder raised in the worker
+                print(f"Could not convert audio for {map_path}: {e}")
+                self.failed.add(out_path)
+                continue
+            evict_audio_cache(keep=out_path)
+            _AUDIO_PREVIEW.retry(map_path)
 
-    # Sort hitobjects by time for correct playback order
-    hitobjects.sort(key=lambda x: x.time)
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
 
-    # Audio handling
-    audio_path = None
+_TRANSCODER = AudioTranscoder()
+
+def resolve_map_audio(map_filepath, difficulty=None):
+    """Finds the audio for a map (or one difficulty of an .osz) without writing anything to disk.
+    Returns (source, namehint, archive): source is a path or a file-like object, archive is
+    the ZipFile that has to stay open while the source is streamed from it (or None)."""
     map_dir = os.path.dirname(map_filepath)
     base_name_no_ext = os.path.splitext(os.path.basename(map_filepath))[0]
     if map_filepath.endswith('.osz'):
         try:
-            with zipfile.ZipFile(map_filepath, 'r') as z:
-                osu_files = [f for f in z.namelist() if f.endswith('.osu')]
-                if osu_files:
-                    with z.open(osu_files[0]) as f:
-                        osu_content = [l.decode('utf-8').strip() for l in f.readlines()]
-                        for line in osu_content:
-                            if line.startswith('AudioFilename:'):
-                                audio_filename = line.split(':', 1)[1].strip()
-                                if audio_filename in z.namelist():
-                                    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio_filename)[1]) as temp_audio:
-                                        temp_audio.write(z.read(audio_filename))
-                                        audio_path = temp_audio.name
-                                        current_audio_temp_file = audio_path
-                                    print(f"Extracted audio from .osz: {audio_filename}")
-                                    break
-                if not audio_path:
-                    for member in z.namelist():
-                        if member.endswith(('.mp3', '.ogg', '.wav')):
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(member)[1]) as temp_audio:
-                                temp_audio.write(z.read(member))
-                                audio_path = temp_audio.name
-                                current_audio_temp_file = audio_path
-                            print(f"Found and extracted generic audio from .osz: {member}")
-                            break
+            z = zipfile.ZipFile(map_filepath, 'r')
         except zipfile.BadZipFile:
             print(f"Warning: {map_filepath} is not a valid zip file. Attempting to load as plain text map.")
-            for ext in ['.mp3', '.ogg', '.wav']:
-                candidate_audio_path = os.path.join(map_dir, base_name_no_ext + ext)
-                if os.path.exists(candidate_audio_path):
-                    audio_path = candidate_audio_path
-                    print(f"Found audio in same directory as .txt map: {audio_path}")
-                    break
+        else:
+            names = z.namelist()
+            member = None
+            osu_files = [f for f in names if f.endswith('.osu')]
+            if difficulty in osu_files:
+                osu_files = [difficulty]
+            if osu_files:
+                with z.open(osu_files[0]) as f:
+                    audio_filename = parse_osu_header(l.decode('utf-8', errors='ignore') for l in f).get('AudioFilename')
+                if audio_filename in names:
+                    member = audio_filename
+                    print(f"Found audio in .osz: {audio_filename}")
+            if member is None:
+                member = next((m for m in names if m.lower().endswith(AUDIO_EXTENSIONS + TRANSCODE_EXTENSIONS)), None)
+                if member is not None:
+                    print(f"Found generic audio in .osz: {member}")
+            if member is not None:
+                # Songs decoded before are played from the cache, without touching the archive again
+                info = z.getinfo(member)
+                cached = lookup_decoded_audio(decoded_audio_key(info.CRC, info.file_size)) if pygame.mixer.get_init() else None
+                if cached is not None:
+                    z.close()
+                    return cached, member, None
+                if member.lower().endswith(TRANSCODE_EXTENSIONS):
+                    # Never converted on the gameplay path; the library scan queues it
+                    print(f"{member} has not been converted yet, playing without audio.")
+                    z.close()
+                    return None, None, None
+                source, keep_open = open_archive_audio(z, member)
+                if not keep_open:
+                    z.close()
+                return source, member, z if keep_open else None
+            z.close()
     elif map_filepath.endswith('.osu'):
         with open(map_filepath, 'r', encoding='utf-8', errors='ignore') as f:
-            for line in f:
-                if line.startswith('AudioFilename:'):
-                    audio_filename = line.split(':', 1)[1].strip()
-                    candidate_audio_path = os.path.join(map_dir, audio_filename)
-                    if os.path.exists(candidate_audio_path):
-                        audio_path = candidate_audio_path
-                        print(f"Found audio specified in .osu file: {audio_path}")
-                        break
-    if not audio_path:
-        for ext in ['.mp3', '.ogg', '.wav']:
-            candidate_audio_path = os.path.join(map_dir, base_name_no_ext + ext)
+            audio_filename = parse_osu_header(f).get('AudioFilename')
+        if audio_filename:
+            candidate_audio_path = os.path.join(map_dir, audio_filename)
+            if os.path.exists(candidate_audio_path) and audio_filename.lower().endswith(TRANSCODE_EXTENSIONS):
+                cached = lookup_decoded_audio(file_audio_key(candidate_audio_path)) if pygame.mixer.get_init() else None
+                if cached is None:
+                    print(f"{audio_filename} has not been converted yet, playing without audio.")
+                return cached, audio_filename if cached else None, None
             if os.path.exists(candidate_audio_path):
-                audio_path = candidate_audio_path
-                print(f"Found audio by map name in directory: {audio_path}")
-                break
-    if audio_path and os.path.exists(audio_path):
+                print(f"Found audio specified in .osu file: {candidate_audio_path}")
+                return candidate_audio_path, audio_filename, None
+    for ext in AUDIO_EXTENSIONS:
+        candidate_audio_path = os.path.join(map_dir, base_name_no_ext + ext)
+        if os.path.exists(candidate_audio_path):
+            print(f"Found audio by map name in directory: {candidate_audio_path}")
+            return candidate_audio_path, base_name_no_ext + ext, None
+    return None, None, None
+
+def load_music(source, namehint, archive=None):
+    """Loads a path or file-like object into pygame.mixer.music, releasing whatever was
+    streamed before. Nothing is ever extracted to a temporary file."""
+    previous_file, previous_archive = _MUSIC_SOURCE['file'], _MUSIC_SOURCE['archive']
+    pygame.mixer.music.unload()
+    for old in (previous_file, previous_archive):
+        if old is not None:
+            old.close()
+    _MUSIC_SOURCE['file'] = None if isinstance(source, str) else source
+    _MUSIC_SOURCE['archive'] = archive
+    if isinstance(source, str):
+        pygame.mixer.music.load(source)
+    else:
+        pygame.mixer.music.load(source, namehint)
+
+def close_audio_source(source, archive):
+    """Closes an audio source returned by resolve_map_audio that was never loaded."""
+    if source is not None and not isinstance(source, str):
+        source.close()
+    if archive is not None:
+        archive.close()
+
+class MapPreloader:
+    """Parses the selected map and resolves its audio on a worker thread while the user is
+    still browsing, so play_game can start without a stall. Moving the selection cancels
+    the previous preload: its worker notices the newer generation and drops its result."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.key = None       # (path, difficulty) the current generation is preparing
+        self.result = None    # Finished preload for self.key, if any
+        self.in_flight = False
+
+    def request(self, map_filepath, difficulty=None):
+        with self.condition:
+            if (map_filepath, difficulty) == self.key:
+                return
+            self._discard()
+            self.generation += 1
+            self.key = (map_filepath, difficulty)
+            self.in_flight = True
+            generation = self.generation
+        threading.Thread(target=self._work, args=(generation, map_filepath, difficulty), daemon=True).start()
+
+    def cancel(self):
+        with self.condition:
+            if self.key is None:
+                return
+            self._discard()
+            self.generation += 1
+            self.key = None
+            self.in_flight = False
+            self.condition.notify_all()
+
+    def take(self, map_filepath, difficulty=None):
+        """Returns the preload for a map, waiting for it if it is still being prepared.
+        Returns None if that map was never requested."""
+        with self.condition:
+            if (map_filepath, difficulty) != self.key:
+                return None
+            while self.in_flight:
+                self.condition.wait()
+            result = self.result
+            self.result = None
+            self.key = None
+            return result
+
+    def _discard(self):
+        if self.result is not None:
+            audio_source, _, audio_archive = self.result['audio']
+            close_audio_source(audio_source, audio_archive)
+            self.result = None
+
+    def _is_stale(self, generation):
+        with self.condition:
+            return generation != self.generation
+
+    def _work(self, generation, map_filepath, difficulty):
+        result = None
+        try:
+            hitobjects, map_name = load_map(map_filepath, difficulty)
+            hitobjects.sort(key=lambda x: x.time)
+            if not self._is_stale(generation):
+                result = {'path': map_filepath, 'hitobjects': hitobjects, 'map_name': map_name,
+                          'audio': resolve_map_audio(map_filepath, difficulty)}
+        except Exception as e:
+            # play_game falls back to loading synchronously and reports the error there
+            print(f"Could not preload {map_filepath}: {e}")
+        with self.condition:
+            if generation != self.generation:
+                if result is not None:
+                    audio_source, _, audio_archive = result['audio']
+                    close_audio_source(audio_source, audio_archive)
+                return
+            self.result = result
+            self.in_flight = False
+            self.condition.notify_all()
+
+_MAP_PRELOADER = MapPreloader()
+
+def analysis_dir():
+    return os.path.join(os.path.dirname(LIBRARY_INDEX_PATH), 'analysis')
+
+def analysis_key(path, audio_filename):
+    """Cache key of a song's analysis, or None if the audio cannot be read. Keyed on the audio
+    content like the decoded audio cache, so editing a map's .osu files keeps its analysis
+    and maps sharing a song share one."""
+    if not audio_filename:
+        return None
+    try:
+        if path.endswith('.osz'):
+            with zipfile.ZipFile(path, 'r') as z:
+                info = z.getinfo(audio_filename)
+            checksum = info.CRC, info.file_size
+        else:
+            checksum = file_checksum(os.path.join(os.path.dirname(path), audio_filename))
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+    return f'{audio_digest(*checksum)}-v{ANALYSIS_FORMAT}'
+
+def compute_song_analysis(samples, frequency):
+    """Returns (envelope, bands) for decoded 16-bit samples. The envelope holds the peak of
+    every 1/ENVELOPE_RATE s, the bands table one row of SPECTRUM_BANDS magnitudes every
+    1/SPECTRUM_FPS s, both scaled to uint8."""
+    mono = (samples.mean(axis=1) if samples.ndim == 2 else samples).astype(np.float32) / 32768.0
+    block = max(1, frequency // ENVELOPE_RATE)
+    count = len(mono) // block
+    envelope = np.abs(mono[:count * block]).reshape(count, block).max(axis=1)
+    envelope = envelope / max(float(envelope.max(initial=0.0)), 1e-6)
+
+    # Hann-windowed FFT frames centered on every hop, averaged into log-spaced bands
+    hop = max(1, frequency // SPECTRUM_FPS)
+    padded = np.concatenate((np.zeros(SPECTRUM_WINDOW // 2, np.float32), mono, np.zeros(SPECTRUM_WINDOW // 2, np.float32)))
+    frames = np.lib.stride_tricks.sliding_window_view(padded, SPECTRUM_WINDOW)[::hop][:len(mono) // hop + 1]
+    edges = np.geomspace(SPECTRUM_LOW_HZ, frequency / 2, SPECTRUM_BANDS + 1)
+    band_of_bin = np.searchsorted(edges, np.fft.rfftfreq(SPECTRUM_WINDOW, 1.0 / frequency), side='right') - 1
+    weights = np.zeros((len(band_of_bin), SPECTRUM_BANDS), np.float32)
+    in_range = (band_of_bin >= 0) & (band_of_bin < SPECTRUM_BANDS)
+    weights[np.nonzero(in_range)[0], band_of_bin[in_range]] = 1.0
+    weights /= np.maximum(weights.sum(axis=0), 1.0)
+    window = np.hanning(SPECTRUM_WINDOW).astype(np.float32)
+    bands = np.empty((len(frames), SPECTRUM_BANDS), np.float32)
+    for start in range(0, len(frames), SPECTRUM_CHUNK):
+        chunk = frames[start:start + SPECTRUM_CHUNK] * window
+        bands[start:start + len(chunk)] = np.abs(np.fft.rfft(chunk, axis=1)) @ weights
+    # Log scale, then normalize every band to its own loud end so quiet highs still move
+    bands = np.log1p(bands * 100.0)
+    bands /= np.maximum(np.percentile(bands, 99, axis=0), 1e-6)
+    return (np.clip(envelope, 0, 1) * 255).astype(np.uint8), (np.clip(bands, 0, 1) * 255).astype(np.uint8)
+
+def save_song_analysis(key, envelope, bands):
+    os.makedirs(analysis_dir(), exist_ok=True)
+    for name, array in (('envelope', envelope), ('bands', bands)):
+        path = os.path.join(analysis_dir(), f'{key}.{name}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path) # Readers never see a half-written file
+
+class SongAnalysis:
+    """A song's cached envelope and band table, memory-mapped so looking up the current
+    frame touches one row and nothing is read up front."""
+    def __init__(self, key):
+        base = os.path.join(analysis_dir(), key)
+        self.envelope = np.load(base + '.envelope.npy', mmap_mode='r')
+        self.bands = np.load(base + '.bands.npy', mmap_mode='r')
+        self.strip = None # (size, surface) of the last rendered waveform strip
+
+    def bands_at(self, ms):
+        """Band levels (0-255) at a song position in ms."""
+        return self.bands[min(max(int(ms * SPECTRUM_FPS // 1000), 0), len(self.bands) - 1)]
+
+    def length_ms(self):
+        return len(self.envelope) * 1000 // ENVELOPE_RATE
+
+    def waveform_strip(self, size):
+        """The whole envelope squeezed into a strip of the given size, rendered once per size."""
+        if self.strip is None or self.strip[0] != size:
+            width, height = size
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            if len(self.envelope) and width > 0:
+                starts = np.linspace(0, len(self.envelope), width, endpoint=False).astype(int)
+                peaks = np.maximum.reduceat(np.asarray(self.envelope), starts).astype(int) * height // 255
+                for x, peak in enumerate(peaks.tolist()):
+                    half = max(1, peak // 2)
+                    pygame.draw.line(surface, OSU_MEDIUM_GREY, (x, height // 2 - half), (x, height // 2 + half - 1))
+            self.strip = (size, surface)
+        return self.strip[1]
+
+_SONG_ANALYSIS = {} # key -> SongAnalysis, opened on first use
+
+def load_song_analysis(key):
+    """The cached analysis for a key, or None if it has not been computed."""
+    if key is None:
+        return None
+    if key not in _SONG_ANALYSIS:
         try:
-            pygame.mixer.music.load(audio_path)
+            _SONG_ANALYSIS[key] = SongAnalysis(key)
+        except (OSError, ValueError):
+            return None
+    return _SONG_ANALYSIS[key]
+
+def ensure_song_analysis(key, samples, frequency):
+    """Computes and caches a song's analysis unless it already is. Returns whether it is available."""
+    base = os.path.join(analysis_dir(), key)
+    if os.path.exists(base + '.envelope.npy') and os.path.exists(base + '.bands.npy'):
+        return True
+    try:
+        save_song_analysis(key, *compute_song_analysis(samples, frequency))
+        return True
+    except (OSError, ValueError) as e:
+        print(f"Could not analyze song: {e}")
+        return False
+
+def draw_spectrum_background(screen, levels):
+    """Beat-reactive menu background: one bar per band rising from the bottom edge."""
+    width, height = LAYOUT.size
+    bar_width = width / len(levels)
+    for i, level in enumerate(levels.tolist()):
+        bar_height = level * height // 640 # Full level reaches 40% of the window
+        shade = 40 + level // 4
+        pygame.draw.rect(screen, (shade // 2, shade, min(255, shade * 2)),
+                         (int(i * bar_width) + 2, height - bar_height, int(bar_width) - 4, bar_height))
+
+class AudioPreviewPlayer:
+    """Plays a song preview from the map's PreviewTime once the maps menu selection settles.
+    Clips are decoded on a worker thread and kept in a size-bounded LRU, so scrolling back
+    to a map replays its preview without decoding again or blocking the UI thread."""
+    def __init__(self, max_bytes=PREVIEW_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.clips = OrderedDict() # (path, audio_filename, preview_time) -> (Sound, size in bytes, start ms, analysis key)
+        self.cached_bytes = 0
+        self.failed = set()        # Keys whose audio could not be decoded
+        self.lock = threading.Lock()
+        self.decode_lock = threading.Lock() # Held while decoding, restart_mixer takes it to keep the mixer up
+        self.wake = threading.Event()
+        self.pending = None        # Latest decode job, older ones are simply replaced
+        self.generation = 0        # Bumped by clear(), so clips decoded for an old mixer format are dropped
+        self.worker = None
+        self.wanted = None         # Clip the menu currently wants to hear
+        self.playing = None
+        self.channel = None
+        self.started_at = 0        # Ticks when the playing clip started, and its start in the song
+        self.clip_start = 0
+        self.analysis = None       # SongAnalysis of the playing song, if it has been computed
+
+    def request(self, entry):
+        if not pygame.mixer.get_init():
+            return
+        key = (entry['path'], entry.get('audio_filename'), entry.get('preview_time', -1))
+        if key == self.wanted:
+            return
+        self.stop()
+        self.wanted = key
+        with self.lock:
+            if key in self.clips or key in self.failed:
+                return # update() picks cached clips up on the next frame
+            self.pending = (key, entry['path'], entry.get('difficulty'))
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._run, daemon=True)
+            self.worker.start()
+        self.wake.set()
+
+    def stop(self):
+        if self.channel is not None:
+            self.channel.fadeout(200)
+            self.channel = None
+        self.wanted = None
+        self.playing = None
+        self.analysis = None
+
+    def clear(self):
+        """Drops every decoded clip, e.g. when the mixer format changes."""
+        self.stop()
+        with self.lock:
+            self.clips.clear()
+            self.cached_bytes = 0
+            self.failed.clear()
+            self.generation += 1
+
+    def retry(self, path):
+        """Forgets failed decodes of a map, e.g. once its audio has been converted."""
+        with self.lock:
+            self.failed = {key for key in self.failed if key[0] != path}
+            if self.wanted is not None and self.wanted[0] == path and self.playing != self.wanted:
+                self.wanted = None # The menu's next request() starts the decode again
+
+    def waiting(self):
+        """True while the wanted clip is still being decoded."""
+        with self.lock:
+            return self.wanted is not None and self.playing != self.wanted and self.wanted not in self.failed
+
+    def update(self):
+        """Starts the wanted clip once it is decoded. Called every frame by the maps menu."""
+        if self.wanted is None or self.playing == self.wanted:
+            return
+        with self.lock:
+            clip = self.clips.get(self.wanted)
+            if clip is not None:
+                self.clips.move_to_end(self.wanted)
+        if clip is not None:
+            clip[0].set_volume(SETTINGS['music_volume'])
+            self.channel = clip[0].play(fade_ms=300)
+            self.playing = self.wanted
+            self.started_at, self.clip_start = pygame.time.get_ticks(), clip[2]
+            self.analysis = load_song_analysis(clip[3])
+
+    def position(self):
+        """Song position of the playing preview in ms, or None when nothing is audible."""
+        if self.channel is None or not self.channel.get_busy():
+            return None
+        return self.clip_start + pygame.time.get_ticks() - self.started_at
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock:
+                job, self.pending = self.pending, None
+                generation = self.generation
+            if job is None:
+                continue
+            key, path, difficulty = job
+            try:
+                with self.decode_lock:
+                    samples, frequency, sound, size, start_ms = self._decode(path, difficulty, key)
+                # The whole song is decoded here anyway, so this is where its visualizer data gets
+                # made; outside the lock, so restarting the mixer does not wait for the analysis
+                song_key = analysis_key(path, key[1])
+                if song_key is not None and not ensure_song_analysis(song_key, samples, frequency):
+                    song_key = None
+                clip = (sound, size, start_ms, song_key)
+            except Exception as e: # Anything left uncaught would end this thread for the session
+                print(f"Could not decode preview for {path}: {e}")
+                with self.lock:
+                    self.failed.add(key)
+                continue
+            with self.lock:
+                if generation != self.generation:
+                    continue
+                self.clips[key] = clip
+                self.cached_bytes += clip[1]
+                while self.cached_bytes > self.max_bytes and len(self.clips) > 1:
+                    _, (_, evicted_bytes, _, _) = self.clips.popitem(last=False)
+                    self.cached_bytes -= evicted_bytes
+
+    def _decode(self, path, difficulty, key):
+        """Decodes the whole song and cuts its preview clip. Returns (samples, frequency, Sound,
+        clip size in bytes, clip start in ms). Uses the mixer, so it runs under decode_lock."""
+        preview_time = key[2]
+        source, member, archive = resolve_map_audio(path, difficulty)
+        if source is None:
+            raise ValueError("map has no audio")
+        try:
+            samples = pygame.sndarray.array(pygame.mixer.Sound(source))
+        finally:
+            close_audio_source(source, archive)
+        frequency = pygame.mixer.get_init()[0]
+        # Maps without a PreviewTime preview from 40% into the song, like osu! does
+        start = preview_time * frequency // 1000 if preview_time >= 0 else int(len(samples) * 0.4)
+        start = min(start, max(0, len(samples) - frequency))
+        clip = np.array(samples[start:start + PREVIEW_CLIP_SECONDS * frequency])
+        fade = min(len(clip), frequency) # Fade out over the last second
+        ramp = np.linspace(1.0, 0.0, fade)
+        clip[len(clip) - fade:] = (clip[len(clip) - fade:] * (ramp[:, None] if clip.ndim == 2 else ramp)).astype(clip.dtype)
+        return samples, frequency, pygame.sndarray.make_sound(clip), clip.nbytes, start * 1000 // frequency
+
+_AUDIO_PREVIEW = AudioPreviewPlayer()
+
+# Keys that nudge the current map's offset during play, in ms
+MAP_OFFSET_KEYS = {pygame.K_EQUALS: 5, pygame.K_PLUS: 5, pygame.K_KP_PLUS: 5, pygame.K_MINUS: -5, pygame.K_KP_MINUS: -5}
+
+def rate_mod_name(mod):
+    """How a rate mod is shown in menus, noting when it will shift the pitch as a fallback."""
+    if mod in RATE_MODS and RATE_MODS[mod][1] and not LIBROSA_AVAILABLE:
+        return f'{mod} (pitch shifted, librosa not installed)'
+    return mod
+
+def apply_playback_rate(hitobjects, rate):
+    """Rescales a freshly loaded chart from song time to real time at a playback rate:
+    object times, slider ends, approach times and hit windows all shrink by the rate."""
+    if rate == 1.0 or not hitobjects:
+        return
+    timing = np.array([(obj.time, getattr(obj, 'end_time', obj.time), obj.approach_time, obj.hit_window)
+                       for obj in hitobjects], dtype=float) / rate
+    for obj, (start, end, approach, window) in zip(hitobjects, timing.tolist()):
+        obj.time, obj.approach_time, obj.hit_window = start, approach, window
+        obj.lifetime = approach + window
+        if isinstance(obj, SliderObject):
+            obj.end_time = end
+
+def play_game(screen, clock, map_filepath, map_name, hit_sound, difficulty=None, on_menu=None, rate=1.0, audio_path=None):
+    # on_menu is called whenever the pause or game over menu is about to show.
+    # rate speeds the chart up or down; audio_path then holds the song rendered for that rate.
+    # Use the chart and audio prepared in the background by maps_menu when available
+    preloaded = _MAP_PRELOADER.take(map_filepath, difficulty)
+    if preloaded is not None:
+        hitobjects = preloaded['hitobjects']
+        audio_source, audio_namehint, audio_archive = preloaded['audio']
+    else:
+        hitobjects, map_name_from_file = load_map(map_filepath, difficulty)
+        # Sort hitobjects by time for correct playback order
+        hitobjects.sort(key=lambda x: x.time)
+        audio_source, audio_namehint, audio_archive = None, None, None
+    if not hitobjects:
+        print(f"No hitobjects found in map: {map_filepath}")
+        close_audio_source(audio_source, audio_archive)
+        return 'Maps' # Go back to maps menu
+    apply_playback_rate(hitobjects, rate)
+
+    # Audio handling (played from memory or straight from the archive, no temp files)
+    if rate != 1.0:
+        close_audio_source(audio_source, audio_archive)
+        audio_source, audio_namehint, audio_archive = audio_path, audio_path and os.path.basename(audio_path), None
+    elif preloaded is None:
+        audio_source, audio_namehint, audio_archive = resolve_map_audio(map_filepath, difficulty)
+    audio_loaded = False
+    if audio_source is not None:
+        try:
+            load_music(audio_source, audio_namehint, audio_archive)
             pygame.mixer.music.set_volume(SETTINGS['music_volume'])
             pygame.mixer.music.play()
-            print(f"Playing audio: {audio_path}")
+            audio_loaded = True
+            print(f"Playing audio: {audio_namehint}")
         except pygame.error as e:
             print(f"Could not load or play audio: {e}")
-            audio_path = None
     next_circle_index = 0
     score = 0
     health = 100
@@ -1353,42 +3301,45 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
     max_health = 100
     combo = 0
     last_hit_time = 0
-    font = pygame.font.SysFont('Arial', 32)
-    combo_font = pygame.font.SysFont('Arial', 48, bold=True)
-    hit_feedback_font = pygame.font.SysFont('Arial', 30, bold=True)
+    font = get_font(32)
+    combo_font = get_font(48, bold=True)
+    hit_feedback_font = get_font(30, bold=True)
+    stats_font = get_font(20)
     hit_feedbacks = []
-    perfect_hit_window = 100   # was 50
-    great_hit_window = 200     # was 100
-    good_hit_window = 400      # was 200
-    miss_window_threshold = 600 # was 300
+    perfect_hit_window = 100 / rate   # was 50
+    great_hit_window = 200 / rate     # was 100
+    good_hit_window = 400 / rate      # was 200
+    miss_window_threshold = 600 / rate # was 300
     running = True
     start_time = pygame.time.get_ticks()
+    local_offset = map_offset(map_filepath, difficulty)
     pygame.mouse.set_visible(not SETTINGS['custom_cursor'])
     while running:
-        now = pygame.time.get_ticks() - start_time
-        current_width, current_height = screen.get_size()
+        # The game clock runs behind the music by the global and per-map offsets
+        now = pygame.time.get_ticks() - start_time - SETTINGS['audio_offset'] - local_offset
+        screen = apply_pending_resize(screen)
+        current_width, current_height = LAYOUT.size
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
                 return 'Quit'
             elif event.type == pygame.VIDEORESIZE:
-                SETTINGS['current_width'], SETTINGS['current_height'] = event.w, event.h
-                screen = pygame.display.set_mode((SETTINGS['current_width'], SETTINGS['current_height']), pygame.RESIZABLE)
+                queue_resize(event)
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     pygame.mixer.music.pause()
+                    if on_menu:
+                        on_menu()
                     result = pause_menu(screen, clock, map_name)
                     pygame.mouse.set_visible(not SETTINGS['custom_cursor'])
                     if result == 'Resume':
                         pygame.mixer.music.unpause()
                     else:
-                        if audio_path and current_audio_temp_file and os.path.exists(current_audio_temp_file):
-                            try:
-                                os.remove(current_audio_temp_file)
-                                current_audio_temp_file = None
-                            except OSError as e:
-                                print(f"Error removing temporary audio file {current_audio_temp_file}: {e}")
                         return result
+                elif event.key in MAP_OFFSET_KEYS:
+                    local_offset = max(-MAX_AUDIO_OFFSET, min(MAX_AUDIO_OFFSET, local_offset + MAP_OFFSET_KEYS[event.key]))
+                    set_map_offset(map_filepath, difficulty, local_offset)
+                    hit_feedbacks.append({'text': f'Map offset: {local_offset:+d} ms', 'time': pygame.time.get_ticks(), 'color': OSU_LIGHT_GREY, 'pos': (current_width // 2, 90)})
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
                     found_hit = False
@@ -1403,8 +3354,7 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
                                     health = min(health + 5, max_health)
                                     combo += 1
                                     obj.hit = True
-                                    hit_sound.set_volume(SETTINGS['sfx_volume'])
-                                    hit_sound.play()
+                                    hit_sound.play_object(obj)
                                     hit_feedbacks.append({'text': 'Perfect!', 'time': pygame.time.get_ticks(), 'color': (0, 255, 0), 'pos': event.pos})
                                     found_hit = True
                                     last_hit_time = now
@@ -1414,8 +3364,7 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
                                     health = min(health + 2, max_health)
                                     combo += 1
                                     obj.hit = True
-                                    hit_sound.set_volume(SETTINGS['sfx_volume'])
-                                    hit_sound.play()
+                                    hit_sound.play_object(obj)
                                     hit_feedbacks.append({'text': 'Great!', 'time': pygame.time.get_ticks(), 'color': (0, 200, 255), 'pos': event.pos})
                                     found_hit = True
                                     last_hit_time = now
@@ -1425,8 +3374,7 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
                                     health = min(health + 1, max_health)
                                     combo += 1
                                     obj.hit = True
-                                    hit_sound.set_volume(SETTINGS['sfx_volume'])
-                                    hit_sound.play()
+                                    hit_sound.play_object(obj)
                                     hit_feedbacks.append({'text': 'Good!', 'time': pygame.time.get_ticks(), 'color': (255, 255, 0), 'pos': event.pos})
                                     found_hit = True
                                     last_hit_time = now
@@ -1461,6 +3409,11 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
                 next_circle_index += 1
         draw_gradient_rect(screen, (0, 0, current_width, current_height), (30, 60, 120), (10, 10, 40), vertical=True)
 
+        # Draw slider tracks and balls underneath the hit circles
+        for obj in hitobjects:
+            if isinstance(obj, SliderObject):
+                obj.draw_body(screen, now)
+
         # Draw all active hit circles
         for obj in hitobjects:
             t = obj.time - now
@@ -1500,6 +3453,10 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
                 screen.blit(feedback_surface, feedback_rect)
                 feedbacks_to_keep.append(fb)
         hit_feedbacks = feedbacks_to_keep
+        if SETTINGS['show_fps_counter']:
+            stats = hit_sound.stats
+            stats_text = stats_font.render(f"{clock.get_fps():.0f} FPS | hitsounds: {stats['played']} played, {stats['stolen']} stolen, {stats['dropped']} dropped", True, OSU_LIGHT_GREY)
+            screen.blit(stats_text, stats_text.get_rect(bottomleft=(10, current_height - 10)))
         if SETTINGS['custom_cursor']:
             mx, my = pygame.mouse.get_pos()
             for r in range(20, 8, -2):
@@ -1507,41 +3464,89 @@ def play_game(screen, clock, map_filepath, map_name, hit_sound):
             pygame.draw.circle(screen, (255,255,255), (mx, my), 16, 2)
         pygame.display.flip()
         clock.tick(FPS)
-        if health <= 0:
-            if audio_path and os.path.exists(audio_path):
-                pygame.mixer.music.stop()
-            result = game_over_screen(screen, clock, score, 'Failed')
-            if audio_path and current_audio_temp_file and os.path.exists(current_audio_temp_file):
-                try:
-                    os.remove(current_audio_temp_file)
-                    current_audio_temp_file = None
-                except OSError as e:
-                    print(f"Error removing temporary audio file {current_audio_temp_file}: {e}")
-            return result
-        if all(obj.hit or obj.disappeared for obj in hitobjects):
-            if audio_path and os.path.exists(audio_path):
+        if health <= 0 or all(obj.finished(now) for obj in hitobjects):
+            if audio_loaded:
                 pygame.mixer.music.stop()
-            result = game_over_screen(screen, clock, score, 'Completed')
-            if audio_path and current_audio_temp_file and os.path.exists(current_audio_temp_file):
-                try:
-                    os.remove(current_audio_temp_file)
-                    current_audio_temp_file = None
-                except OSError as e:
-                    print(f"Error removing temporary audio file {current_audio_temp_file}: {e}")
-            return result
-    if audio_path and current_audio_temp_file and os.path.exists(current_audio_temp_file):
-        try:
-            os.remove(current_audio_temp_file)
-        except OSError as e:
-            print(f"Error removing temporary audio file {current_audio_temp_file}: {e}")
+            if on_menu:
+                on_menu()
+            return game_over_screen(screen, clock, score, 'Failed' if health <= 0 else 'Completed')
     return 'Maps'
 
+class PlayScene(Scene):
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.queued_rate = None # (path, audio, mod) whose rate mod audio was last queued
+        self.queued_map = None  # (path, snapshot signature, mixer format) last checked for conversion
+
+    def preload(self, entry):
+        _MAP_PRELOADER.request(entry['path'], entry['difficulty'])
+        # Scans only check unchanged files once per mixer format, so a conversion cut short by
+        # quitting is queued again here, once per selection since checking reads the audio
+        queued_map = (entry['path'], _MAP_LIBRARY['snapshot'].get(entry['path']), pygame.mixer.get_init())
+        if pygame.mixer.get_init() and self.queued_map != queued_map:
+            self.queued_map = queued_map
+            _TRANSCODER.queue_map(entry['path'])
+        mod = SETTINGS['rate_mod']
+        # Start rendering the mod's audio as soon as the map is selected, not when it starts
+        if mod in RATE_MODS and pygame.mixer.get_init() and self.queued_rate != (entry['path'], entry.get('audio_filename'), mod):
+            self.queued_rate = (entry['path'], entry.get('audio_filename'), mod)
+            _TRANSCODER.queue_rate(entry, mod)
+
+    def wait_for_rate_audio(self, screen, clock, entry, mod):
+        """Waits for the mod's audio to finish rendering. Returns (started, path): started is
+        False if the player backed out, path is None if the song could not be rendered."""
+        out_path = _TRANSCODER.queue_rate(entry, mod) if pygame.mixer.get_init() else None
+        if out_path is None:
+            return True, None
+        label = Label(f'Preparing {rate_mod_name(mod)} audio...', get_font(36))
+        overlay = Menu([label, Label('Esc to cancel', get_font(24), OSU_LIGHT_GREY)], lambda w, h: [(w//2, h//2), (w//2, h//2 + 50)])
+        while True:
+            status = _TRANSCODER.status(out_path)
+            if status != 'pending':
+                return True, out_path if status == 'ready' else None
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
+                elif event.type == pygame.VIDEORESIZE:
+                    queue_resize(event)
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                    return False, None
+            screen = apply_pending_resize(screen)
+            draw_menu_background(screen)
+            overlay.draw(screen)
+            pygame.display.flip()
+            clock.tick(20)
+
+    def run(self, screen, clock, entry):
+        offset = map_offset(entry['path'], entry['difficulty'])
+        mod = SETTINGS['rate_mod']
+        rate, audio_path, label = 1.0, None, entry['label']
+        if mod in RATE_MODS:
+            started, audio_path = self.wait_for_rate_audio(screen, clock, entry, mod)
+            if not started:
+                return ('maps', {})
+            rate, label = RATE_MODS[mod][0], f"{label} +{mod}"
+        # Prepare a retry in the background while the pause or game over menu is up
+        result = play_game(screen, clock, entry['path'], label, self.manager.hit_sound, entry['difficulty'],
+                           on_menu=lambda: self.preload(entry), rate=rate, audio_path=audio_path)
+        if map_offset(entry['path'], entry['difficulty']) != offset:
+            save_library_index()
+        if result == 'Retry':
+            return ('play', {'entry': entry}) # Straight back into the map, no menus in between
+        elif result == 'Maps':
+            if rate == 1.0 and pygame.mixer.get_init():
+                # Decoded once the song is over, so the worker does not compete with gameplay
+                _TRANSCODER.queue_decoded(entry)
+            return ('maps', {})
+        return None # Quit
+
 # Placeholder for osu!mania gamemode
 def osu_mania_mode(screen, clock):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
+    font_big = get_font(54, bold=True)
     running = True
     while running:
-        current_width, current_height = screen.get_size()
+        current_width, current_height = LAYOUT.size
         draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True)
         title = font_big.render('osu!mania Mode (Placeholder)', True, OSU_BLUE)
         title_rect = title.get_rect(center=(current_width//2, current_height//2))
@@ -1557,10 +3562,10 @@ def osu_mania_mode(screen, clock):
 
 # Placeholder for osu!taiko gamemode
 def osu_taiko_mode(screen, clock):
-    font_big = pygame.font.SysFont('Arial', 54, bold=True)
+    font_big = get_font(54, bold=True)
     running = True
     while running:
-        current_width, current_height = screen.get_size()
+        current_width, current_height = LAYOUT.size
         draw_gradient_rect(screen, (0, 0, current_width, current_height), OSU_DARK_GREY, (10, 10, 40), vertical=True)
         title = font_big.render('osu!taiko Mode (Placeholder)', True, OSU_BLUE)
         title_rect = title.get_rect(center=(current_width//2, current_height//2))
@@ -1575,6 +3580,10 @@ def osu_taiko_mode(screen, clock):
         clock.tick(FPS)
 
 def main():
+    load_settings()
+    # The mixer has to be configured before pygame.init() starts it with SDL's defaults
+    _MIXER_STATE['settings'] = mixer_settings()
+    pygame.mixer.pre_init(*_MIXER_STATE['settings'])
     pygame.init()
     pygame.font.init() # Initialize font module
 
@@ -1586,13 +3595,13 @@ def main():
     except pygame.error as e:
         print(f"Warning: Pygame mixer could not be initialized. Running in silent mode. Error: {e}")
 
-    # 2. Attempt to generate hitsound if mixer is up
+    # 2. Attempt to load the hitsound bank if mixer is up (synthesized once, then read from disk)
     hit_sound = None
     if mixer_initialized:
         try:
-            hit_sound = generate_hitsound()
+            hit_sound = HitsoundBank()
         except pygame.error as e:
-            print(f"Warning: Could not generate hitsound. SFX will be disabled. Error: {e}")
+            print(f"Warning: Could not generate hitsounds. SFX will be disabled. Error: {e}")
 
     # 3. Create dummy objects for whatever failed
     if not mixer_initialized:
@@ -1602,54 +3611,35 @@ def main():
             def pause(self, *args, **kwargs): pass
             def unpause(self, *args, **kwargs): pass
             def stop(self, *args, **kwargs): pass
+            def unload(self, *args, **kwargs): pass
             def set_volume(self, *args, **kwargs): pass
         pygame.mixer.music = DummyMusic()
     if not hit_sound:
         class DummySound:
+            stats = {'played': 0, 'stolen': 0, 'dropped': 0}
             def play(self, *args, **kwargs): pass
+            def play_object(self, *args, **kwargs): pass
             def set_volume(self, *args, **kwargs): pass
+            def reload(self, *args, **kwargs): pass
         hit_sound = DummySound()
 
-    screen = pygame.display.set_mode((INITIAL_WIDTH, INITIAL_HEIGHT), pygame.RESIZABLE)
+    screen = set_display_mode((INITIAL_WIDTH, INITIAL_HEIGHT))
     pygame.display.set_caption("osu!python")
 
     clock = pygame.time.Clock()
 
-    global SETTINGS # Declare that we intend to modify the global SETTINGS
-    global current_audio_temp_file
-
-    running = True
-    while running:
-        SETTINGS = main_menu(screen, clock, SETTINGS, hit_sound) # Pass and receive updated settings
-
-        if SETTINGS is None: # This could happen if main_menu decides to quit
-            running = False
-            break
-
-        # If 'Start' was selected in main_menu, go to maps_menu
-        selected_map_path = maps_menu(screen, clock)
-
-        if selected_map_path:
-            map_name = os.path.splitext(os.path.basename(selected_map_path))[0]
-            result = play_game(screen, clock, selected_map_path, map_name, hit_sound)
-
-            if result == 'Quit':
-                running = False
-            elif result == 'Retry':
-                # Restart this map from the beginning
-                continue # Loop back to play_game with the same map
-            elif result == 'Maps':
-                continue # Loop back to maps_menu
-        else:
-            # If maps_menu returned None (Back to Main Menu) or no map selected, loop back to main_menu
-            continue 
-    
-    # Clean up temporary audio file if it exists
-    if current_audio_temp_file and os.path.exists(current_audio_temp_file):
-        try:
-            os.remove(current_audio_temp_file)
-        except OSError as e:
-            print(f"Error removing temporary audio file {current_audio_temp_file}: {e}")
+    manager = SceneManager(clock, hit_sound)
+    manager.register('main_menu', MainMenuScene)
+    manager.register('settings', SettingsScene)
+    manager.register('audio', AudioSettingsScene)
+    manager.register('calibration', CalibrationScene)
+    manager.register('tutorial', TutorialScene)
+    manager.register('about', AboutScene)
+    manager.register('maps', MapsMenuScene)
+    manager.register('play', PlayScene)
+    manager.run('main_menu')
+    save_settings()
+    _TRANSCODER.shutdown()
 
     pygame.mouse.set_visible(True) # Ensure cursor is visible when returning to main menu
 